@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import numpy as np
+import argparse
+import io as bytes_io
+import json
+import os
+import pickle
+import platform
+import time
+from Helmholtz import *
+from Sequential_Monte_Carlo import *
+
+'''
+Component benchmarks of the forward model and the SMC loop. Every component is timed on its own, one
+parameter is varied at a time around a base configuration, and the medians are written to a JSON file and
+compared with a stored baseline:
+
+python Benchmark.py                        quick sweep, compared with Benchmarks/baseline.json
+python Benchmark.py --full                 all sweeps
+python Benchmark.py --save-baseline        store the results as the new baseline
+'''
+
+base_forward = {"freq" : 10**9, "h" : 0.125, "quad" : False, "char_len" : True, "s" : 0.2, "K" : 100, "assembly" : "operator"} # Runs on the shipped Meshes/ files
+base_smc     = {"M" : 1000, "s" : 0.2}
+
+sweeps_quick = {"forward" : {"K" : [25, 400], "s" : [0.001]}, "smc" : {"M" : [10000]}}
+sweeps_full  = {"forward" : {"h" : [0.125, 0.04419], "quad" : [True], "freq" : [2*10**9], "s" : [0.02, 0.001], "K" : [25, 400], "assembly" : ["form"]},
+                "smc"     : {"M" : [10000, 100000], "s" : [0.001]}}
+
+
+def timed(func, repeat): # Median wall time of repeat calls
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def configurations(base, sweeps): # Base configuration and one-at-a-time variations of it
+    yield dict(base)
+    for name, values in sweeps.items():
+        for value in values:
+            if value != base.get(name):
+                yield dict(base, **{name: value})
+
+
+def label(kwargs):
+    return ",".join("{0}={1}".format(name, kwargs[name]) for name in sorted(kwargs))
+
+
+def benchmark_forward(kwargs, repeat): # Mesh, model setup, mapping, assembly, solve, Phi_inv, observation and gradient of one discretization
+    r0, r1, R, epsilon = 1, 6, 7, 0.001
+    results = {}
+    results["mesh"]  = timed(lambda: Generate_Mesh(**kwargs)(), repeat)
+    start = time.perf_counter()
+    model = forward_models[forward_model_key(**kwargs)] = Forward_Model(**kwargs) # Timed build is the cached model, so it is not built twice
+    results["model"] = time.perf_counter() - start # Includes the form compilation
+    solver, observation = model.forward_solver, model.observations[0]
+    sum, J = spectral_constants(kwargs["s"], epsilon, kwargs["char_len"])
+    Y = np.random.uniform(-1, 1, 2*J)
+
+    results["mapping_build"] = timed(lambda: Coordinate_Mapping(R, r0, kwargs["char_len"], kwargs["s"], epsilon, J, sum, solver.points), repeat)
+    mapping = solver.get_mapping(R, r0, kwargs["char_len"], kwargs["s"], epsilon, J, sum)
+    results["mapping"] = timed(lambda: solver.set_coefficients(*mapping(Y)), repeat)
+
+    uhs = [observation.uh for observation in model.observations]
+    assembly_time, solve_time, n_solves = solver.assembly_time, solver.solve_time, solver.n_solves # Assembly and solve are timed inside the solver
+    for i in range(repeat):
+        solver.solve(uhs)
+    results["assembly"] = (solver.assembly_time - assembly_time)/repeat
+    results["solve"]    = (solver.solve_time - solve_time)/(solver.n_solves - n_solves) # Per right-hand side
+
+    measurement_points = np.array([r1*np.cos(model.angles_meas), r1*np.sin(model.angles_meas)])
+    results["phi_inv"] = timed(lambda: Phi_inv(R, r0, kwargs["char_len"], kwargs["s"], epsilon, J, sum, Y, measurement_points), repeat)
+    ref_measurement_points = Phi_inv(R, r0, kwargs["char_len"], kwargs["s"], epsilon, J, sum, Y, measurement_points)
+    observation.kappa_sqrd_hat.x.array[:] = solver.kappa_sqrd_hat.x.array
+    results["observation"] = timed(lambda: observation(ref_measurement_points), repeat)
+
+    Ys = np.random.uniform(-1, 1, (repeat, 2*J))
+    results["forward_per_particle"] = timed(lambda: forward_observation(Ys, **kwargs), 1)/repeat
+    delta = forward_observation(np.zeros(2*J), **kwargs)
+    results["gradient_per_particle"] = timed(lambda: forward_observation(Ys, gradient=(delta, 1), **kwargs), 1)/repeat # Forward and adjoint solves
+    results["dofs"] = model.V.dofmap.index_map.size_global # Not a time, reported for the scaling
+    return results
+
+
+def linear_observation(Y, **kwargs): # Cheap stand-in for the forward map, picklable for the worker pool
+    return np.atleast_2d(Y) @ kwargs["G"]
+
+
+def benchmark_smc(kwargs, repeat): # Bookkeeping of the SMC loop with a cheap linear forward map, so solves do not hide it
+    sum, J = spectral_constants(kwargs["s"], 0.001, True)
+    func_kwargs = {"G" : np.random.standard_normal((2*J, 100))/np.sqrt(2*J)}
+    smc = Sequential_Monte_Carlo(linear_observation(np.zeros(2*J), **func_kwargs)[0], 0.1, J, M=kwargs["M"], checkpoint_dir=None)
+    smc.observed = linear_observation(smc.particles, **func_kwargs)
+    potent = smc.misfit(smc.observed)
+
+    results = {}
+    def temperature():
+        smc.T = [0]
+        smc.weights = np.full(len(smc.particles), 1/smc.M)
+        smc.adaptive_temperature(potent)
+        smc.reweight(potent)
+    results["temperature"] = timed(temperature, repeat)
+    results["resample"]    = timed(lambda: smc.resample(potent), repeat)
+    results["adapt"]       = timed(smc.adaptive_MH, repeat)
+    results["propose"]     = timed(lambda: smc.kernel.in_support(smc.kernel.propose(smc.particles)), repeat)
+    results["pickle"]      = timed(lambda: pickle.dump((smc.particles, smc.weights), bytes_io.BytesIO()), repeat)
+    checkpoint = Checkpoint("Benchmarks/checkpoint")
+    results["checkpoint"]  = timed(lambda: checkpoint.write("current", **smc.get_state(potent)), repeat)
+
+    pool = smc.make_pool(linear_observation, func_kwargs)
+    results["dispatch"] = timed(lambda: pool.observations(smc.particles, linear_observation, func_kwargs), repeat) # Transfer and scheduling cost of the worker pool
+    pool.close()
+    return results
+
+
+def compare(results, baseline, tolerance): # Ratios to the baseline, flagged beyond the tolerance
+    print("{0:<70} {1:>11} {2:>11} {3:>7}".format("benchmark", "baseline", "now", "ratio"))
+    for key in sorted(results):
+        if key not in baseline or key.endswith("/dofs"):
+            continue
+        ratio = results[key]/max(baseline[key], 1e-12)
+        flag  = "slower" if ratio > 1 + tolerance else "faster" if ratio < 1/(1 + tolerance) else ""
+        print("{0:<70} {1:>11.3e} {2:>11.3e} {3:>7.2f} {4}".format(key, baseline[key], results[key], ratio, flag))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Component benchmarks of the forward model and the SMC loop")
+    parser.add_argument("--full", action="store_true", help="run all sweeps instead of the quick ones")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions per component, the median is reported")
+    parser.add_argument("--baseline", default="Benchmarks/baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change reported as slower or faster")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    sweeps  = sweeps_full if args.full else sweeps_quick
+    results = {}
+    for kwargs in configurations(base_forward, sweeps["forward"]):
+        for name, value in benchmark_forward(kwargs, args.repeat).items():
+            results["forward/{0}/{1}".format(label(kwargs), name)] = value
+    for kwargs in configurations(base_smc, sweeps["smc"]):
+        for name, value in benchmark_smc(kwargs, args.repeat).items():
+            results["smc/{0}/{1}".format(label(kwargs), name)] = value
+
+    os.makedirs("Benchmarks", exist_ok=True)
+    output = {"time" : time.strftime("%Y%m%d-%H%M%S"), "machine" : platform.node(), "processor" : platform.processor(),
+              "repeat" : args.repeat, "results" : results}
+    with open("Benchmarks/" + output["time"] + ".json", "w") as file:
+        json.dump(output, file, indent=1, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(output, file, indent=1, sort_keys=True)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            compare(results, json.load(file)["results"], args.tolerance)
+    else:
+        print("No baseline at {0}, store one with --save-baseline".format(args.baseline))
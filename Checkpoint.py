@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import numpy as np
+import os
+
+'''
+Checkpoint store of the Sequential Monte Carlo sampler. Every checkpoint is one uncompressed .npz file in the
+directory of the run: stage_0000.npz, stage_0001.npz, ... for the completed stages and current.npz for the most
+recent state, which is overwritten after every MCMC sweep. Files are written to a temporary name, synced and
+then renamed, so a crash never leaves a partially written checkpoint behind.
+'''
+
+class Checkpoint():
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".npz")
+
+
+    def write(self, name, **arrays):
+        tmp = self.path(name + ".tmp")
+        with open(tmp, "wb") as file:
+            np.savez(file, **arrays)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.path(name)) # Atomic on POSIX and Windows
+
+
+    def read(self, name):
+        with np.load(self.path(name), allow_pickle=False) as file:
+            return {key: file[key] for key in file.files}
+
+
+    def stages(self): # Names of the completed stages in order
+        return sorted(file[:-4] for file in os.listdir(self.directory) if file.startswith("stage_") and file.endswith(".npz") and not file.endswith(".tmp.npz"))
@@ -2,8 +2,9 @@
 
 import numpy as np
 import gmsh
-from dolfinx import io
-from dolfinx.io.gmshio import model_to_mesh
+import hashlib
+import os
+from dolfinx import fem, io
 from mpi4py import MPI
 
 '''
@@ -19,11 +20,39 @@ class Generate_Mesh():
         self.gdim    = kwargs["gdim"]    if "gdim"    in kwargs else 2            # Geometric dimension of the mesh
         self.h       = kwargs["h"]       if "h"       in kwargs else self.r0/2**3 # Characteristic length of mesh elements
         self.quad    = kwargs["quad"]    if "quad"    in kwargs else False        # If False, triangular mesh, if True quadrilateral
+        self.comm    = kwargs["comm"]    if "comm"    in kwargs else MPI.COMM_SELF # Communicator the mesh is distributed over
+
+        # Graded meshes keep h in r0/4 < rho <= R_tilde and coarsen the absorbing layer and the inner core. Their sizes follow the
+        # geometry: at 1 GHz the wavelength is about 30 cm, longer than the whole domain, so it never limits them
+        self.graded  = kwargs["graded"]  if "graded"  in kwargs else False        # If True, coarser elements in the PML R_tilde < rho <= R_PML and in rho <= r0/4
+        n_PML        = kwargs["n_PML"]   if "n_PML"   in kwargs else 8            # Elements across the absorbing layer
+        n_core       = kwargs["n_core"]  if "n_core"  in kwargs else 4            # Elements across the radius r0/4 of the core
+        self.growth  = kwargs["growth"]  if "growth"  in kwargs else 0.3          # Maximal increase of the element size per unit distance
+        self.h_PML   = kwargs["h_PML"]   if "h_PML"   in kwargs else max(self.h, (self.R_PML - self.R_tilde)/n_PML) # Element size at the outer radius of the PML
+        self.h_core  = kwargs["h_core"]  if "h_core"  in kwargs else max(self.h, self.r0/4/n_core)                   # Element size at the centre
+
+        # Cached meshes are keyed by every parameter that changes the geometry or the meshing, as floats so R=7 and R=7.0 share a mesh
+        parameters = (float(self.r0), float(self.R), float(self.R_tilde), float(self.R_PML), int(self.gdim), float(self.h), bool(self.quad))
+        if self.graded:
+            parameters += (float(self.h_PML), float(self.h_core), float(self.growth), "PML_1") # Only the absorbing layer PML_1 is coarsened
+        self.key   = hashlib.sha1(repr(parameters).encode()).hexdigest()[:16]
+        self.path  = "Meshes/Mesh_{0}".format(self.key) # .xdmf with the mesh in .h5, _metadata.npz with the derived data
+        self.default_geometry = (self.r0, self.R, self.R_tilde, self.R_PML, self.gdim) == (1, 7, 7.5, 11, 2) and not self.graded
+
+
+    def cached(self): # File of the cached mesh, None if it has to be generated
+        if os.path.exists(self.path + ".xdmf") and os.path.exists(self.path + ".h5"):
+            return self.path + ".xdmf"
+        legacy = "Meshes/Mesh_h={0:.5f}_quad={1}".format(self.h, self.quad) # Name before the hashed keys, only used for the default geometry
+        if self.default_geometry and os.path.exists(legacy + ".XDMF") and os.path.exists(legacy + ".h5"):
+            return legacy + ".XDMF"
+        return None
 
 
     def __call__(self):
-        try:
-          with io.XDMFFile(MPI.COMM_SELF, "Meshes/Mesh_h={0:.5f}_quad={1}.XDMF".format(self.h,self.quad), "r") as xdmf:
+        cached = self.cached()
+        if cached is not None:
+          with io.XDMFFile(self.comm, cached, "r") as xdmf: # Cells are partitioned over self.comm
             domain = xdmf.read_mesh(name="scatterer")
             ct = xdmf.read_meshtags(domain, name="scatterer_cells")
             domain.topology.create_connectivity(domain.topology.dim, domain.topology.dim - 1)
@@ -31,105 +60,170 @@ class Generate_Mesh():
             return domain, ct, ft
             
         
-        except RuntimeError:
+        else:
           gmsh.initialize()
   
-          # Define geometry of outer domain
-          gmsh.model.occ.addCircle(0, 0, 0, self.R_PML, tag=1)
-          gmsh.model.occ.addCircle(0, 0, 0, self.R_tilde, tag=2)
-          gmsh.model.occ.addCurveLoop([1], tag=1)
-          gmsh.model.occ.addCurveLoop([2], tag=2)
-          PML_1 = gmsh.model.occ.addPlaneSurface([1, 2])
-          gmsh.model.occ.synchronize()
+          if self.comm.rank == 0: # The mesh is generated on one rank and distributed by model_to_mesh
+            # Define geometry of outer domain
+            gmsh.model.occ.addCircle(0, 0, 0, self.R_PML, tag=1)
+            gmsh.model.occ.addCircle(0, 0, 0, self.R_tilde, tag=2)
+            gmsh.model.occ.addCurveLoop([1], tag=1)
+            gmsh.model.occ.addCurveLoop([2], tag=2)
+            PML_1 = gmsh.model.occ.addPlaneSurface([1, 2])
+            gmsh.model.occ.synchronize()
   
-          gmsh.model.occ.addCircle(0, 0, 0, self.R, tag=3)
-          gmsh.model.occ.addCurveLoop([3], tag=3)
-          PML_2 = gmsh.model.occ.addPlaneSurface([2, 3])
-          gmsh.model.occ.synchronize()
+            gmsh.model.occ.addCircle(0, 0, 0, self.R, tag=3)
+            gmsh.model.occ.addCurveLoop([3], tag=3)
+            PML_2 = gmsh.model.occ.addPlaneSurface([2, 3])
+            gmsh.model.occ.synchronize()
   
-          gmsh.model.occ.addCircle(0, 0, 0, self.r0, tag=4)
-          gmsh.model.occ.addCurveLoop([4], tag=4)
-          Medium = gmsh.model.occ.addPlaneSurface([3, 4])
-          gmsh.model.occ.synchronize()
+            gmsh.model.occ.addCircle(0, 0, 0, self.r0, tag=4)
+            gmsh.model.occ.addCurveLoop([4], tag=4)
+            Medium = gmsh.model.occ.addPlaneSurface([3, 4])
+            gmsh.model.occ.synchronize()
   
-          # Define geometry of inner domain
-          gmsh.model.occ.addCircle(0, 0, 0, self.r0/4, tag=5) # Radius at which coordinate transformation starts
-          gmsh.model.occ.addCurveLoop([5], tag=5)
-          Object_1 = gmsh.model.occ.addPlaneSurface([4, 5])
-          gmsh.model.occ.synchronize()
+            # Define geometry of inner domain
+            gmsh.model.occ.addCircle(0, 0, 0, self.r0/4, tag=5) # Radius at which coordinate transformation starts
+            gmsh.model.occ.addCurveLoop([5], tag=5)
+            Object_1 = gmsh.model.occ.addPlaneSurface([4, 5])
+            gmsh.model.occ.synchronize()
   
-          Object_2 = gmsh.model.occ.addDisk(0, 0, 0, self.r0/4, self.r0/4)
-          gmsh.model.occ.synchronize()
+            Object_2 = gmsh.model.occ.addDisk(0, 0, 0, self.r0/4, self.r0/4)
+            gmsh.model.occ.synchronize()
   
-          # Resolve all boundaries
-          whole_domain = gmsh.model.occ.fragment([(self.gdim, Object_1)],[(self.gdim, Object_2),(self.gdim, Medium),(self.gdim, PML_2),(self.gdim, PML_1)])
-          gmsh.model.occ.synchronize()
+            # Resolve all boundaries
+            whole_domain = gmsh.model.occ.fragment([(self.gdim, Object_1)],[(self.gdim, Object_2),(self.gdim, Medium),(self.gdim, PML_2),(self.gdim, PML_1)])
+            gmsh.model.occ.synchronize()
   
-          # We use the following markers for the domains:
-          # PML_1:    1
-          # PML_2:    2
-          # Medium:   3
-          # Object_1: 4
-          # Object_2: 5
+            # We use the following markers for the domains:
+            # PML_1:    1
+            # PML_2:    2
+            # Medium:   3
+            # Object_1: 4
+            # Object_2: 5
   
-          # We use the following markers for the boundaries:
-          # Boundary at R_PML:   6
-          # Boundary at R_tilde: 7
-          # Boundary at R:       8
-          # Boundary at r0:      9
-          # Boundary at r0/4:    10
+            # We use the following markers for the boundaries:
+            # Boundary at R_PML:   6
+            # Boundary at R_tilde: 7
+            # Boundary at R:       8
+            # Boundary at r0:      9
+            # Boundary at r0/4:    10
   
-          visited_boundaries = []
-          for domain in whole_domain[0]:
-              mass = gmsh.model.occ.getMass(domain[0], domain[1])
-              # Identify PML_1, PML_2, Medium, Object_1 and Object_2 by their masses
-              if np.isclose(mass, np.pi*self.R_PML**2 - np.pi*self.R_tilde**2):
-                  gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=1)
-              elif np.isclose(mass, np.pi*self.R_tilde**2 - np.pi*self.R**2):
-                  gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=2)
-              elif np.isclose(mass, np.pi*self.R**2 - np.pi*self.r0**2):
-                  gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=3)
-              elif np.isclose(mass, np.pi*self.r0**2 - np.pi*(self.r0/4)**2):
-                  gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=4)
-              elif np.isclose(mass, np.pi*(self.r0/4)**2):
-                  gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=5)
+            visited_boundaries = []
+            for domain in whole_domain[0]:
+                mass = gmsh.model.occ.getMass(domain[0], domain[1])
+                # Identify PML_1, PML_2, Medium, Object_1 and Object_2 by their masses
+                if np.isclose(mass, np.pi*self.R_PML**2 - np.pi*self.R_tilde**2):
+                    gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=1)
+                elif np.isclose(mass, np.pi*self.R_tilde**2 - np.pi*self.R**2):
+                    gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=2)
+                elif np.isclose(mass, np.pi*self.R**2 - np.pi*self.r0**2):
+                    gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=3)
+                elif np.isclose(mass, np.pi*self.r0**2 - np.pi*(self.r0/4)**2):
+                    gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=4)
+                elif np.isclose(mass, np.pi*(self.r0/4)**2):
+                    gmsh.model.addPhysicalGroup(domain[0], [domain[1]], tag=5)
   
-              boundaries = gmsh.model.getBoundary([domain], oriented=False)
-              for boundary in boundaries:
-                  if boundary not in visited_boundaries:
-                      mass_boundary = gmsh.model.occ.getMass(boundary[0], boundary[1])
-                      if np.isclose(mass_boundary, 2*np.pi*self.R_PML):
-                          gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=6)
-                      elif np.isclose(mass_boundary, 2*np.pi*self.R_tilde):
-                          gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=7)
-                      elif np.isclose(mass_boundary, 2*np.pi*self.R):
-                          gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=8)
-                      elif np.isclose(mass_boundary, 2*np.pi*self.r0):
-                          gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=9)
-                      elif np.isclose(mass_boundary, 2*np.pi*self.r0/4):
-                          gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=10)
-                  visited_boundaries.append(boundary)
+                boundaries = gmsh.model.getBoundary([domain], oriented=False)
+                for boundary in boundaries:
+                    if boundary not in visited_boundaries:
+                        mass_boundary = gmsh.model.occ.getMass(boundary[0], boundary[1])
+                        if np.isclose(mass_boundary, 2*np.pi*self.R_PML):
+                            gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=6)
+                        elif np.isclose(mass_boundary, 2*np.pi*self.R_tilde):
+                            gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=7)
+                        elif np.isclose(mass_boundary, 2*np.pi*self.R):
+                            gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=8)
+                        elif np.isclose(mass_boundary, 2*np.pi*self.r0):
+                            gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=9)
+                        elif np.isclose(mass_boundary, 2*np.pi*self.r0/4):
+                            gmsh.model.addPhysicalGroup(boundary[0], [boundary[1]], tag=10)
+                    visited_boundaries.append(boundary)
   
-          # Set characteristic length of mesh elements
-          gmsh.option.setNumber("Mesh.CharacteristicLengthMin", self.h)
-          gmsh.option.setNumber("Mesh.CharacteristicLengthMax", self.h)
-          if self.quad == True:
-              gmsh.option.setNumber('Mesh.RecombineAll', 1)
+            # Set characteristic length of mesh elements
+            gmsh.option.setNumber("Mesh.CharacteristicLengthMin", self.h)
+            gmsh.option.setNumber("Mesh.CharacteristicLengthMax", max(self.h_PML, self.h_core) if self.graded else self.h)
+            if self.graded:
+                self.size_fields()
+            if self.quad == True:
+                gmsh.option.setNumber('Mesh.RecombineAll', 1)
   
-          # Generate the mesh
-          gmsh.model.mesh.generate(self.gdim)
+            # Generate the mesh
+            gmsh.model.mesh.generate(self.gdim)
   
           # Create dolfinx mesh saving cell and facet tags
-          domain, ct, ft = io.gmshio.model_to_mesh(gmsh.model, MPI.COMM_WORLD, 0, gdim=self.gdim)
+          domain, ct, ft = io.gmshio.model_to_mesh(gmsh.model, self.comm, 0, gdim=self.gdim)
           gmsh.finalize()
           
           domain.name = "scatterer"
           ct.name = f"{domain.name}_cells"
           ft.name = f"{domain.name}_facets"
-          with io.XDMFFile(MPI.COMM_SELF, "Meshes/Mesh_h={0:.5f}_quad={1}.XDMF".format(self.h,self.quad), "w") as xdmf:
+          if self.comm.rank == 0:
+            os.makedirs("Meshes", exist_ok=True)
+          self.comm.barrier()
+          with io.XDMFFile(self.comm, self.path + ".xdmf", "w") as xdmf:
             domain.topology.create_connectivity(domain.topology.dim, domain.topology.dim - 1)
             xdmf.write_mesh(domain)
             xdmf.write_meshtags(ct, geometry_xpath=f"/Xdmf/Domain/Grid[@Name='{domain.name}']/Geometry")
             xdmf.write_meshtags(ft, geometry_xpath=f"/Xdmf/Domain/Grid[@Name='{domain.name}']/Geometry")    
-            
-        return domain, ct, ft
+          return self() # Read back, so the cached metadata matches the numbering of every later load
+
+
+    def size_fields(self): # Background size field from the physical tags, h grows linearly from R_tilde into the PML and from r0/4 into the core
+        field = gmsh.model.mesh.field
+        surfaces = lambda *tags: [entity for tag in tags for entity in gmsh.model.getEntitiesForPhysicalGroup(2, tag)]
+        curves   = lambda tag: list(gmsh.model.getEntitiesForPhysicalGroup(1, tag))
+
+        restricted = []
+        for curve_tag, surface_tags, h_max in [(7, (1,), self.h_PML), (10, (5,), self.h_core)]: # From R_tilde into the PML, from r0/4 into the core
+            distance = field.add("Distance")
+            field.setNumbers(distance, "CurvesList", curves(curve_tag))
+            threshold = field.add("Threshold")
+            field.setNumber(threshold, "InField", distance)
+            field.setNumber(threshold, "SizeMin", self.h)
+            field.setNumber(threshold, "SizeMax", h_max)
+            field.setNumber(threshold, "DistMin", 0)
+            field.setNumber(threshold, "DistMax", max((h_max - self.h)/self.growth, 1e-12))
+            restrict = field.add("Restrict")
+            field.setNumber(restrict, "InField", threshold)
+            field.setNumbers(restrict, "SurfacesList", surfaces(*surface_tags))
+            restricted.append(restrict)
+
+        constant = field.add("MathEval") # PML_2, Medium and Object_1, where the wave and the mapping are resolved
+        field.setString(constant, "F", repr(float(self.h)))
+        restrict = field.add("Restrict")
+        field.setNumber(restrict, "InField", constant)
+        field.setNumbers(restrict, "SurfacesList", surfaces(2, 3, 4))
+        restricted.append(restrict)
+
+        minimum = field.add("Min")
+        field.setNumbers(minimum, "FieldsList", restricted)
+        field.setAsBackgroundMesh(minimum)
+        gmsh.option.setNumber("Mesh.MeshSizeExtendFromBoundary", 0)
+        gmsh.option.setNumber("Mesh.MeshSizeFromPoints", 0)
+        gmsh.option.setNumber("Mesh.MeshSizeFromCurvature", 0)
+
+
+    def stamp(self): # Modification time and size of the mesh file, so metadata of a regenerated mesh is not reused
+        status = os.stat(os.path.splitext(self.cached())[0] + ".h5")
+        return np.array([status.st_mtime_ns, status.st_size])
+
+
+    def metadata(self, V, Q, ct, ft): # Derived data of the CG1 and DG0 spaces, one bulk read once computed
+        path = self.path + "_metadata.npz"
+        if self.comm.size == 1 and os.path.exists(path):
+            with np.load(path) as file:
+                if "stamp" in file.files and np.array_equal(file["stamp"], self.stamp()):
+                    return {key: file[key] for key in file.files if key != "stamp"}
+
+        data = {"dof_coordinates" : V.tabulate_dof_coordinates(), "points" : Q.tabulate_dof_coordinates(), # DG0 evaluation points are the cell midpoints
+                "boundary_dofs_6" : fem.locate_dofs_topological(V, self.gdim-1, ft.find(6)),
+                "boundary_dofs_8" : fem.locate_dofs_topological(V, self.gdim-1, ft.find(8))}
+        for tag in np.unique(ct.values):
+            data["cells_{0}".format(tag)] = ct.find(tag)
+        if self.comm.size == 1: # Local numbering depends on the partition, so only serial meshes are cached
+            tmp = "{0}.{1}.tmp".format(path, os.getpid()) # One per process, concurrent builds do not write into each other's files
+            with open(tmp, "wb") as file:
+                np.savez(file, stamp=self.stamp(), **data)
+            os.replace(tmp, path)
+        return data
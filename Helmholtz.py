@@ -2,6 +2,10 @@
 
 import numpy as np
 import ufl
+import time
+from scipy import sparse
+from scipy.spatial import cKDTree
+from functools import lru_cache
 from scipy.special import zeta
 from scipy.optimize import fsolve
 from dolfinx import fem, geometry
@@ -14,7 +18,7 @@ This code is made for DOLFINx version 0.5.1.
 
 freq = 2*10**9
 kwargs_data = {"freq" : freq, "h" : 0.5*np.sqrt((1/2**3)**2 * (10**9/(2*10**9))**3), "quad" : True, "char_len" : True, "s" : 0.2, "K" : 100, "data" : True}
-kwargs_inv = {"freq" : freq, "h" : np.sqrt((1/2**3)**2 * (10**9/freq)**3), "char_len" : True, "s" : 0.2, "K" : 100, "M" : 1000, "data" : False}
+kwargs_inv = {"freq" : freq, "h" : np.sqrt((1/2**3)**2 * (10**9/freq)**3), "char_len" : True, "s" : 0.2, "K" : 100, "M" : 1000, "data" : False, "assembly" : "operator"}
 
 def u_i(kappa_0, n_out, alpha_out, dir, x): # Amplitude of incoming wave
     return np.e**(complex(0,1)*kappa_0*np.sqrt(n_out/alpha_out)*(dir[0]*x[0] + dir[1]*x[1]))
@@ -143,15 +147,19 @@ def kappa_sqrd_trans(R, r0, char_len, s, epsilon, J, sum, Y, x):
     return Jac00*Jac11 - Jac01*Jac10
 
 
+def interpolate_mapping(R, r0, char_len, s, epsilon, J, sum, Y, alpha_hat00, alpha_hat01, alpha_hat11, kappa_sqrd_hat): # Coordinate mapping into existing DG0 functions
+    points = alpha_hat00.function_space.tabulate_dof_coordinates()[:, 0:2].T
+    values = Coordinate_Mapping(R, r0, char_len, s, epsilon, J, sum, points)(Y)
+    for function, value in zip([alpha_hat00, alpha_hat01, alpha_hat11, kappa_sqrd_hat], values):
+        function.x.array[:] = value
+
+
 def build_mapping(R, r0, char_len, s, epsilon, J, sum, Q, Y): # Coordinate mapping
     alpha_hat00    = fem.Function(Q)
     alpha_hat01    = fem.Function(Q)
     alpha_hat11    = fem.Function(Q)
     kappa_sqrd_hat = fem.Function(Q)
-    alpha_hat00.interpolate(lambda x: alpha_hatxx(R, r0, char_len, s, epsilon, J, sum, Y, x))
-    alpha_hat01.interpolate(lambda x: alpha_hatxy(R, r0, char_len, s, epsilon, J, sum, Y, x))
-    alpha_hat11.interpolate(lambda x: alpha_hatyy(R, r0, char_len, s, epsilon, J, sum, Y, x))
-    kappa_sqrd_hat.interpolate(lambda x: kappa_sqrd_trans(R, r0, char_len, s, epsilon, J, sum, Y, x))
+    interpolate_mapping(R, r0, char_len, s, epsilon, J, sum, Y, alpha_hat00, alpha_hat01, alpha_hat11, kappa_sqrd_hat)
     return ufl.as_matrix([[alpha_hat00,alpha_hat01], [alpha_hat01, alpha_hat11]]), kappa_sqrd_hat
 
 
@@ -167,187 +175,624 @@ def Phi_inv(R, r0, char_len, s, epsilon, J, sum, Y, x):
     return np.array([rho_hat*np.cos(phi), rho_hat*np.sin(phi)])
 
 
-def get_J(**kwargs):
-    epsilon  = kwargs["epsilon"]  if "epsilon"  in kwargs else 0.001 # Small number greater than zero for convergence of radius expansion
-    char_len = kwargs["char_len"] if "char_len" in kwargs else False # Determines type of expansion
-    s        = kwargs["s"]        if "s"        in kwargs else 0.001 # Scaled version of correlation length
-    
+def der_Phi_inv(R, r0, char_len, s, epsilon, J, sum, Y, x, weights): # Gradient with respect to Y of sum_k weights[:, k].Phi_inv(Y, x[:, k])
+    rho, phi = np.sqrt(x[0]**2 + x[1]**2), np.arctan2(x[1], x[0])
+    rad_phys = r0 + radial(r0, char_len, s, epsilon, J, sum, Y, phi)
+
+    der_rho_hat  = (r0/4 < rho)   * (rho <= rad_phys) * 3*r0*(r0 - 4*rho)/(4*rad_phys - r0)**2 # d(rho_hat)/d(rad_phys)
+    der_rho_hat += (rad_phys < rho) * (rho <= R)      * (R - r0)*(rho - R)/(R - rad_phys)**2
+    weight = (weights[0]*np.cos(phi) + weights[1]*np.sin(phi))*der_rho_hat
+
+    j = np.arange(1, J+1)
     if char_len == True:
-        sum = np.sum(np.array([1/(1 + s*k**(2 + epsilon)) for k in range(1, 1000000)]))
-
-        var_sum = np.sum(np.array([1/((1 + s*k**(2 + epsilon))**2) for k in range(1, 1000000)]))
-        sum_j, j = 0, 0
-        while sum_j < 0.95*var_sum:
-            j += 1
-            sum_j += 1/((1 + s*j**(2 + epsilon))**2)
-        J = j
-        
+        c = r0/(4*sum*(1 + s*j**(2 + epsilon)))
     else:
-        sum = zeta(2 + epsilon)
-        var_sum = zeta(2*(2 + epsilon))
-        sum_j, j = 0, 0
-        while sum_j < 0.95*var_sum:
-            j += 1
-            sum_j += 1/(j**(2*(2 + epsilon)))
-        J = j
-    return J
-    
-
+        c = r0/(4*sum*j**(2 + epsilon))
+    gradient = np.zeros(2*J)
+    gradient[0::2] = c*(np.cos(np.outer(j, phi)) @ weight)
+    gradient[1::2] = c*(np.sin(np.outer(j, phi)) @ weight)
+    return gradient
+
+
+class Coordinate_Mapping(): # Fused evaluation of the mapping coefficients at fixed points x
+    def __init__(self, R, r0, char_len, s, epsilon, J, sum, x):
+        self.key     = (R, r0, char_len, s, epsilon, J, sum)
+        self.npoints = x.shape[1]
+
+        rho, phi    = np.sqrt(x[0]**2 + x[1]**2), np.arctan2(x[1], x[0])
+        inner       = (r0/4 < rho)*(rho <= r0) # Region of mollifier_1
+        self.active = np.nonzero(inner + (r0 < rho)*(rho <= R))[0] # Outside the Jacobian is the identity
+        x, rho, phi, inner = x[:, self.active], rho[self.active], phi[self.active], inner[self.active]
+
+        # Basis of the radius and of its angular derivative, so both follow from one product with Y
+        j = np.arange(1, J+1)
+        if char_len == True:
+            weights = r0/(4*sum*(1 + s*j**(2 + epsilon)))
+        else:
+            weights = r0/(4*sum*j**(2 + epsilon))
+        cos_phi, sin_phi = np.cos(np.outer(phi, j))*weights, np.sin(np.outer(phi, j))*weights
+        self.basis = np.zeros((2*len(self.active), 2*J))
+        self.basis[:len(self.active), 0::2] = cos_phi
+        self.basis[:len(self.active), 1::2] = sin_phi
+        self.basis[len(self.active):, 0::2] = sin_phi*j
+        self.basis[len(self.active):, 1::2] = -cos_phi*j
+
+        # Jac_ab = delta_ab + radial_Y*P_ab + der_radial_Y*Q_ab, with the mollifier m and its slope g per region
+        m = np.where(inner, mollifier_1(r0, rho), mollifier_2(R, r0, rho))
+        g = np.where(inner, 4/(3*r0), -1/(R - r0))
+        t = np.array([x[1], -x[0]])/rho**2 # d(phi)/dx and d(phi)/dy
+        self.P = np.array([[g*x[a]*x[b]/rho**2 + m*((a == b)*rho**2 - x[a]*x[b])/rho**3 for b in range(2)] for a in range(2)])
+        self.Q = np.array([[m*x[a]/rho*t[b] for b in range(2)] for a in range(2)])
+
+
+    def __call__(self, Y): # Y of shape (2J,) or (2J, M), returns alpha_hat00, alpha_hat01, alpha_hat11, kappa_sqrd_hat
+        radial_der = self.basis @ Y
+        radial_Y, der_radial_Y = radial_der[:len(self.active)], radial_der[len(self.active):]
+        if np.ndim(Y) == 2:
+            P, Q = self.P[..., None], self.Q[..., None]
+        else:
+            P, Q = self.P, self.Q
+        Jac00 = 1 + radial_Y*P[0,0] + der_radial_Y*Q[0,0]
+        Jac01 =     radial_Y*P[0,1] + der_radial_Y*Q[0,1]
+        Jac10 =     radial_Y*P[1,0] + der_radial_Y*Q[1,0]
+        Jac11 = 1 + radial_Y*P[1,1] + der_radial_Y*Q[1,1]
+        det   = Jac00*Jac11 - Jac01*Jac10
+
+        shape = (self.npoints,) + np.shape(Y)[1:]
+        alpha_hat00, alpha_hat01, alpha_hat11, kappa_sqrd_hat = np.ones(shape), np.zeros(shape), np.ones(shape), np.ones(shape)
+        alpha_hat00[self.active]    = (Jac01**2 + Jac11**2)/det
+        alpha_hat01[self.active]    = -(Jac00*Jac01 + Jac10*Jac11)/det
+        alpha_hat11[self.active]    = (Jac00**2 + Jac10**2)/det
+        kappa_sqrd_hat[self.active] = det
+        return alpha_hat00, alpha_hat01, alpha_hat11, kappa_sqrd_hat
+
+
+    def gradient(self, Y, g00, g01, g11, g_kappa): # Gradient with respect to Y of the sum over the points of g00*alpha_hat00 + g01*alpha_hat01 + g11*alpha_hat11 + g_kappa*kappa_sqrd_hat
+        radial_der = self.basis @ Y
+        radial_Y, der_radial_Y = radial_der[:len(self.active)], radial_der[len(self.active):]
+        Jac00 = 1 + radial_Y*self.P[0,0] + der_radial_Y*self.Q[0,0]
+        Jac01 =     radial_Y*self.P[0,1] + der_radial_Y*self.Q[0,1]
+        Jac10 =     radial_Y*self.P[1,0] + der_radial_Y*self.Q[1,0]
+        Jac11 = 1 + radial_Y*self.P[1,1] + der_radial_Y*self.Q[1,1]
+        det   = Jac00*Jac11 - Jac01*Jac10
+        g00, g01, g11, g_kappa = g00[self.active], g01[self.active], g11[self.active], g_kappa[self.active]
+
+        # Reverse mode through alpha_hat = N/det and kappa_sqrd_hat = det to the entries of the Jacobian
+        g_det = g_kappa - (g00*(Jac01**2 + Jac11**2) - g01*(Jac00*Jac01 + Jac10*Jac11) + g11*(Jac00**2 + Jac10**2))/det**2
+        g_Jac = np.array([[(-g01*Jac01 + 2*g11*Jac00)/det + g_det*Jac11, (2*g00*Jac01 - g01*Jac00)/det - g_det*Jac10],
+                          [(-g01*Jac11 + 2*g11*Jac10)/det - g_det*Jac01, (2*g00*Jac11 - g01*Jac10)/det + g_det*Jac00]])
+        g_radial     = np.sum(g_Jac*self.P, axis=(0, 1))
+        g_der_radial = np.sum(g_Jac*self.Q, axis=(0, 1))
+        return self.basis.T @ np.concatenate([g_radial, g_der_radial])
+
+
+def color_cells(cell_dofs): # Greedy colouring such that cells of one colour share no degree of freedom
+    masks  = np.zeros(cell_dofs.max() + 1, dtype=np.int64) # Bit mask of the colours at every dof
+    colors = np.zeros(len(cell_dofs), dtype=int)
+    for cell, dofs in enumerate(cell_dofs):
+        used  = np.bitwise_or.reduce(masks[dofs])
+        color = 0
+        while (used >> color) & 1:
+            color += 1
+        colors[cell] = color
+        masks[dofs] |= 1 << color
+    return colors
+
+
+class Coefficient_Operator(): # Sparse linear map from DG0 coefficients to the CSR values of the matrix of a form linear in them
+    def __init__(self, form, A, V, Q, coefficients, bcs):
+        self.form, self.bcs, self.coefficients = form, bcs, coefficients
+        cell_dofs = V.dofmap.list.array.reshape(-1, V.dofmap.dof_layout.num_dofs)
+        q_dofs    = Q.dofmap.list.array
+        colors    = color_cells(cell_dofs)
+
+        for coefficient in coefficients:
+            coefficient.x.array[:] = 0
+        self.indptr, self.indices, self.constant = self.probe(A) # Only the diagonal of the boundary condition rows
+        rows = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+
+        # Probing with the indicator of one colour gives every entry (i, j) from at most one cell, the one owning dof i
+        entries, columns, values = [], [], []
+        for k, coefficient in enumerate(coefficients):
+            for color in range(colors.max() + 1):
+                cells = np.flatnonzero(colors == color)
+                coefficient.x.array[:] = 0
+                coefficient.x.array[q_dofs[cells]] = 1
+                probe = self.probe(A)[2] - self.constant
+                owner = np.full(V.dofmap.index_map.size_local + V.dofmap.index_map.num_ghosts, -1)
+                owner[cell_dofs[cells]] = q_dofs[cells][:, None]
+                nonzero = np.flatnonzero(probe)
+                entries.append(nonzero)
+                columns.append(k*len(q_dofs) + owner[rows[nonzero]])
+                values.append(probe[nonzero])
+            coefficient.x.array[:] = 0
+        self.G = sparse.csr_matrix((np.concatenate(values), (np.concatenate(entries), np.concatenate(columns))), shape=(len(self.indices), len(coefficients)*len(q_dofs)))
+
+
+    def probe(self, A):
+        A.zeroEntries()
+        fem.petsc.assemble_matrix(A, self.form, bcs=self.bcs)
+        A.assemble()
+        return A.getValuesCSR()
+
+
+    def values(self, coefficient_values): # One sparse mat-vec per particle
+        return self.G @ np.concatenate(coefficient_values) + self.constant
+
+
+    def insert(self, A, values):
+        A.setValuesCSR(self.indptr, self.indices, values)
+        A.assemble()
+
+
+class Forward_Solver(): # Persistent system matrix and LU or preconditioned GMRES solver for one discretization
+    def __init__(self, V, Q, alpha, kappa_sqrd, A_matrix, dd_bar, bc, bs, points=None, **kwargs):
+        self.method   = kwargs["solver"]      if "solver"      in kwargs else "lu"    # "lu" or "gmres" with a shifted-Laplacian preconditioner
+        solver_type   = kwargs["solver_type"] if "solver_type" in kwargs else None    # LU package, for example "mumps" or "superlu_dist", None for mumps on more than one rank
+        shift         = kwargs["shift"]       if "shift"       in kwargs else 1-0.5j  # Complex shift of the wave number squared in the preconditioner
+        pc_type       = kwargs["pc_type"]     if "pc_type"     in kwargs else "gamg"  # Approximate inverse of the shifted operator, "lu" for an exact one
+        rtol          = kwargs["rtol"]        if "rtol"        in kwargs else 1e-8    # Relative tolerance of GMRES
+        self.rebuild  = kwargs["rebuild"]     if "rebuild"     in kwargs else 1.5     # Preconditioner is rebuilt once the iterations grow by this factor
+        assembly      = kwargs["assembly"]    if "assembly"    in kwargs else "form"  # "operator" maps the coefficients to the matrix values directly, for the many solves of the inversion
+        self.shift    = shift
+        self.bs  = bs # One right-hand side per incident direction
+        self.bcs = [bc]
+
+        self.points  = (points if points is not None else Q.tabulate_dof_coordinates())[:, 0:2].T # DG0 evaluation points (cell midpoints)
+        self.mapping = None
+
+        # Coefficients of the coordinate mapping, updated in place per Y
+        self.alpha_hat00    = fem.Function(Q)
+        self.alpha_hat01    = fem.Function(Q)
+        self.alpha_hat11    = fem.Function(Q)
+        self.kappa_sqrd_hat = fem.Function(Q)
+        alpha_hat = ufl.as_matrix([[self.alpha_hat00, self.alpha_hat01], [self.alpha_hat01, self.alpha_hat11]])
+
+        u = ufl.TrialFunction(V)
+        v = ufl.TestFunction(V)
+        a = ufl.inner(alpha*alpha_hat*A_matrix*ufl.grad(u), ufl.grad(v))*ufl.dx - ufl.inner(kappa_sqrd*self.kappa_sqrd_hat*dd_bar*u, v)*ufl.dx
+        self.bilinear_form = fem.form(a)
+        self.A = fem.petsc.create_matrix(self.bilinear_form) # Sparsity pattern is allocated once
+
+        # Derivatives of lam^T A u with respect to the four DG0 coefficients, tested with DG0 functions. u and lam
+        # enter without conjugation, so the transposed (not the Hermitian) adjoint is needed. Compiled on first use
+        self.state, self.adjoint_state = fem.Function(V), fem.Function(V)
+        q, lam = ufl.TestFunction(Q), ufl.conj(self.adjoint_state)
+        self.gradient_ufl = [ufl.inner(ufl.inner(alpha*ufl.as_matrix(E)*A_matrix*ufl.grad(self.state), ufl.grad(lam)), q)*ufl.dx for E in [[[1, 0], [0, 0]], [[0, 1], [1, 0]], [[0, 0], [0, 1]]]]
+        self.gradient_ufl.append(-ufl.inner(kappa_sqrd*dd_bar*self.state*self.adjoint_state, q)*ufl.dx)
+        self.gradient_forms = None
+        self.n_coefficients = len(self.points.T)
+
+        # The form is linear in the four DG0 coefficients, so the values of A are G @ coefficients plus the boundary
+        # condition diagonal. G is built once from a few probing assemblies. Only for serial meshes, since on
+        # several ranks rows receive contributions from cells of other ranks. The cell colouring is a Python loop
+        # over all cells and G is several times larger than A, so it only pays off for the many solves of the inversion
+        self.operator = None
+        if assembly == "operator" and V.mesh.comm.size == 1:
+            self.operator = Coefficient_Operator(self.bilinear_form, self.A, V, Q, [self.alpha_hat00, self.alpha_hat01, self.alpha_hat11, self.kappa_sqrd_hat], self.bcs)
+
+        self.solver = PETSc.KSP().create(V.mesh.comm)
+        self.solver.setOptionsPrefix("helmholtz_") # Command line options such as -helmholtz_ksp_rtol override the settings below
+        if self.method == "lu":
+            # The operator is set once: since the nonzero pattern of A never changes, PETSc keeps the
+            # symbolic factorization and ordering and only redoes the numeric factorization per solve
+            self.solver.setType(PETSc.KSP.Type.PREONLY)
+            self.solver.getPC().setType(PETSc.PC.Type.LU)
+            if solver_type is None and V.mesh.comm.size > 1: # PETSc's own LU is sequential
+                solver_type = "mumps"
+            if solver_type is not None:
+                self.solver.getPC().setFactorSolverType(solver_type)
+            self.solver.setOperators(self.A)
+        else:
+            # Same operator with kappa^2 replaced by shift*kappa^2. The damping makes it cheap to invert approximately
+            # and it is kept over consecutive solves, since proposals only change the mapping coefficients slightly
+            p = ufl.inner(alpha*alpha_hat*A_matrix*ufl.grad(u), ufl.grad(v))*ufl.dx - shift*ufl.inner(kappa_sqrd*self.kappa_sqrd_hat*dd_bar*u, v)*ufl.dx
+            self.preconditioner_form = fem.form(p)
+            self.P = fem.petsc.create_matrix(self.preconditioner_form)
+            self.solver.setType(PETSc.KSP.Type.GMRES)
+            self.solver.setTolerances(rtol=rtol)
+            self.solver.setInitialGuessNonzero(True) # Warm start from the solution of the previous proposal
+            self.solver.getPC().setType(pc_type)
+            self.solver.setOperators(self.A, self.P)
+            self.solver.getPC().setReusePreconditioner(True)
+        self.solver.setFromOptions()
+
+        self.n_solves, self.iterations, self.n_setups, self.n_adjoints = 0, 0, 0, 0 # Statistics for comparing the solvers
+        self.assembly_time, self.setup_time, self.solve_time, self.adjoint_time = 0.0, 0.0, 0.0, 0.0
+        self.reference_its = None # Iterations right after the last preconditioner setup
+
+
+    def get_mapping(self, R, r0, char_len, s, epsilon, J, sum):
+        if self.mapping is None or self.mapping.key != (R, r0, char_len, s, epsilon, J, sum): # Basis is built once per set of parameters
+            self.mapping = Coordinate_Mapping(R, r0, char_len, s, epsilon, J, sum, self.points)
+        return self.mapping
+
+
+    def set_coefficients(self, alpha_hat00, alpha_hat01, alpha_hat11, kappa_sqrd_hat):
+        self.alpha_hat00.x.array[:]    = alpha_hat00
+        self.alpha_hat01.x.array[:]    = alpha_hat01
+        self.alpha_hat11.x.array[:]    = alpha_hat11
+        self.kappa_sqrd_hat.x.array[:] = kappa_sqrd_hat
+
+
+    def coefficient_values(self):
+        return [self.alpha_hat00.x.array, self.alpha_hat01.x.array, self.alpha_hat11.x.array, self.kappa_sqrd_hat.x.array]
+
+
+    def update(self, R, r0, char_len, s, epsilon, J, sum, Y):
+        self.set_coefficients(*self.get_mapping(R, r0, char_len, s, epsilon, J, sum)(Y))
+
+
+    def setup_preconditioner(self):
+        start = time.perf_counter()
+        if self.operator is not None: # The shift only scales the kappa_sqrd_hat part, the sparsity pattern is the same
+            self.operator.insert(self.P, self.operator.values(self.coefficient_values()[:3] + [self.shift*self.kappa_sqrd_hat.x.array]))
+        else:
+            self.P.zeroEntries()
+            fem.petsc.assemble_matrix(self.P, self.preconditioner_form, bcs=self.bcs)
+            self.P.assemble()
+        self.solver.getPC().setReusePreconditioner(False)
+        self.solver.setUp()
+        self.solver.getPC().setReusePreconditioner(True)
+        self.n_setups     += 1
+        self.reference_its = None
+        self.setup_time   += time.perf_counter() - start
+
+
+    def solve(self, uhs): # One solution per right-hand side, all against the same operator
+        start = time.perf_counter()
+        if self.operator is not None:
+            self.operator.insert(self.A, self.operator.values(self.coefficient_values()))
+        else:
+            self.A.zeroEntries()
+            fem.petsc.assemble_matrix(self.A, self.bilinear_form, bcs=self.bcs)
+            self.A.assemble()
+        self.assembly_time += time.perf_counter() - start
+        if self.method != "lu" and (self.n_setups == 0 or (self.reference_its is not None and self.solver.getIterationNumber() > self.rebuild*self.reference_its)):
+            self.setup_preconditioner() # The kept preconditioner no longer fits the current proposals
+
+        for b, uh in zip(self.bs, uhs): # LU factorizes on the first right-hand side only, since A is unchanged in between
+            start = time.perf_counter()
+            self.solver.solve(b, uh.vector)
+            uh.x.scatter_forward()
+            self.solve_time += time.perf_counter() - start
+            self.n_solves   += 1
+            self.iterations += self.solver.getIterationNumber()
+            if self.reference_its is None:
+                self.reference_its = max(self.solver.getIterationNumber(), 1)
+
+
+    def adjoint(self, rhs, uh): # Solves A^T lam = rhs with the operator of the last solve, returns -Re(d(lam^T A uh)/d(coefficients)) per DG0 dof
+        start = time.perf_counter()
+        if self.gradient_forms is None:
+            self.gradient_forms = [fem.form(form) for form in self.gradient_ufl]
+        fem.petsc.set_bc(rhs, self.bcs) # lam vanishes on the Dirichlet boundary like uh
+        self.solver.solveTranspose(rhs, self.adjoint_state.vector) # LU reuses the factorization, GMRES the preconditioner
+        self.adjoint_state.x.scatter_forward()
+        self.state.x.array[:] = uh.x.array
+
+        gradients = []
+        for form in self.gradient_forms:
+            vector = fem.petsc.assemble_vector(form)
+            vector.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE)
+            gradient = np.zeros(self.n_coefficients) # Ghost cells are counted by their owners
+            gradient[:len(vector.array)] = -np.real(vector.array)
+            gradients.append(gradient)
+        self.n_adjoints   += 1
+        self.adjoint_time += time.perf_counter() - start
+        return gradients
+
+
+    def statistics(self): # Averages per solve, to compare LU and GMRES per frequency
+        n = max(self.n_solves, 1)
+        return {"solver" : self.method, "solves" : self.n_solves, "iterations" : self.iterations/n, "setups" : self.n_setups,
+                "assembly_time" : self.assembly_time/n, "setup_time" : self.setup_time/n, "solve_time" : self.solve_time/n,
+                "adjoints" : self.n_adjoints, "adjoint_time" : self.adjoint_time/max(self.n_adjoints, 1)}
+
+
+class Observation_Operator(): # Smoothed point measurements, the form is compiled once per discretization
+    def __init__(self, V, Q, kappa_0, n_out, alpha_out, dir, sigma_smooth, mode="truncated", radius=None, mass_operator=None, dof_coords=None, chunk_size=10**7, operator=False):
+        self.comm         = V.mesh.comm
+        self.mesh         = V.mesh
+        self.sigma_smooth = sigma_smooth
+        self.mode         = mode # "full", "truncated" (kernels cut off at radius) or "pointwise"
+        self.radius       = radius if radius is not None else 5*sigma_smooth # The kernel has decayed to 4e-6 of its peak at 5 sigma
+        self.chunk_size   = chunk_size # Maximal number of entries of one block of the K x ndofs kernel matrix
+        self.n_local      = V.dofmap.index_map.size_local
+        self.dof_coords   = (dof_coords if dof_coords is not None else V.tabulate_dof_coordinates())[:self.n_local, 0:2] # Owned degrees of freedom only
+        self.q_dofs       = Q.dofmap.list.array # DG0 dof of every cell
+
+        self.uh             = fem.Function(V) # Solution of the forward problem, written by the solver
+        self.ui             = fem.Function(V) # Incoming wave, independent of Y
+        self.kappa_sqrd_hat = fem.Function(Q) # Weight from the coordinate mapping, updated per Y
+        self.ui.interpolate(lambda x: u_i(kappa_0, n_out, alpha_out, dir, x))
+        self.z              = fem.Function(V) # sum_k residual_k*kernel_k for the adjoint, real valued
+        self.V, self.Q      = V, Q
+        self.adjoint_forms  = None
+
+        # The smoothing kernels are interpolated in V, so every measurement is the kernel values at the dofs
+        # contracted with this vector. One assembly then gives all K measurements.
+        self.form   = fem.form(ufl.inner(self.uh - self.ui, self.kappa_sqrd_hat*ufl.TestFunction(V))*ufl.dx)
+        self.vector = fem.petsc.create_vector(self.form)
+
+        if self.mode == "truncated":
+            self.dof_tree = cKDTree(self.dof_coords) # Spatial index of the owned dofs
+            # The vector is W(kappa_sqrd_hat) @ (uh - ui) with W linear in the DG0 weight, so on a serial mesh only
+            # the rows near the measurement points are formed, instead of assembling over the whole mesh. Building
+            # the operator costs a cell colouring and memory like assembly="operator", so it is built only with it
+            self.mass_operator = mass_operator
+            if self.mass_operator is None and operator and self.comm.size == 1:
+                mass = fem.form(ufl.inner(ufl.TrialFunction(V), self.kappa_sqrd_hat*ufl.TestFunction(V))*ufl.dx)
+                self.mass_operator = Coefficient_Operator(mass, fem.petsc.create_matrix(mass), V, Q, [self.kappa_sqrd_hat], [])
+        elif self.mode == "pointwise":
+            self.cell_tree = geometry.BoundingBoxTree(self.mesh, self.mesh.topology.dim)
+
+
+    def kernels(self, ref_measurement_points): # Values of the Gaussian kernels at the owned dofs, shape (K, ndofs)
+        dist_sqrd = (self.dof_coords[:,0][None,:] - ref_measurement_points[0][:,None])**2 + (self.dof_coords[:,1][None,:] - ref_measurement_points[1][:,None])**2
+        return 1/(2*np.pi*self.sigma_smooth**2)*np.exp(-dist_sqrd/(2*self.sigma_smooth**2))
+
+
+    def assemble(self):
+        with self.vector.localForm() as loc:
+            loc.set(0)
+        fem.petsc.assemble_vector(self.vector, self.form)
+        self.vector.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE)
+        return self.vector.array
+
+
+    def local_rows(self, rows): # Rows of the weighted vector from the entries of W in these rows only
+        op       = self.mass_operator
+        starts   = op.indptr[rows]
+        counts   = op.indptr[rows + 1] - starts
+        entries  = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+        products = (op.G[entries] @ self.kappa_sqrd_hat.x.array)*(self.uh.x.array - self.ui.x.array)[op.indices[entries]]
+        return np.add.reduceat(products, np.cumsum(counts) - counts)
+
+
+    def full(self, ref_measurement_points):
+        weighted = self.assemble()
+        K = ref_measurement_points.shape[1]
+        step = max(1, self.chunk_size//max(1, self.n_local))
+        measurement_values_local = np.zeros(K, dtype=PETSc.ScalarType)
+        for k in range(0, K, step): # Blocks of kernels to bound the memory on fine meshes
+            measurement_values_local[k:k+step] = self.kernels(ref_measurement_points[:, k:k+step]) @ weighted
+        return measurement_values_local
+
+
+    def truncated(self, ref_measurement_points): # Only the dofs within radius of a point contribute to its measurement
+        K         = ref_measurement_points.shape[1]
+        neighbors = self.dof_tree.query_ball_point(ref_measurement_points.T, self.radius)
+        points    = np.repeat(np.arange(K), [len(n) for n in neighbors])
+        dofs      = np.concatenate([np.asarray(n, dtype=int) for n in neighbors])
+        if len(dofs) == 0:
+            return np.zeros(K, dtype=PETSc.ScalarType)
+        if self.mass_operator is not None:
+            rows     = np.unique(dofs)
+            weighted = self.local_rows(rows)[np.searchsorted(rows, dofs)]
+        else: # Rows of a distributed mesh also get contributions from other ranks
+            weighted = self.assemble()[dofs]
+        dist_sqrd = np.sum((self.dof_coords[dofs] - ref_measurement_points.T[points])**2, axis=1)
+        values    = 1/(2*np.pi*self.sigma_smooth**2)*np.exp(-dist_sqrd/(2*self.sigma_smooth**2))*weighted
+        return np.bincount(points, np.real(values), minlength=K) + 1j*np.bincount(points, np.imag(values), minlength=K)
+
+
+    def pointwise(self, ref_measurement_points): # Limit sigma_smooth -> 0: (uh - ui)*kappa_sqrd_hat at the points
+        K = ref_measurement_points.shape[1]
+        points = np.zeros((K, 3))
+        points[:, :2] = ref_measurement_points.T
+        colliding = geometry.compute_colliding_cells(self.mesh, geometry.compute_collisions(self.cell_tree, points), points)
+        found = np.array([k for k in range(K) if len(colliding.links(k)) > 0], dtype=int)
+        cells = np.array([colliding.links(k)[0] for k in found], dtype=np.int32)
+        values, counts = np.zeros(K, dtype=PETSc.ScalarType), np.zeros(K)
+        if len(found) > 0:
+            values[found] = (self.uh.eval(points[found], cells) - self.ui.eval(points[found], cells))[:, 0]*self.kappa_sqrd_hat.x.array[self.q_dofs[cells]]
+            counts[found] = 1
+        counts = self.comm.allreduce(counts, op=MPI.SUM) # Points on a shared boundary are found on several ranks
+        return values/np.maximum(counts, 1)
+
+
+    def __call__(self, ref_measurement_points):
+        measurement_values_local = getattr(self, self.mode)(ref_measurement_points)
+        return np.real(self.comm.allreduce(measurement_values_local, op=MPI.SUM))
+
+
+    def adjoint(self, ref_measurement_points, residual): # Sets z and returns d(sum_k residual_k*measurement_k)/d(ref_measurement_points), shape (2, K)
+        if self.mode == "pointwise":
+            raise ValueError("Gradients need smoothed measurements, observation \"full\" or \"truncated\"")
+        K = ref_measurement_points.shape[1]
+        if self.mode == "truncated":
+            neighbors = self.dof_tree.query_ball_point(ref_measurement_points.T, self.radius)
+            points    = np.repeat(np.arange(K), [len(n) for n in neighbors])
+            dofs      = np.concatenate([np.asarray(n, dtype=int) for n in neighbors])
+            if self.mass_operator is not None and len(dofs) > 0:
+                rows     = np.unique(dofs)
+                weighted = self.local_rows(rows)[np.searchsorted(rows, dofs)]
+            else:
+                weighted = self.assemble()[dofs]
+            blocks = [(points, dofs, weighted)]
+        else:
+            weighted = self.assemble()
+            step     = max(1, self.chunk_size//max(1, self.n_local))
+            blocks   = ((np.repeat(np.arange(k, min(k+step, K)), self.n_local), np.tile(np.arange(self.n_local), min(k+step, K) - k), np.tile(weighted, min(k+step, K) - k)) for k in range(0, K, step))
+
+        z, gradient = np.zeros(self.n_local), np.zeros((2, K))
+        for points, dofs, weighted in blocks:
+            diff   = self.dof_coords[dofs] - ref_measurement_points.T[points]
+            kernel = 1/(2*np.pi*self.sigma_smooth**2)*np.exp(-np.sum(diff**2, axis=1)/(2*self.sigma_smooth**2))
+            z     += np.bincount(dofs, residual[points]*kernel, minlength=self.n_local)
+            shift  = residual[points]*np.real(kernel*weighted)/self.sigma_smooth**2 # The kernel moves with its point
+            gradient += np.array([np.bincount(points, shift*diff[:, 0], minlength=K), np.bincount(points, shift*diff[:, 1], minlength=K)])
+        self.z.x.array[:self.n_local] = z
+        self.z.x.scatter_forward()
+        return self.comm.allreduce(gradient, op=MPI.SUM)
+
+
+    def adjoint_rhs(self): # W(kappa_sqrd_hat) z, the derivative of sum_k residual_k*measurement_k with respect to uh
+        if self.adjoint_forms is None:
+            self.adjoint_forms = [fem.form(ufl.inner(self.kappa_sqrd_hat*self.z, ufl.TestFunction(self.V))*ufl.dx),
+                                  fem.form(ufl.inner((self.uh - self.ui)*self.z, ufl.TestFunction(self.Q))*ufl.dx)]
+        rhs = fem.petsc.assemble_vector(self.adjoint_forms[0])
+        rhs.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE)
+        return rhs
+
+
+    def weight_gradient(self): # Derivative of sum_k residual_k*measurement_k with respect to the DG0 weight kappa_sqrd_hat, owned cells
+        vector = fem.petsc.assemble_vector(self.adjoint_forms[1])
+        vector.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE)
+        return np.real(vector.array)
+
+
+@lru_cache(maxsize=None)
+def spectral_constants(s, epsilon, char_len): # Normalisation sum and number of modes J of the radius expansion, computed once per process
+    k = np.arange(1, 1000000, dtype=float)
+    if char_len == True:
+        terms     = 1/(1 + s*k**(2 + epsilon))
+        sum       = np.sum(terms)
+        var_terms = terms**2
+        var_sum   = np.sum(var_terms)
+    else:
+        sum       = zeta(2 + epsilon)
+        var_terms = 1/(k**(2*(2 + epsilon)))
+        var_sum   = zeta(2*(2 + epsilon))
+    J = int(np.searchsorted(np.cumsum(var_terms), 0.95*var_sum)) + 1 # Smallest J capturing 95% of the variance
+    return sum, J
 
 
-alpha_in  = kwargs_data["alpha_in"]  if "alpha_in"  in kwargs_data else 1   # Material constant inside scatterer
-alpha_out = kwargs_data["alpha_out"] if "alpha_out" in kwargs_data else 1   # Material constant outside scatterer
-n_in      = kwargs_data["n_in"]      if "n_in"      in kwargs_data else 0.9 # Refractive index inside scatterer
-n_out     = kwargs_data["n_out"]     if "n_out"     in kwargs_data else 1   # Refractive index ouside scatterer
-
-dir  = kwargs_data["dir"]  if "dir"  in kwargs_data else np.array([1.0,0.0]) # Direction of propagation, norm should be 1
-c    = kwargs_data["c"]    if "c"    in kwargs_data else 3*10**10            # Lightspeed in cm
-freq = kwargs_data["freq"] if "freq" in kwargs_data else 10**9               # Frequency of incoming wave in dm
-kappa_0 = 2*np.pi*freq/c
-
-R_tilde   = kwargs_data["R_tilde"]   if "R_tilde"   in kwargs_data else 7.5          # Outer radius PML in cm
-R_PML     = kwargs_data["R_PML"]     if "R_PML"     in kwargs_data else 11           # Outer radius PML in cm
-sigma_PML = kwargs_data["sigma_PML"] if "sigma_PML" in kwargs_data else 10000        # Global demping parameter of PML layer
-gdim      = kwargs_data["gdim"]      if "gdim"      in kwargs_data else 2            # Geometric dimension of the mesh
-
-epsilon  = kwargs_data["epsilon"]  if "epsilon"  in kwargs_data else 0.001 # Small number greater than zero for convergence of radius expansion
-char_len = kwargs_data["char_len"] if "char_len" in kwargs_data else False # Determines type of expansion
-s        = kwargs_data["s"]        if "s"        in kwargs_data else 0.001 # Scaled version of correlation length
-
-K            = kwargs_data["K"]            if "K"            in kwargs_data else 100  # Number of measured points
-sigma_smooth = kwargs_data["sigma_smooth"] if "sigma_smooth" in kwargs_data else fsolve(lambda sigma: 1/(2*np.pi*sigma**2)*np.e**(-(0.5*np.sqrt((1/2**3)**2 * (10**9/(4*10**9))**3))**2/(2*sigma**2))-0.1, x0=0.1)[0]# the exponential is still 10% one characterstic length further
-
-
-create_domain_data = Generate_Mesh(**kwargs_data)
-domain_data, ct_data, ft_data = create_domain_data()
-
-V_data = fem.FunctionSpace(domain_data, ("CG", 1)) # Solution space
-Q_data = fem.FunctionSpace(domain_data, ("DG", 0)) # For discontinuous expressions
-
-alpha_data      = fem.Function(Q_data)
-kappa_sqrd_data = fem.Function(Q_data)
-
-material_tags_data = np.unique(ct_data.values)
-for tag in material_tags_data:
-    cells = ct_data.find(tag)
-    if tag == 1 or tag == 2 or tag == 3:
-        alpha_data_ = alpha_out
-        kappa_sqrd_data_ = kappa_0**2*n_out
-    elif tag == 4 or tag == 5:
-        alpha_data_ = alpha_in
-        kappa_sqrd_data_ = kappa_0**2*n_in
-    alpha_data.x.array[cells] = np.full_like(cells, alpha_data_, dtype=PETSc.ScalarType)
-    kappa_sqrd_data.x.array[cells] = np.full_like(cells, kappa_sqrd_data_, dtype=PETSc.ScalarType)
-
-bc_data = fem.dirichletbc(fem.Constant(domain_data, PETSc.ScalarType(0)), fem.locate_dofs_topological(V_data, gdim-1, ft_data.find(6)), V_data) # Set zero Dirichlet boundary condition at R_PML
-u_i_boundary_data  = fem.Function(V_data)
-dof_data = V_data.tabulate_dof_coordinates()[:, 0:2]
-dofs_boundary_data   = fem.locate_dofs_topological(V_data, gdim-1, ft_data.find(8)) # Degrees of freedom at R
-coords_boundary_data = domain_data.geometry.x[dofs_boundary_data]
-values_boundary_data = u_i(kappa_0, n_out, alpha_out, dir, dof_data[dofs_boundary_data].transpose())
-with u_i_boundary_data.vector.localForm() as loc:
-        loc.setValues(dofs_boundary_data, values_boundary_data)
-u_i_n_data = fem.Function(V_data)
-u_i_n_data.interpolate(lambda x: u_in(kappa_0, n_out, alpha_out, dir, x))
-
-dx_inner_data = ufl.Measure('dx', domain=domain_data, subdomain_data=ct_data, subdomain_id=3) # Integration on medium domain
-dS_data       = ufl.Measure('dS', domain=domain_data, subdomain_data=ft_data, subdomain_id=8) # Surface integration at R
-
-A_matrix_data, dd_bar_data = build_PML(sigma_PML, R_tilde, R_PML, freq, Q_data, V_data)
-
-u_data = ufl.TrialFunction(V_data)
-v_data = ufl.TestFunction(V_data)
-
-solver_data = PETSc.KSP().create(domain_data.comm)
-solver_data.setType(PETSc.KSP.Type.PREONLY)
-solver_data.getPC().setType(PETSc.PC.Type.LU)
-
-L_data = alpha_data('+')*ufl.inner(u_i_n_data, v_data)('+')*dS_data - alpha_data*ufl.inner(ufl.grad(u_i_boundary_data), ufl.grad(v_data))*dx_inner_data + kappa_sqrd_data*ufl.inner(u_i_boundary_data, v_data)*dx_inner_data
-b_data = fem.petsc.assemble_vector(fem.form(L_data))
-b_data.assemble()
-fem.petsc.set_bc(b_data, [bc_data])
-
-
-create_domain_inv = Generate_Mesh(**kwargs_inv)
-domain_inv, ct_inv, ft_inv = create_domain_inv()
-
-V_inv = fem.FunctionSpace(domain_inv, ("CG", 1))
-Q_inv = fem.FunctionSpace(domain_inv, ("DG", 0))
-
-alpha_inv      = fem.Function(Q_inv)
-kappa_sqrd_inv = fem.Function(Q_inv)
-
-material_tags_inv = np.unique(ct_inv.values)
-for tag in material_tags_inv:
-    cells = ct_inv.find(tag)
-    if tag == 1 or tag == 2 or tag == 3:
-        alpha_inv_ = alpha_out
-        kappa_sqrd_inv_ = kappa_0**2*n_out
-    elif tag == 4 or tag == 5:
-        alpha_inv_ = alpha_in
-        kappa_sqrd_inv_ = kappa_0**2*n_in
-    alpha_inv.x.array[cells] = np.full_like(cells, alpha_inv_, dtype=PETSc.ScalarType)
-    kappa_sqrd_inv.x.array[cells] = np.full_like(cells, kappa_sqrd_inv_, dtype=PETSc.ScalarType)
-
-bc_inv = fem.dirichletbc(fem.Constant(domain_inv, PETSc.ScalarType(0)), fem.locate_dofs_topological(V_inv, gdim-1, ft_inv.find(6)), V_inv) # Set zero Dirichlet boundary condition at R_PML
-u_i_boundary_inv  = fem.Function(V_inv)
-dof_inv = V_inv.tabulate_dof_coordinates()[:, 0:2]
-dofs_boundary_inv    = fem.locate_dofs_topological(V_inv, gdim-1, ft_inv.find(8)) # Degrees of freedom at R
-coords_boundary_inv  = domain_inv.geometry.x[dofs_boundary_inv]
-values_boundary_inv  = u_i(kappa_0, n_out, alpha_out, dir, dof_inv[dofs_boundary_inv].transpose())
-with u_i_boundary_inv.vector.localForm() as loc:
-        loc.setValues(dofs_boundary_inv, values_boundary_inv)
-u_i_n_inv = fem.Function(V_inv)
-u_i_n_inv.interpolate(lambda x: u_in(kappa_0, n_out, alpha_out, dir, x))
-
-dx_inner_inv = ufl.Measure('dx', domain=domain_inv, subdomain_data=ct_inv, subdomain_id=3) # Integration on medium domain
-dS_inv       = ufl.Measure('dS', domain=domain_inv, subdomain_data=ft_inv, subdomain_id=8) # Surface integration at R
-
-A_matrix_inv, dd_bar_inv = build_PML(sigma_PML, R_tilde, R_PML, freq, Q_inv, V_inv)
-
-u_inv = ufl.TrialFunction(V_inv)
-v_inv = ufl.TestFunction(V_inv)
-
-solver_inv = PETSc.KSP().create(domain_inv.comm)
-solver_inv.setType(PETSc.KSP.Type.PREONLY)
-solver_inv.getPC().setType(PETSc.PC.Type.LU)
-
-L_inv = alpha_inv('+')*ufl.inner(u_i_n_inv, v_inv)('+')*dS_inv - alpha_inv*ufl.inner(ufl.grad(u_i_boundary_inv), ufl.grad(v_inv))*dx_inner_inv + kappa_sqrd_inv*ufl.inner(u_i_boundary_inv, v_inv)*dx_inner_inv
-b_inv = fem.petsc.assemble_vector(fem.form(L_inv))
-b_inv.assemble()
-fem.petsc.set_bc(b_inv, [bc_inv])
-
-if char_len == True:
-    sum = np.sum(np.array([1/(1 + s*k**(2 + epsilon)) for k in range(1, 1000000)]))
-
-    var_sum = np.sum(np.array([1/((1 + s*k**(2 + epsilon))**2) for k in range(1, 1000000)]))
-    sum_j, j = 0, 0
-    while sum_j < 0.95*var_sum:
-        j += 1
-        sum_j += 1/((1 + s*j**(2 + epsilon))**2)
-    J = j
-    
-else:
-    sum = zeta(2 + epsilon)
-    var_sum = zeta(2*(2 + epsilon))
-    sum_j, j = 0, 0
-    while sum_j < 0.95*var_sum:
-        j += 1
-        sum_j += 1/(j**(2*(2 + epsilon)))
-    J = j
-
-angles_meas = np.array([i for i in range(K)])/K*2*np.pi
+def get_J(**kwargs):
+    epsilon  = kwargs["epsilon"]  if "epsilon"  in kwargs else 0.001 # Small number greater than zero for convergence of radius expansion
+    char_len = kwargs["char_len"] if "char_len" in kwargs else False # Determines type of expansion
+    s        = kwargs["s"]        if "s"        in kwargs else 0.001 # Scaled version of correlation length
+    return spectral_constants(s, epsilon, char_len)[1]
+
+
+@lru_cache(maxsize=None)
+def default_sigma_smooth(): # The exponential is still 10% one characterstic length further
+    return fsolve(lambda sigma: 1/(2*np.pi*sigma**2)*np.e**(-(0.5*np.sqrt((1/2**3)**2 * (10**9/(4*10**9))**3))**2/(2*sigma**2))-0.1, x0=0.1)[0]
+
+
+class Forward_Model(): # Mesh, spaces, right-hand side, solver and observation operator of one discretization
+    def __init__(self, **kwargs):
+        alpha_in  = kwargs["alpha_in"]  if "alpha_in"  in kwargs else 1   # Material constant inside scatterer
+        alpha_out = kwargs["alpha_out"] if "alpha_out" in kwargs else 1   # Material constant outside scatterer
+        n_in      = kwargs["n_in"]      if "n_in"      in kwargs else 0.9 # Refractive index inside scatterer
+        n_out     = kwargs["n_out"]     if "n_out"     in kwargs else 1   # Refractive index ouside scatterer
+
+        dir  = kwargs["dir"]  if "dir"  in kwargs else np.array([1.0,0.0]) # Direction of propagation, norm should be 1
+        dirs = kwargs["dirs"] if "dirs" in kwargs else [dir]               # Incident directions, observations are stacked in this order
+        c    = kwargs["c"]    if "c"    in kwargs else 3*10**10            # Lightspeed in cm
+        freq = kwargs["freq"] if "freq" in kwargs else 10**9               # Frequency of incoming wave in dm
+        kappa_0 = 2*np.pi*freq/c
+
+        R_tilde   = kwargs["R_tilde"]   if "R_tilde"   in kwargs else 7.5          # Outer radius PML in cm
+        R_PML     = kwargs["R_PML"]     if "R_PML"     in kwargs else 11           # Outer radius PML in cm
+        sigma_PML = kwargs["sigma_PML"] if "sigma_PML" in kwargs else 10000        # Global demping parameter of PML layer
+
+        K            = kwargs["K"]            if "K"            in kwargs else 100  # Number of measured points
+        sigma_smooth = kwargs["sigma_smooth"] if "sigma_smooth" in kwargs else default_sigma_smooth()
+        observation  = kwargs["observation"]  if "observation"  in kwargs else "truncated" # "full", "truncated" or "pointwise" measurements
+        assembly     = kwargs["assembly"]     if "assembly"     in kwargs else "form"      # "operator" also precomputes the truncated measurements
+        radius       = kwargs["radius"]       if "radius"       in kwargs else None        # Truncation radius of the kernels, None for 5*sigma_smooth
+
+        mesh = Generate_Mesh(**kwargs)
+        self.domain, self.ct, self.ft = mesh()
+
+        self.V = fem.FunctionSpace(self.domain, ("CG", 1)) # Solution space
+        self.Q = fem.FunctionSpace(self.domain, ("DG", 0)) # For discontinuous expressions
+        self.metadata = mesh.metadata(self.V, self.Q, self.ct, self.ft) # Loaded with the mesh after the first build
+
+        self.alpha      = fem.Function(self.Q)
+        self.kappa_sqrd = fem.Function(self.Q)
+
+        material_tags = [int(key[len("cells_"):]) for key in self.metadata if key.startswith("cells_")]
+        for tag in material_tags:
+            cells = self.metadata["cells_{0}".format(tag)]
+            if tag == 1 or tag == 2 or tag == 3:
+                alpha_ = alpha_out
+                kappa_sqrd_ = kappa_0**2*n_out
+            elif tag == 4 or tag == 5:
+                alpha_ = alpha_in
+                kappa_sqrd_ = kappa_0**2*n_in
+            self.alpha.x.array[cells] = np.full_like(cells, alpha_, dtype=PETSc.ScalarType)
+            self.kappa_sqrd.x.array[cells] = np.full_like(cells, kappa_sqrd_, dtype=PETSc.ScalarType)
+        self.alpha.x.scatter_forward() # Ghost cells take the values of their owners
+        self.kappa_sqrd.x.scatter_forward()
+
+        self.bc = fem.dirichletbc(fem.Constant(self.domain, PETSc.ScalarType(0)), self.metadata["boundary_dofs_6"], self.V) # Set zero Dirichlet boundary condition at R_PML
+        dof             = self.metadata["dof_coordinates"][:, 0:2]
+        dofs_boundary   = self.metadata["boundary_dofs_8"] # Degrees of freedom at R
+
+        dx_inner = ufl.Measure('dx', domain=self.domain, subdomain_data=self.ct, subdomain_id=3) # Integration on medium domain
+        dS       = ufl.Measure('dS', domain=self.domain, subdomain_data=self.ft, subdomain_id=8) # Surface integration at R
+
+        self.A_matrix, self.dd_bar = build_PML(sigma_PML, R_tilde, R_PML, freq, self.Q, self.V)
+
+        # Only the right-hand side depends on the incident direction
+        self.bs, self.observations = [], []
+        for dir in dirs:
+            u_i_boundary    = fem.Function(self.V)
+            values_boundary = u_i(kappa_0, n_out, alpha_out, dir, dof[dofs_boundary].transpose())
+            with u_i_boundary.vector.localForm() as loc:
+                    loc.setValues(dofs_boundary, values_boundary)
+            u_i_n = fem.Function(self.V)
+            u_i_n.interpolate(lambda x: u_in(kappa_0, n_out, alpha_out, dir, x))
+
+            v = ufl.TestFunction(self.V)
+            L = self.alpha('+')*ufl.inner(u_i_n, v)('+')*dS - self.alpha*ufl.inner(ufl.grad(u_i_boundary), ufl.grad(v))*dx_inner + self.kappa_sqrd*ufl.inner(u_i_boundary, v)*dx_inner
+            b = fem.petsc.assemble_vector(fem.form(L))
+            b.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE) # Contributions to shared dofs are summed on their owners
+            fem.petsc.set_bc(b, [self.bc])
+            self.bs.append(b)
+            mass_operator = self.observations[0].mass_operator if self.observations and observation == "truncated" else None # Shared by all directions
+            self.observations.append(Observation_Operator(self.V, self.Q, kappa_0, n_out, alpha_out, dir, sigma_smooth, observation, radius, mass_operator, self.metadata["dof_coordinates"],
+                                                          operator=assembly == "operator"))
+
+        self.forward_solver = Forward_Solver(self.V, self.Q, self.alpha, self.kappa_sqrd, self.A_matrix, self.dd_bar, self.bc, self.bs, self.metadata["points"], **kwargs)
+        self.angles_meas    = np.array([i for i in range(K)])/K*2*np.pi
+
+
+# Parameters of the model besides the mesh, the mesh enters with the key of Generate_Mesh
+discretization_keys = ["freq", "alpha_in", "alpha_out", "n_in", "n_out", "dir", "dirs", "c", "sigma_PML", "K", "sigma_smooth", "observation", "radius", "solver", "solver_type", "shift", "pc_type", "rtol", "rebuild", "assembly"]
+forward_models      = {} # Cache of the forward models built in this process
+
+
+def prepare_forward_model(**kwargs): # Generates and caches the mesh and its metadata, processes started afterwards only load them
+    mesh = Generate_Mesh(**kwargs)
+    domain, ct, ft = mesh()
+    mesh.metadata(fem.FunctionSpace(domain, ("CG", 1)), fem.FunctionSpace(domain, ("DG", 0)), ct, ft)
+
+
+def forward_model_key(**kwargs): # Key of a discretization in forward_models
+    key  = (("mesh", Generate_Mesh(**kwargs).key),)
+    key += tuple((name, tuple(np.ravel(kwargs[name])) if np.ndim(kwargs[name]) > 0 else kwargs[name]) for name in discretization_keys if name in kwargs)
+    if "comm" in kwargs: # Communicators are not hashable
+        key += (("comm", kwargs["comm"].py2f()),)
+    return key
+
+
+def get_forward_model(**kwargs): # Builds the forward model of a discretization on first use
+    key = forward_model_key(**kwargs)
+    if key not in forward_models:
+        forward_models[key] = Forward_Model(**kwargs)
+    return forward_models[key]
     
     
-def forward_observation(Y, **kwargs):    
-    alpha_out = kwargs["alpha_out"] if "alpha_out" in kwargs else 1   # Material constant outside scatterer
-    n_out     = kwargs["n_out"]     if "n_out"     in kwargs else 1   # Refractive index ouside scatterer
-
-    dir  = kwargs["dir"]  if "dir"  in kwargs else np.array([1.0,0.0]) # Direction of propagation, norm should be 1
-    c    = kwargs["c"]    if "c"    in kwargs else 3*10**10            # Lightspeed in cm
-    freq = kwargs["freq"] if "freq" in kwargs else 10**9               # Frequency of incoming wave in dm
-    kappa_0 = 2*np.pi*freq/c
-
+def adjoint_gradient(model, mapping, Y, residual, ref_measurement_points, measurement_points, R, r0, char_len, s, epsilon, J, sum): # Gradient of sum_k residual_k*observation_k(Y) after the forward solve of Y
+    forward_solver, observations = model.forward_solver, model.observations
+    K = len(model.angles_meas)
+    g_coefficients = [np.zeros(forward_solver.n_coefficients) for i in range(4)]
+    g_points       = np.zeros((2, K))
+    for d, observation in enumerate(observations): # One adjoint solve per incident direction
+        g_points += observation.adjoint(ref_measurement_points, residual[d*K:(d+1)*K])
+        for g, g_direction in zip(g_coefficients, forward_solver.adjoint(observation.adjoint_rhs(), observation.uh)):
+            g += g_direction
+        weight = observation.weight_gradient()
+        g_coefficients[3][:len(weight)] += weight
+    gradient = model.domain.comm.allreduce(mapping.gradient(Y, *g_coefficients), op=MPI.SUM)
+    return gradient + der_Phi_inv(R, r0, char_len, s, epsilon, J, sum, Y, measurement_points, g_points)
+
+
+def forward_observation_batch(Ys, **kwargs): # Block of parameters of shape (M, 2J), returns observations of shape (M, n_dirs*K)
     r0        = kwargs["r0"]        if "r0"        in kwargs else 1            # Radius of reference configuration in cm (scaling because of numerical underflow)
     r1        = kwargs["r1"]        if "r1"        in kwargs else 6            # Radius of measured points in physical domain in dm, must be greater than 1.5*r0, smaller than R
     R         = kwargs["R"]         if "R"         in kwargs else 7            # Radius of coordinate transformation domain D_R in cm
@@ -356,61 +801,47 @@ def forward_observation(Y, **kwargs):
     char_len = kwargs["char_len"] if "char_len" in kwargs else False # Determines type of expansion
     s        = kwargs["s"]        if "s"        in kwargs else 0.001 # Scaled version of correlation length
     
-    data     = kwargs["data"] if "data" in kwargs else False
-
-    if "data" == True:
-      uh_data = fem.Function(V_data)
-      alpha_hat_data, kappa_sqrd_hat_data = build_mapping(R, r0, char_len, s, epsilon, J, sum, Q_data, Y)
-  
-      a_data = ufl.inner(alpha_data*alpha_hat_data*A_matrix_data*ufl.grad(u_data), ufl.grad(v_data))*ufl.dx - ufl.inner(kappa_sqrd_data*kappa_sqrd_hat_data*dd_bar_data*u_data, v_data)*ufl.dx
-      bilinear_form_data = fem.form(a_data)
-      A_data = fem.petsc.assemble_matrix(bilinear_form_data, bcs=[bc_data])
-      A_data.assemble()
-          
-      solver_data.setOperators(A_data)
-      solver_data.solve(b_data, uh_data.vector)
-  
-      # Observation operator
-      measurement_points =  np.array([r1*np.cos(angles_meas), r1*np.sin(angles_meas)])
-      ref_measurement_points = Phi_inv(R, r0, char_len, s, epsilon, J, sum, Y, measurement_points)
-      measurement_values = []
-      
-      ui_data = fem.Function(V_data)
-      ui_data.interpolate(lambda x: u_i(kappa_0, n_out, alpha_out, dir, x))
-      
-      for k in range(len(angles_meas)):
-          smoothing_data = fem.Function(V_data)
-          smoothing_data.interpolate(lambda x: 1/(2*np.pi*sigma_smooth**2)*np.e**(-((x[0] - ref_measurement_points[0,k])**2 + (x[1] - ref_measurement_points[1,k])**2)/(2*sigma_smooth**2)))
-          measurement_value = fem.form(ufl.inner((uh_data - ui_data), smoothing_data*kappa_sqrd_hat_data) * ufl.dx)
-          measurement_value_local = fem.assemble_scalar(measurement_value)
-          measurement_value_global = (domain_data.comm.allreduce(measurement_value_local, op=MPI.SUM))
-          measurement_values.append(np.real(measurement_value_global))
-  
-    else:
-      uh_inv = fem.Function(V_inv)
-      alpha_hat_inv, kappa_sqrd_hat_inv = build_mapping(R, r0, char_len, s, epsilon, J, sum, Q_inv, Y)
-  
-      a_inv = ufl.inner(alpha_inv*alpha_hat_inv*A_matrix_inv*ufl.grad(u_inv), ufl.grad(v_inv))*ufl.dx - ufl.inner(kappa_sqrd_inv*kappa_sqrd_hat_inv*dd_bar_inv*u_inv, v_inv)*ufl.dx
-      bilinear_form_inv = fem.form(a_inv)
-      A_inv = fem.petsc.assemble_matrix(bilinear_form_inv, bcs=[bc_inv])
-      A_inv.assemble()
-          
-      solver_inv.setOperators(A_inv)
-      solver_inv.solve(b_inv, uh_inv.vector)
-  
-      # Observation operator
-      measurement_points =  np.array([r1*np.cos(angles_meas), r1*np.sin(angles_meas)])
-      ref_measurement_points = Phi_inv(R, r0, char_len, s, epsilon, J, sum, Y, measurement_points)
-      measurement_values = []
-      
-      ui_inv = fem.Function(V_inv)
-      ui_inv.interpolate(lambda x: u_i(kappa_0, n_out, alpha_out, dir, x))
-      
-      for k in range(len(angles_meas)):
-          smoothing_inv = fem.Function(V_inv)
-          smoothing_inv.interpolate(lambda x: 1/(2*np.pi*sigma_smooth**2)*np.e**(-((x[0] - ref_measurement_points[0,k])**2 + (x[1] - ref_measurement_points[1,k])**2)/(2*sigma_smooth**2)))
-          measurement_value = fem.form(ufl.inner((uh_inv - ui_inv), smoothing_inv*kappa_sqrd_hat_inv) * ufl.dx)
-          measurement_value_local = fem.assemble_scalar(measurement_value)
-          measurement_value_global = (domain_inv.comm.allreduce(measurement_value_local, op=MPI.SUM))
-          measurement_values.append(np.real(measurement_value_global))
-    return np.array(measurement_values)
\ No newline at end of file
+    batch_size = kwargs["batch_size"] if "batch_size" in kwargs else 16   # Number of particles whose mapping coefficients are computed together
+    gradient   = kwargs["gradient"]   if "gradient"   in kwargs else None # (delta, var) to also return the gradients of -|delta - observations|^2/(2*var) with respect to Y
+
+    model = get_forward_model(**kwargs)
+    forward_solver, observations = model.forward_solver, model.observations
+    sum, J = spectral_constants(s, epsilon, char_len)
+
+    mapping = forward_solver.get_mapping(R, r0, char_len, s, epsilon, J, sum)
+    measurement_points = np.array([r1*np.cos(model.angles_meas), r1*np.sin(model.angles_meas)])
+    K = len(model.angles_meas)
+    measurement_values = np.zeros((len(Ys), len(observations)*K))
+    gradients          = np.zeros(np.shape(Ys))
+    for start in range(0, len(Ys), batch_size):
+        block = Ys[start:start+batch_size]
+        coefficients = mapping(block.T) # Dense products for the whole block
+        for i, Y in enumerate(block): # Back to back solves on the warm solver
+            forward_solver.set_coefficients(*[coefficient[:, i] for coefficient in coefficients])
+            forward_solver.solve([observation.uh for observation in observations]) # One assembly and factorization for all directions
+
+            # Observation operator
+            ref_measurement_points = Phi_inv(R, r0, char_len, s, epsilon, J, sum, Y, measurement_points)
+            for d, observation in enumerate(observations):
+                observation.kappa_sqrd_hat.x.array[:] = forward_solver.kappa_sqrd_hat.x.array
+                measurement_values[start+i, d*K:(d+1)*K] = observation(ref_measurement_points)
+
+            if gradient is not None: # Adjoint solves against the operator of this particle
+                residual = (gradient[0] - measurement_values[start+i])/gradient[1]
+                gradients[start+i] = adjoint_gradient(model, mapping, Y, residual, ref_measurement_points, measurement_points, R, r0, char_len, s, epsilon, J, sum)
+    if gradient is not None:
+        return measurement_values, gradients
+    return measurement_values
+
+
+def solver_statistics(**kwargs): # Iterations and timings of the forward solves of a discretization in this process
+    return get_forward_model(**kwargs).forward_solver.statistics()
+
+
+def forward_observation(Y, **kwargs): # Y of shape (2J,), or a block of shape (M, 2J). With gradient=(delta, var) also the gradients of the misfit
+    if np.ndim(Y) == 2:
+        return forward_observation_batch(Y, **kwargs)
+    if "gradient" in kwargs and kwargs["gradient"] is not None:
+        measurement_values, gradients = forward_observation_batch(np.asarray(Y)[None, :], **kwargs)
+        return measurement_values[0], gradients[0]
+    return forward_observation_batch(np.asarray(Y)[None, :], **kwargs)[0]
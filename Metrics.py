@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import numpy as np
+import json
+import os
+import time
+from contextlib import contextmanager
+
+'''
+Metrics of a Sequential Monte Carlo run as a JSONL stream, one record per MCMC sweep ("event": "sweep", or
+"chains" for all sweeps of a stage run in the workers) and one per stage ("event": "stage"). Wall time is split into dispatch (time inside the worker pool), solve (time
+the workers spend in the forward map), reweight (temperature bisection, reweighting and resampling) and io
+(pickles and checkpoints). Utilization is solve/(dispatch*workers): close to one means the run is solve-bound,
+small values mean it is bound by scheduling, transfer or load imbalance. Read it with for example
+pandas.read_json(path, lines=True).
+'''
+
+class Metrics():
+    def __init__(self, path, **kwargs):
+        self.path = path # None disables the stream, the timers still run
+        self.bins = kwargs["bins"] if "bins" in kwargs else np.logspace(-4, 3, 29) # Edges of the solve time histograms in seconds per particle
+        self.file = None
+        self.reset()
+
+
+    def reset(self): # Start of a stage
+        self.start    = time.perf_counter()
+        self.times    = {}
+        self.dispatch = 0.0
+        self.workers  = 1
+        self.tasks    = [] # (worker, particles, seconds) of every task of the stage
+
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+    def add(self, statistics): # Statistics of the worker pool since they were last taken
+        self.dispatch += statistics["dispatch"]
+        self.workers   = statistics["workers"]
+        self.tasks    += statistics["tasks"]
+
+
+    def summary(self, dispatch, workers, tasks, histograms=False):
+        busy = {}
+        for worker, n, seconds in tasks:
+            busy[str(worker)] = busy.get(str(worker), 0.0) + seconds
+        solve   = sum(busy.values())
+        summary = {"dispatch" : dispatch, "solve" : solve, "overhead" : max(dispatch - solve/workers, 0.0),
+                   "utilization" : solve/(dispatch*workers) if dispatch > 0 else 0.0, "busy" : busy}
+        if histograms: # Seconds per particle of the tasks of every worker
+            summary["bins"] = self.bins
+            summary["histograms"] = {worker: np.histogram([seconds/n for name, n, seconds in tasks if str(name) == worker], self.bins)[0] for worker in busy}
+        return summary
+
+
+    def stage_summary(self):
+        summary = self.summary(self.dispatch, self.workers, self.tasks, histograms=True)
+        summary["wall"] = self.elapsed()
+        summary.update(self.times)
+        summary["other"] = summary["wall"] - self.dispatch - sum(self.times.values()) # Proposals, acceptance and bookkeeping
+        return summary
+
+
+    def write(self, record):
+        if self.path is None:
+            return
+        if self.file is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, "a")
+        record = dict(record, time=time.time())
+        self.file.write(json.dumps(record, default=lambda value: value.tolist() if isinstance(value, np.ndarray) else value.item()) + "\n")
+        self.file.flush() # Readable while the run continues
+
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -20,37 +20,43 @@ def rotation_matrix(K, theta = np.pi/2): # Source algorithm: https://analyticphy
 
     
 if __name__ == '__main__':
+    comm = MPI.COMM_WORLD # The data mesh is distributed over all ranks, for example with mpirun -n 8
     freq = 2*10**9
-    kwargs_data = {"freq" : freq, "h" : 0.5*np.sqrt((1/2**3)**2 * (10**9/(2*10**9))**3), "quad" : True, "char_len" : True, "s" : 0.2, "K" : 100, "data" : True}
+    kwargs_data = {"freq" : freq, "h" : 0.5*np.sqrt((1/2**3)**2 * (10**9/(2*10**9))**3), "quad" : True, "char_len" : True, "s" : 0.2, "K" : 100, "data" : True, "comm" : comm}
     J = get_J(**kwargs_data)
     loc    = np.full(2*J, -1) 
     scale  = np.full(2*J, 2)
     Y_data = np.array([uniform.rvs(loc=loc[i], scale=scale[i]) for i in range(len(loc))]) # [loc[i], loc[i]+scale[i]]
     while np.sum((Y_data-(loc+0.5*scale))**2) < np.sum((0.5*scale)**2)*0.6:
         Y_data = np.array([uniform.rvs(loc=loc[i], scale=scale[i]) for i in range(len(loc))])
-    helm_data = forward_observation(Y_data, **kwargs_data)
-    print(helm_data)
+    Y_data    = comm.bcast(Y_data, root=0) # All ranks solve for the same parameter
+    # Solved on the fine data mesh of kwargs_data. The simulations in Data/ from before this was fixed took their data from the
+    # inversion mesh (the "data" flag had no effect), so new synthetic data and posteriors differ from the published figures
+    helm_data = forward_observation(Y_data, **kwargs_data) # Reduced over the ranks, so equal on all of them
 
     var       = abs(np.mean(helm_data)*0.01)
-    eta       = multivariate_normal(mean=np.zeros(len(helm_data)), cov=var*np.eye(len(helm_data))).rvs()
+    eta       = comm.bcast(multivariate_normal(mean=np.zeros(len(helm_data)), cov=var*np.eye(len(helm_data))).rvs(), root=0)
     delta_1   = helm_data        # zero noise realisation
     delta_2   = helm_data + eta
 
-    with open("Data/" + time.strftime("%Y%m%d-%H%M%S") + "_Parameters_Simulation.pickle", "wb") as file:
-        pickle.dump(Y_data, file)
-        pickle.dump(helm_data, file)
-        pickle.dump(var, file)
-        pickle.dump(eta, file)
-        pickle.dump(delta_1, file)
-        pickle.dump(delta_2, file)
+    if comm.rank == 0:
+        print(helm_data)
+        with open("Data/" + time.strftime("%Y%m%d-%H%M%S") + "_Parameters_Simulation.pickle", "wb") as file:
+            pickle.dump(Y_data, file)
+            pickle.dump(helm_data, file)
+            pickle.dump(var, file)
+            pickle.dump(eta, file)
+            pickle.dump(delta_1, file)
+            pickle.dump(delta_2, file)
 
-    kwargs_inv = {"freq" : freq, "h" : np.sqrt((1/2**3)**2 * (10**9/freq)**3), "char_len" : True, "s" : 0.2, "K" : 100, "M" : 1000, "data" : False}
+    kwargs_inv = {"freq" : freq, "h" : np.sqrt((1/2**3)**2 * (10**9/freq)**3), "char_len" : True, "s" : 0.2, "K" : 100, "M" : 1000, "data" : False, "assembly" : "operator"}
     
-    smc_1 = Sequential_Monte_Carlo(delta_1, var, J)
-    smc_1.SMC_algorithm(forward_observation, kwargs_inv)
-
-    smc_2 = Sequential_Monte_Carlo(delta_2, var, J)
-    smc_2.SMC_algorithm(forward_observation, kwargs_inv)
+    if comm.size > 1: # Under mpirun every rank solves its share of the particles, no worker processes are forked from an MPI process
+        smc = MPI_Sequential_Monte_Carlo(delta_1, var, J, prepare=prepare_forward_model, comm=comm)
+    else:
+        smc = Sequential_Monte_Carlo(delta_1, var, J, prepare=prepare_forward_model) # Meshes are generated before the workers start
+    smc.SMC_algorithm(forward_observation, kwargs_inv)
+    smc.SMC_retarget(forward_observation, kwargs_inv, delta_2) # Reuses the forward outputs of the first posterior, solves only where the weights degenerate
 
 
 ## Docker
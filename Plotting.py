@@ -1,211 +1,32 @@
-import numpy as np
-import matplotlib.pyplot as plt
-import pickle
-
-
-objects = []
-with (open("Data/20250119-132403_Parameters_Simulation.pickle", "rb")) as openfile:
-    while True:
-        try:
-            objects.append(pickle.load(openfile))
-        except EOFError:
-            break
-
-Y_data    = objects[0]
-helm_data = objects[1]
-var       = objects[2]
-eta       = objects[3]
-delta_1   = objects[4]
-delta_2   = objects[5]
-particles = objects[1]
-
-run_1 = []
-with (open("Data/20250119-164658_Posterior.pickle", "rb")) as openfile:
-    while True:
-        try:
-            run_1.append(pickle.load(openfile))
-        except EOFError:
-            break
-
-particles_1 = run_1[0]
-weights_1   = run_1[1]
-
-run_2 = []
-with (open("Data/20250119-213939_Posterior.pickle", "rb")) as openfile:
-    while True:
-        try:
-            run_2.append(pickle.load(openfile))
-        except EOFError:
-            break
-
-particles_2 = run_2[0]
-weights_2   = run_2[1]
-
-colors = ['red','teal','goldenrod','orchid','wheat','darkgreen','aquamarine','crimson','orange','silver','plum','lightblue','lavender','lightgreen','pink','coral','khaki','violet','sienna','indigo']
-
-print('True parameters:')
-print(Y_data)
-print('Empirical mean:')
-print(np.mean(particles_1,axis=0))
-print(np.mean(particles_2,axis=0))
-print('Emperical variance:')
-print(np.var(particles_1,axis=0))
-print(np.var(particles_2,axis=0))
-
-for i in range(1,len(Y_data)+1):
-    plt.subplot(3,4,i)
-    plt.hist(particles_1[:,i-1], weights=weights_1, color=colors[i-1])
-    plt.title('$Y_{{{}}}$ = {:.5f}'.format(i, Y_data[i-1]))
-    plt.vlines(Y_data[i-1],-0.01,0.5)
-    plt.grid()
-    plt.xlim((-1,1))
-
-plt.savefig("Run_1")
-
-for i in range(1,len(Y_data)+1):
-    plt.subplot(3,4,i)
-    plt.hist(particles_2[:,i-1], weights=weights_2, color=colors[i-1])
-    plt.title('$Y_{{{}}}$ = {:.5f}'.format(i, Y_data[i-1]))
-    plt.vlines(Y_data[i-1],-0.01,0.5)
-    plt.grid()
-    plt.xlim((-1,1))
-
-plt.savefig("Run_2")
+import sys
+from Posterior_Analytics import *
 
 '''
-## Plot Radii Main Project
-import numpy as np
-import matplotlib.pyplot as plt
-from scipy.special import zeta
-import pickle
-
-
-# (Usually) Fixed Parameters
-M       = 1000
-r0      = 0.01
-epsilon = 0.001
-
-# Variable Parameters
-s_1   = 0.1
-s_2   = 0.001
-sum_1 = 4.124
-sum_2 = 44.1466
-J_1   = 6
-J_2   = 58
-
-objects_prior_1 = []
-objects_prior_2 = []
-objects_post_1  = []
-objects_post_2  = []
-
-with (open("Master Thesis - s=0.1 Prior.pickle", "rb")) as openfile:
-    while True:
-        try:
-            objects_prior_1.append(pickle.load(openfile))
-        except EOFError:
-            break
-
-with (open("Master Thesis - s=0.001 Prior.pickle", "rb")) as openfile:
-    while True:
-        try:
-            objects_prior_2.append(pickle.load(openfile))
-        except EOFError:
-            break
-
-with (open("Master Thesis - s=0.1 Posterior.pickle", "rb")) as openfile:
-    while True:
-        try:
-            objects_post_1.append(pickle.load(openfile))
-        except EOFError:
-            break
-
-with (open("Master Thesis - s=0.001 Posterior.pickle", "rb")) as openfile:
-    while True:
-        try:
-            objects_post_2.append(pickle.load(openfile))
-        except EOFError:
-            break
-
-Y_1               = objects_prior_1[0]
-Y_2               = objects_prior_2[0]
-particles_prior_1 = objects_prior_1[1]
-weights_prior_1   = objects_prior_1[2]
-particles_prior_2 = objects_prior_2[1]
-weights_prior_2   = objects_prior_2[2]
-particles_post_1  = objects_post_1[1]
-weights_post_1    = objects_post_1[2]
-particles_post_2  = objects_post_2[1]
-weights_post_2    = objects_post_2[2]
-
-EY_prior_1  = np.dot(weights_prior_1.T,particles_prior_1)
-EY_prior_2  = np.dot(weights_prior_2.T,particles_prior_2)
-EY_post_1   = np.dot(weights_post_1.T, particles_post_1)
-EY_post_2   = np.dot(weights_post_2.T, particles_post_2)
-VarY_post_1 = np.dot(weights_post_1.T, (particles_post_1-EY_post_1*np.ones((M,2*J_1)))**2)
-VarY_post_2 = np.dot(weights_post_2.T, (particles_post_2-EY_post_2*np.ones((M,2*J_2)))**2)
-
-def pol2cart(rho, phi):
-    x = rho * np.cos(phi)
-    y = rho * np.sin(phi)
-    return x, y
-
-def radius_scatt(Y,s,sum,J):
-    r = r0*np.ones(len(phi))
-    for j in range(1,J+1):
-        #r += r0/(4*zeta(2+epsilon)*j**(2+epsilon))*(Y[2*j-2]*np.cos(j*phi)+Y[2*j-1]*np.sin(j*phi))
-        r += r0/(4*sum*(1+s*j**(2+epsilon)))*(Y[2*j-2]*np.cos(j*phi)+Y[2*j-1]*np.sin(j*phi))
-    return r
-
-def radius_var_scatt(Y,s,sum,J):
-    r = np.zeros(len(phi))
-    for j in range(1,J+1):
-        #r += (r0/(4*zeta(2+epsilon)*j**(2+epsilon)))**2*(Y[2*j-2]*np.cos(j*phi)**2+Y[2*j-1]*np.sin(j*phi)**2)
-        r += (r0/(4*sum*(1+s*j**(2+epsilon))))**2*(Y[2*j-2]*np.cos(j*phi)**2+Y[2*j-1]*np.sin(j*phi)**2)
-    return r
-
-phi        = np.linspace(0,2*np.pi,1000)
-r_1        = radius_scatt(Y_1,s_1,sum_1,J_1)
-r_2        = radius_scatt(Y_2,s_2,sum_2,J_2)
-Er_prior_1 = radius_scatt(EY_prior_1,s_1,sum_1,J_1)
-Er_prior_2 = radius_scatt(EY_prior_2,s_2,sum_2,J_2)
-Er_post_1  = radius_scatt(EY_post_1 ,s_1,sum_1,J_1)
-Er_post_2  = radius_scatt(EY_post_2 ,s_2,sum_2,J_2)
-
-Varr_post_1  = radius_var_scatt(VarY_post_1,s_1,sum_1,J_1)
-Varr_post_2  = radius_var_scatt(VarY_post_2,s_2,sum_2,J_2)
-r_min_post_1 = Er_post_1-np.sqrt(Varr_post_1)
-r_max_post_1 = Er_post_1+np.sqrt(Varr_post_1)
-r_min_post_2 = Er_post_2-np.sqrt(Varr_post_2)
-r_max_post_2 = Er_post_2+np.sqrt(Varr_post_2)
-
-x_1,y_1                   = pol2cart(r_1,phi)
-x_2,y_2                   = pol2cart(r_2,phi)
-Ex_prior_1,Ey_prior_1     = pol2cart(Er_prior_1,phi)
-Ex_prior_2,Ey_prior_2     = pol2cart(Er_prior_2,phi)
-Ex_post_1 ,Ey_post_1      = pol2cart(Er_post_1, phi)
-Ex_post_2 ,Ey_post_2      = pol2cart(Er_post_2, phi)
-x_min_post_1,y_min_post_1 = pol2cart(r_min_post_1,phi)
-x_max_post_1,y_max_post_1 = pol2cart(r_max_post_1,phi)
-x_min_post_2,y_min_post_2 = pol2cart(r_min_post_2,phi)
-x_max_post_2,y_max_post_2 = pol2cart(r_max_post_2,phi)
-
-plt.subplot(1,2,1)
-plt.plot(x_1       ,y_1       ,label='$\hat{r}(\phi)$')
-plt.plot(Ex_prior_1,Ey_prior_1,label='$E_{prior}[r(\phi)]$')
-plt.plot(Ex_post_1 ,Ey_post_1 ,label='$E_{post}[r(\phi)]$')
-plt.fill(np.append(x_min_post_1,x_max_post_1[::-1]),np.append(y_min_post_1,y_max_post_1[::-1]),color='grey',label='$\sigma$-inverval')
-plt.legend()
-plt.grid()
-plt.title('Prior and Posterior Expectation for $s=0.1$')
-
-plt.subplot(1,2,2)
-plt.plot(x_2       ,y_2       ,label='$\hat{r}(\phi)$')
-plt.plot(Ex_prior_2,Ey_prior_2,label='$E_{prior}[r(\phi)]$')
-plt.plot(Ex_post_2 ,Ey_post_2 ,label='$E_{post}[r(\phi)]$')
-plt.fill(np.append(x_min_post_2,x_max_post_2[::-1]),np.append(y_min_post_2,y_max_post_2[::-1]),color='grey',label='$\sigma$-inverval')
-plt.legend()
-plt.grid()
-plt.title('Prior and Posterior Expectation for $s=0.001$')
+Figures of one simulation in a data directory: python Plotting.py [Data] [s] [simulation]
+The simulation is a time stamp, by default 20250119-132403 behind the Run_i.png files of the repository, or
+"latest" for the newest simulation. Run_i.png shows the weighted posterior marginals of run i, Radius_Run_i.png
+the prior and posterior radius.
+'''
 
-plt.show()
-'''
\ No newline at end of file
+if __name__ == '__main__':
+    directory = sys.argv[1]        if len(sys.argv) > 1 else "Data"
+    s         = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2 # As in kwargs_inv of Paper.py
+    stamp     = sys.argv[3]        if len(sys.argv) > 3 else "20250119-132403" # Simulation of the published figures, "latest" for the newest
+
+    parameters, runs = find_simulation(directory, stamp)
+    Y_data, helm_data, var, eta, delta_1, delta_2 = list(load_pickle(parameters))[:6]
+    analytics = Posterior_Analytics(len(Y_data)//2, s=s, char_len=True)
+
+    print('True parameters:')
+    print(Y_data)
+    for i, run in enumerate(runs, start=1):
+        summaries = analytics.run(pickle_snapshots(run))
+        print('Run {0}:'.format(i))
+        analytics.report(summaries)
+        print('Empirical mean:')
+        print(summaries[-1]["mean"])
+        print('Emperical variance:')
+        print(summaries[-1]["var"])
+
+        analytics.plot_histograms(summaries[-1], Y_data, "Run_{0}".format(i))
+        analytics.plot_radius(summaries[0], summaries[-1], Y_data, "Radius_Run_{0}".format(i), title='Prior and Posterior Expectation for $s={0}$'.format(s))
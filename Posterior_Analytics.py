@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import numpy as np
+import os
+import pickle
+import matplotlib.pyplot as plt
+from scipy.special import zeta
+from Checkpoint import Checkpoint
+
+'''
+Streaming analytics of the particle snapshots of a Sequential Monte Carlo run. Snapshots are read one at a
+time and reduced to a small summary, so the memory use is that of a single stage. The boundary radius
+r(phi) = r0 + sum_j c_j*(Y[2j-2]*cos(j*phi) + Y[2j-1]*sin(j*phi)) of all particles is one matrix product
+with a fixed Fourier basis.
+'''
+
+def load_pickle(path): # Objects of a pickle file in order, one at a time
+    with open(path, "rb") as file:
+        while True:
+            try:
+                yield pickle.load(file)
+            except EOFError:
+                return
+
+
+def stage_name(path): # "Data/20250119-151655_T=0.594.pickle" -> "T=0.594"
+    return os.path.basename(path)[len("20250119-151655_"):-len(".pickle")]
+
+
+def simulations(directory="Data"): # Parameter files with the snapshot files of the runs that followed them
+    files = sorted(file for file in os.listdir(directory) if file.endswith(".pickle"))
+    groups, runs = [], None
+    for file in files:
+        path, name = os.path.join(directory, file), stage_name(file)
+        if name == "Parameters_Simulation":
+            runs = []
+            groups.append((path, runs))
+        elif runs is not None:
+            if name in ("Prior", "Retarget") or not runs: # A run starts with its prior, or with the posterior it is retargeted from
+                runs.append([])
+            runs[-1].append(path)
+    return groups
+
+
+def find_simulation(directory="Data", stamp="latest"): # Parameter file and runs of the simulation with time stamp, for example "20250119-132403"
+    groups = simulations(directory)
+    if stamp == "latest":
+        return groups[-1]
+    for parameters, runs in groups:
+        if os.path.basename(parameters).startswith(stamp + "_"):
+            return parameters, runs
+    raise ValueError("No simulation {0} in {1}".format(stamp, directory))
+
+
+def pickle_snapshots(paths): # (name, particles, weights) of the pickles written by Sequential_Monte_Carlo.save
+    for path in paths:
+        particles, weights = list(load_pickle(path))[:2]
+        yield stage_name(path), particles, weights
+
+
+def checkpoint_snapshots(directory): # (name, particles, weights) of the completed stages of a checkpoint directory
+    checkpoint = Checkpoint(directory)
+    for stage in checkpoint.stages():
+        state = checkpoint.read(stage)
+        yield "T={:.3g}".format(state["T"][-1]), state["particles"], state["weights"]
+
+
+def radius_coefficients(J, **kwargs): # c_j of the radius expansion, as in Helmholtz.radial
+    r0       = kwargs["r0"]       if "r0"       in kwargs else 1     # Radius of reference configuration
+    s        = kwargs["s"]        if "s"        in kwargs else 0.001 # Scaled version of correlation length
+    epsilon  = kwargs["epsilon"]  if "epsilon"  in kwargs else 0.001 # Small number greater than zero for convergence of radius expansion
+    char_len = kwargs["char_len"] if "char_len" in kwargs else False # Determines type of expansion
+    sum      = kwargs["sum"]      if "sum"      in kwargs else None  # Normalisation, computed if None
+
+    j = np.arange(1, J+1)
+    if char_len == True:
+        if sum is None:
+            sum = np.sum(1/(1 + s*np.arange(1, 1000000, dtype=float)**(2 + epsilon)))
+        return r0/(4*sum*(1 + s*j**(2 + epsilon)))
+    if sum is None:
+        sum = zeta(2 + epsilon)
+    return r0/(4*sum*j**(2 + epsilon))
+
+
+class Posterior_Analytics():
+    def __init__(self, J, **kwargs):
+        self.r0        = kwargs["r0"]        if "r0"        in kwargs else 1                           # Radius of reference configuration
+        self.phi       = kwargs["phi"]       if "phi"       in kwargs else np.linspace(0, 2*np.pi, 360) # Angles of the radius curves
+        self.quantiles = kwargs["quantiles"] if "quantiles" in kwargs else np.array([0.05, 0.5, 0.95])  # Levels of the radius bands
+        self.bins      = kwargs["bins"]      if "bins"      in kwargs else 20                          # Histogram bins per coordinate
+        self.lower     = kwargs["lower"]     if "lower"     in kwargs else -1                          # Prior box of the coordinates
+        self.upper     = kwargs["upper"]     if "upper"     in kwargs else 1
+        self.block     = kwargs["block"]     if "block"     in kwargs else 10**7                       # Maximal number of radius values held at once
+
+        c = radius_coefficients(J, **kwargs)
+        j = np.arange(1, J+1)
+        self.basis = np.empty((2*J, len(self.phi))) # Rows ordered like Y: cos(j*phi) at 2j-2, sin(j*phi) at 2j-1
+        self.basis[0::2] = c[:, None]*np.cos(np.outer(j, self.phi))
+        self.basis[1::2] = c[:, None]*np.sin(np.outer(j, self.phi))
+
+
+    def radius(self, Y): # Y of shape (2J,) or (M, 2J)
+        return self.r0 + Y @ self.basis
+
+
+    def radius_statistics(self, particles, weights): # Weighted mean, variance and quantiles of r(phi), in blocks of angles
+        mean      = self.radius(weights @ particles)
+        var       = np.zeros(len(self.phi))
+        quantiles = np.zeros((len(self.quantiles), len(self.phi)))
+        step      = max(1, self.block//len(particles))
+        uniform   = np.all(weights == weights[0]) # After resampling, partitioning suffices
+        for start in range(0, len(self.phi), step):
+            r = self.r0 + self.basis[:, start:start+step].T @ particles.T # Shape (angles, M), contiguous per angle
+            var[start:start+step] = (r - mean[start:start+step, None])**2 @ weights
+            if uniform:
+                quantiles[:, start:start+step] = np.quantile(r, self.quantiles, axis=1, method="inverted_cdf")
+            else:
+                order   = np.argsort(r, axis=1)
+                cumsum  = np.cumsum(weights[order], axis=1)
+                indices = np.stack([np.argmax(cumsum >= q*cumsum[:, -1:], axis=1) for q in self.quantiles], axis=1)
+                quantiles[:, start:start+step] = np.take_along_axis(r, np.take_along_axis(order, indices, axis=1), axis=1).T
+        return mean, var, quantiles
+
+
+    def histograms(self, particles, weights): # Weighted histograms of all coordinates in one bincount, shape (2J, bins)
+        dim   = particles.shape[1]
+        index = np.clip(((particles - self.lower)/(self.upper - self.lower)*self.bins).astype(int), 0, self.bins - 1)
+        return np.bincount((np.arange(dim)*self.bins + index).ravel(), np.repeat(weights, dim), minlength=dim*self.bins).reshape(dim, self.bins)
+
+
+    def summarize(self, name, particles, weights):
+        weights = weights/np.sum(weights)
+        mean    = weights @ particles
+        summary = {"name" : name, "M" : len(particles), "ess" : 1/np.dot(weights, weights), "mean" : mean, "var" : weights @ (particles - mean)**2,
+                   "unique" : len(np.unique(particles @ np.random.default_rng(0).standard_normal(particles.shape[1]))), # Distinct particles after resampling
+                   "histograms" : self.histograms(particles, weights)}
+        summary["radius_mean"], summary["radius_var"], summary["radius_quantiles"] = self.radius_statistics(particles, weights)
+        return summary
+
+
+    def diagnostics(self, previous, current): # Change of the particle system between consecutive stages
+        return {"mean_shift"   : np.sqrt(np.mean((current["mean"] - previous["mean"])**2/np.maximum(previous["var"], 1e-300))), # In standard deviations of the previous stage
+                "var_ratio"    : np.mean(current["var"]/np.maximum(previous["var"], 1e-300)),
+                "radius_shift" : np.max(np.abs(current["radius_mean"] - previous["radius_mean"]))}
+
+
+    def run(self, snapshots): # Summaries of a stream of (name, particles, weights), only one stage is in memory
+        summaries = []
+        for name, particles, weights in snapshots:
+            summary = self.summarize(name, particles, weights)
+            if summaries:
+                summary.update(self.diagnostics(summaries[-1], summary))
+            summaries.append(summary)
+        return summaries
+
+
+    def report(self, summaries):
+        print("{0:>12} {1:>9} {2:>9} {3:>11} {4:>10} {5:>13}".format("stage", "ESS", "unique", "mean shift", "var ratio", "radius shift"))
+        for summary in summaries:
+            print("{0:>12} {1:>9.1f} {2:>9d} {3:>11.3g} {4:>10.3g} {5:>13.3g}".format(summary["name"], summary["ess"], summary["unique"],
+                  summary.get("mean_shift", np.nan), summary.get("var_ratio", np.nan), summary.get("radius_shift", np.nan)))
+
+
+    def plot_histograms(self, summary, Y_true, file): # Run_1 style: weighted marginals with the true parameters
+        colors = ['red','teal','goldenrod','orchid','wheat','darkgreen','aquamarine','crimson','orange','silver','plum','lightblue','lavender','lightgreen','pink','coral','khaki','violet','sienna','indigo']
+        edges  = np.linspace(self.lower, self.upper, self.bins + 1)
+        rows   = int(np.ceil(len(Y_true)/4))
+        plt.figure(figsize=(12, 3*rows))
+        for i in range(1, len(Y_true)+1):
+            plt.subplot(rows, 4, i)
+            plt.bar(edges[:-1], summary["histograms"][i-1], width=np.diff(edges), align='edge', color=colors[(i-1) % len(colors)])
+            plt.title('$Y_{{{}}}$ = {:.5f}'.format(i, Y_true[i-1]))
+            plt.vlines(Y_true[i-1], -0.01, 0.5)
+            plt.grid()
+            plt.xlim((self.lower, self.upper))
+        plt.tight_layout()
+        plt.savefig(file)
+        plt.close()
+
+
+    def plot_radius(self, prior, posterior, Y_true, file, title=''): # True boundary, prior and posterior means and the quantile band
+        band = posterior["radius_quantiles"][[0, -1]]
+        x, y = lambda r: r*np.cos(self.phi), lambda r: r*np.sin(self.phi)
+        r_true = self.radius(Y_true)
+        plt.figure()
+        plt.plot(x(r_true), y(r_true), label='$\\hat{r}(\\phi)$')
+        plt.plot(x(prior["radius_mean"]), y(prior["radius_mean"]), label='$E_{prior}[r(\\phi)]$')
+        plt.plot(x(posterior["radius_mean"]), y(posterior["radius_mean"]), label='$E_{post}[r(\\phi)]$')
+        plt.fill(np.append(x(band[0]), x(band[1])[::-1]), np.append(y(band[0]), y(band[1])[::-1]), color='grey', alpha=0.5,
+                 label='{0:.0%}-{1:.0%} band'.format(self.quantiles[0], self.quantiles[-1]))
+        plt.legend()
+        plt.grid()
+        plt.axis('equal')
+        plt.title(title)
+        plt.savefig(file)
+        plt.close()
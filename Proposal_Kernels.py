@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy.stats import norm
+
+'''
+Proposal kernels for the MCMC moves of the Sequential Monte Carlo sampler. The prior is the uniform box
+[loc, loc+scale], all kernels are reversible with respect to it up to the indicator of the box, so the
+acceptance probability only contains the tempered potential and in_support. Kernels with gradient = True use
+the gradient of the potential and evaluate their proposals themselves in move, which also returns the log ratio
+of the reverse and forward proposal densities for the acceptance probability.
+'''
+
+class Proposal_Kernel():
+    gradient = False
+
+    def __init__(self, loc, scale, **kwargs):
+        self.loc      = np.asarray(loc, dtype=float)
+        self.scale    = np.asarray(scale, dtype=float)
+        self.lambda_l = kwargs["lambda_l"] if "lambda_l" in kwargs else 0.5  # Initial value global step size parameter
+        self.lower    = kwargs["lower"]    if "lower"    in kwargs else 0.15 # Acceptance ratio below which the step size is halved
+        self.upper    = kwargs["upper"]    if "upper"    in kwargs else 0.3  # Acceptance ratio above which the step size is doubled
+        self.max_step = np.inf
+
+
+    def adapt(self, alpha_l, particles, weights, global_sum=lambda value: value): # Tuning on the acceptance ratio of the previous stage
+        if alpha_l > self.upper:
+            self.lambda_l = min(2*self.lambda_l, self.max_step)
+        elif alpha_l < self.lower:
+            self.lambda_l = 0.5*self.lambda_l
+        self.fit(particles, weights, global_sum)
+
+
+    def fit(self, particles, weights, global_sum): # global_sum reduces over all particles when they are distributed
+        pass
+
+
+    def n_moves(self, m, MCMC_lower, MCMC_upper): # Adaptive number of MCMC moves
+        return int(min(max(np.floor(m/self.lambda_l**2), MCMC_lower), MCMC_upper))
+
+
+    def in_support(self, proposals):
+        return np.logical_and(self.loc <= proposals, proposals <= self.loc + self.scale).all(axis=1)
+
+
+    def propose(self, particles):
+        raise NotImplementedError
+
+
+class Random_Walk(Proposal_Kernel): # Gaussian random walk with diagonal covariance lambda_l^2*Var(particles)
+    def fit(self, particles, weights, global_sum):
+        n           = global_sum(len(particles))
+        mean        = global_sum(np.sum(particles, axis=0))/n
+        self.std_RW = self.lambda_l*np.sqrt(global_sum(np.sum((particles - mean)**2, axis=0))/n)
+
+
+    def propose(self, particles):
+        return particles + np.random.standard_normal(particles.shape)*self.std_RW
+
+
+class Covariance_Walk(Proposal_Kernel): # Gaussian random walk with the weighted particle covariance, optionally of low rank
+    def __init__(self, loc, scale, **kwargs):
+        super().__init__(loc, scale, **kwargs)
+        self.rank = kwargs["rank"] if "rank" in kwargs else None # Number of leading eigenvectors kept, None for the full covariance
+
+
+    def fit(self, particles, weights, global_sum):
+        mean = global_sum(weights @ particles)
+        cov  = global_sum(((particles - mean).T*weights) @ (particles - mean))
+        eigval, eigvec = np.linalg.eigh(cov)
+        eigval = np.maximum(eigval[::-1], 0)
+        eigvec = eigvec[:, ::-1]
+        rank   = len(eigval) if self.rank is None else min(self.rank, len(eigval))
+        self.factor   = eigvec[:, :rank]*np.sqrt(eigval[:rank])
+        self.basis    = eigvec[:, :rank]
+        self.residual = np.sqrt(np.mean(eigval[rank:])) if rank < len(eigval) else 0 # Isotropic variance in the discarded directions
+
+
+    def propose(self, particles):
+        z    = np.random.standard_normal(particles.shape)
+        step = z[:, :self.factor.shape[1]] @ self.factor.T
+        if self.residual > 0:
+            step += self.residual*(z - (z @ self.basis) @ self.basis.T)
+        return particles + self.lambda_l*step
+
+
+class Crank_Nicolson(Proposal_Kernel): # Preconditioned Crank-Nicolson in Gaussian coordinates of the uniform prior
+    def __init__(self, loc, scale, **kwargs):
+        super().__init__(loc, scale, **kwargs)
+        self.max_step = 1 # lambda_l plays the role of beta in (0, 1]
+        self.lambda_l = min(self.lambda_l, self.max_step)
+
+
+    def to_gaussian(self, particles):
+        return norm.ppf(np.clip((particles - self.loc)/self.scale, 1e-15, 1 - 1e-15))
+
+
+    def from_gaussian(self, xi):
+        return self.loc + self.scale*norm.cdf(xi)
+
+
+    def propose(self, particles): # Reversible with respect to the prior, so proposals never leave the box
+        xi = self.to_gaussian(particles)
+        return self.from_gaussian(np.sqrt(1 - self.lambda_l**2)*xi + self.lambda_l*np.random.standard_normal(xi.shape))
+
+
+class Langevin(Random_Walk): # Metropolis-adjusted Langevin, preconditioned with the diagonal particle variance
+    gradient = True
+
+    def __init__(self, loc, scale, **kwargs):
+        super().__init__(loc, scale, **dict({"lower" : 0.4, "upper" : 0.8}, **kwargs)) # Optimal acceptance ratio is about 0.57
+
+
+    def move(self, particles, gradients, T, evaluate): # evaluate returns the observations and gradients of a block of particles
+        drift     = 0.5*self.std_RW**2*T*gradients
+        proposals = particles + drift + self.std_RW*np.random.standard_normal(particles.shape)
+        inside    = self.in_support(proposals)
+        observed, proposal_gradients = evaluate(proposals[inside])
+        forward = proposals[inside] - particles[inside] - drift[inside]
+        reverse = particles[inside] - proposals[inside] - 0.5*self.std_RW**2*T*proposal_gradients
+        log_correction = (np.sum((forward/self.std_RW)**2, axis=1) - np.sum((reverse/self.std_RW)**2, axis=1))/2
+        return proposals, inside, observed, proposal_gradients, log_correction
+
+
+class Hamiltonian(Random_Walk): # Hamiltonian Monte Carlo with the inverse particle variance as mass matrix, reflected at the faces of the prior box
+    gradient = True
+
+    def __init__(self, loc, scale, **kwargs):
+        super().__init__(loc, scale, **dict({"lower" : 0.5, "upper" : 0.85}, **kwargs)) # Optimal acceptance ratio is about 0.65
+        self.n_steps = kwargs["n_steps"] if "n_steps" in kwargs else 5 # Leapfrog steps per move, each needs one forward and adjoint solve
+
+
+    def reflect(self, x, p): # Positions folded back into the box with the momenta flipped, volume preserving and reversible
+        t   = (x - self.loc)/self.scale
+        n   = np.floor(t)
+        odd = n % 2 == 1
+        return self.loc + self.scale*np.where(odd, 1 - (t - n), t - n), np.where(odd, -p, p)
+
+
+    def move(self, particles, gradients, T, evaluate): # Momenta in coordinates whitened by std_RW, so the step size is one
+        p0   = np.random.standard_normal(particles.shape)
+        x, p = particles, p0 + 0.5*self.std_RW*T*gradients
+        for step in range(self.n_steps):
+            x, p = self.reflect(x + self.std_RW*p, p)
+            observed, proposal_gradients = evaluate(x)
+            p = p + (0.5 if step == self.n_steps - 1 else 1)*self.std_RW*T*proposal_gradients
+        log_correction = (np.sum(p0**2, axis=1) - np.sum(p**2, axis=1))/2 # Change of the kinetic energy
+        return x, np.full(len(x), True), observed, proposal_gradients, log_correction
+
+
+proposal_kernels = {"RW" : Random_Walk, "covariance" : Covariance_Walk, "pCN" : Crank_Nicolson, "MALA" : Langevin, "HMC" : Hamiltonian}
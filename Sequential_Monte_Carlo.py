@@ -3,10 +3,22 @@
 import numpy as np
 import multiprocessing as mp
 import pickle
+import os
 import time
-from math import floor
-from scipy.stats import uniform, multivariate_normal
-from Helmholtz import *
+from scipy.stats import uniform
+from mpi4py import MPI
+from Worker_Pool import Worker_Pool, Serial_Pool
+from Proposal_Kernels import proposal_kernels
+from Surrogate import Polynomial_Surrogate
+from Checkpoint import Checkpoint
+from Metrics import Metrics
+
+
+def level_bridge(Y, forward, levels, beta, gradient=None): # Outputs of the previous and the next discretization side by side, for the targets between two levels
+    if gradient is None:
+        return np.concatenate([forward(Y, **levels[0]), forward(Y, **levels[1])], axis=-1)
+    (observed_0, gradients_0), (observed_1, gradients_1) = forward(Y, gradient=gradient, **levels[0]), forward(Y, gradient=gradient, **levels[1])
+    return np.concatenate([observed_0, observed_1], axis=-1), (1-beta)*gradients_0 + beta*gradients_1
 
 
 class Sequential_Monte_Carlo():
@@ -19,45 +31,138 @@ class Sequential_Monte_Carlo():
         self.loc   = kwargs["loc"]   if "loc"   in kwargs else np.full(2*self.J, -1) # For i.i.d uniform r.v. [-1,1]
         self.scale = kwargs["scale"] if "scale" in kwargs else np.full(2*self.J, 2)
         
-        self.particles = np.array([uniform.rvs(loc=self.loc[i], scale=self.scale[i], size=self.M) for i in range(len(self.loc))]).reshape((len(self.loc), self.M)).T # [loc[i], loc[i]+scale[i]]
+        self.particles = self.sample_prior(self.M)
         self.weights   = np.full(self.M, 1/self.M)
+        self.observed  = None # Forward outputs of the particles, shape (M, len(meas)), they follow the particles like the potentials
+        self.gradients = None # Gradients of the potentials, shape (M, 2J), only kept for kernels with gradients
 
         self.rho_ratio  = kwargs["rho_ratio"]  if "rho_ratio"  in kwargs else 1.01  # Effective sample size ratio for adaptive temperature choice
+        self.ess_retarget = kwargs["ess_retarget"] if "ess_retarget" in kwargs else 0.5 # Fraction of M below which retargeting to new data resamples and moves the particles
+        self.ess_bridge   = kwargs["ess_bridge"]   if "ess_bridge"   in kwargs else 0.5 # Fraction of M the effective sample size may drop to in one step between discretizations
         self.max_iter   = kwargs["max_iter"]   if "max_iter"   in kwargs else 25   # Maximal number of iterations in calculation of adaptive temperature choice
         self.p_min      = kwargs["p_min"]      if "p_min"      in kwargs else 0.05 # Minimal increase in calculation of adaptive temperature choice
         self.m          = kwargs["m"]          if "m"          in kwargs else 1    # Global parameter adaptive number of MCMC moves
         self.MCMC_lower = kwargs["MCMC_lower"] if "MCMC_lower" in kwargs else 3    # Lower bound for number of MCMC moves
         self.MCMC_upper = kwargs["MCMC_upper"] if "MCMC_upper" in kwargs else 10   # Upper bound for number of MCMC moves 
         self.lambda_l   = kwargs["lambda_l"]   if "lambda_l"   in kwargs else 0.5  # Initial value global parameter adaptive variance RW MH
+        self.n_chunks   = kwargs["n_chunks"]   if "n_chunks"   in kwargs else 4*mp.cpu_count() # Number of blocks of particles sent to the workers
+        kernel          = kwargs["kernel"]     if "kernel"     in kwargs else "RW" # Proposal kernel of the MCMC moves: "RW", "covariance", "pCN", "MALA" or "HMC"
+        kernel_kwargs   = kwargs["kernel_kwargs"] if "kernel_kwargs" in kwargs else {} # For example the rank of the covariance kernel
+        self.kernel     = proposal_kernels[kernel](self.loc, self.scale, lambda_l=self.lambda_l, **kernel_kwargs)
+        self.kwargs_coarse = kwargs["kwargs_coarse"] if "kwargs_coarse" in kwargs else None # Coarse discretization for delayed acceptance, None to disable
+        self.surrogate_mode   = kwargs["surrogate"]        if "surrogate"        in kwargs else None # "screen" (exact delayed acceptance) or "approximate", None to disable
+        self.surrogate_kwargs = kwargs["surrogate_kwargs"] if "surrogate_kwargs" in kwargs else {}   # For example degree and tol of the surrogate
+        self.surrogates       = {} # One surrogate per discretization, trained on all forward solves
+        self.mcmc             = kwargs["mcmc"] if "mcmc" in kwargs else "sweeps" # "sweeps" accepts and rejects here after every sweep, "chains" runs whole chains in the workers
+        if self.mcmc == "chains" and (self.kwargs_coarse is not None or self.surrogate_mode is not None):
+            raise ValueError("Delayed acceptance and surrogates need mcmc=\"sweeps\"")
+        if self.kernel.gradient and (self.kwargs_coarse is not None or self.surrogate_mode is not None):
+            raise ValueError("Delayed acceptance and surrogates cannot be combined with kernels that need gradients")
+        if self.surrogate_mode is not None:
+            terms = Polynomial_Surrogate(self.loc, self.scale, **self.surrogate_kwargs).P
+            if terms > self.M:
+                raise ValueError(f"The surrogate basis has {terms} terms for {self.M} particles, lower its degree or max_terms")
+        self.checkpoint_dir   = kwargs["checkpoint_dir"] if "checkpoint_dir" in kwargs else "Data/" + time.strftime("%Y%m%d-%H%M%S") + "_Checkpoints" # Directory of the .npz checkpoints
+        default_metrics       = os.path.join(self.checkpoint_dir, "metrics.jsonl") if self.checkpoint_dir is not None else None
+        self.metrics          = Metrics(kwargs["metrics"] if "metrics" in kwargs else default_metrics) # JSONL stream of per-sweep and per-stage metrics, None to disable
+        self.profile          = kwargs["profile"] if "profile" in kwargs else None # cProfile output of one worker, for example "Data/worker.prof"
+        self.prepare          = kwargs["prepare"] if "prepare" in kwargs else None # Called with the kwargs of every discretization before the workers start, for example prepare_forward_model
         
         self.alpha_l  = 0.2 # Initial acceptance ratio
         self.T        = [0] # Initial temperature
+        self.screen_l = 0   # Fraction of proposals rejected by the coarse screen in the last stage
+        self.n_solves, self.n_surrogate = 0, 0 # Forward solves and surrogate evaluations in the last stage
+        self.ess_level = self.M # Effective sample size of the last step between discretizations
+        self.ess_before, self.ess_after = self.M, self.M # Effective sample size before and after the last reweighting
+        self.M_l       = 0      # Number of MCMC sweeps of the last stage
+        self.level     = 0      # Index of the current discretization
+        self.level_beta = None  # Exponent of the likelihood ratio while bridging from the previous discretization, None at a level
+        self.stage     = 0      # Number of completed stages
+        self.checkpoint = None
 
 
-    def potential(self, func, Y, kwargs):
-        return -np.sum((self.delta-func(Y, **kwargs))**2)/(2*self.var)
+    def sample_prior(self, n):
+        return np.array([uniform.rvs(loc=self.loc[i], scale=self.scale[i], size=n) for i in range(len(self.loc))]).reshape((len(self.loc), n)).T # [loc[i], loc[i]+scale[i]]
 
 
-    def vector_potential(self, pool, func, kwargs):
-        inputs = [(func, self.particles[i], kwargs) for i in range(len(self.particles))]
-        potent = np.array(pool.starmap(self.potential, inputs))
-        return potent
+    def vector_potential(self, pool, func, kwargs): # The forward outputs of the current particles are kept
+        if self.kernel.gradient:
+            self.observed, self.gradients = self.evaluate_gradients(pool, func, self.particles, kwargs)
+        else:
+            self.observed = self.vector_observations_proposals(pool, func, self.particles, kwargs)
+        return self.misfit(self.observed)
     
     def vector_potential_proposals(self, pool, func, proposals, kwargs):
-        inputs = [(func, proposals[i], kwargs) for i in range(len(proposals))]
-        potent = np.array(pool.starmap(self.potential, inputs))
-        return potent
+        return self.misfit(self.vector_observations_proposals(pool, func, proposals, kwargs))
+
+
+    def vector_observations_proposals(self, pool, func, proposals, kwargs):
+        if self.surrogate_mode is None or self.level_beta is not None: # Surrogates are fitted per discretization, not to the outputs of a level bridge
+            self.n_solves += len(proposals)
+            return pool.observations(proposals, func, kwargs) # Proposals go through shared memory, only observations come back
+
+        surrogate    = self.get_surrogate(kwargs)
+        observations = np.zeros((len(proposals), len(self.delta)))
+        solve        = np.full(len(proposals), True)
+        if self.surrogate_mode == "approximate" and surrogate.ready(): # True solves only where the error indicator is too large
+            predicted    = surrogate.predict(proposals)
+            solve        = surrogate.potential_error(proposals, self.delta - predicted, self.var) > surrogate.tol
+            observations[~solve] = predicted[~solve]
+        if np.any(solve):
+            observations[solve] = pool.observations(proposals[solve], func, kwargs)
+            surrogate.add(proposals[solve], observations[solve])
+        self.n_solves    += np.sum(solve)
+        self.n_surrogate += np.sum(~solve)
+        return observations
+
+
+    def evaluate_gradients(self, pool, func, proposals, kwargs): # Observations and gradients of the potentials, a forward and an adjoint solve per proposal
+        self.n_solves += len(proposals)
+        if len(proposals) == 0:
+            return np.zeros((0, np.shape(self.observed)[1])), np.zeros((0, 2*self.J)) # Twice the data while bridging between discretizations
+        return pool.gradients(proposals, func, kwargs)
+
+
+    def misfit(self, observations):
+        if self.level_beta is not None and np.shape(observations)[-1] == 2*len(self.delta): # Level bridge, L(previous)^(1-beta)*L(next)^beta
+            n = len(self.delta)
+            return (1-self.level_beta)*self.misfit(observations[..., :n]) + self.level_beta*self.misfit(observations[..., n:])
+        return -np.sum((self.delta-observations)**2, axis=-1)/(2*self.var)
+
+
+    def get_surrogate(self, kwargs):
+        key = repr(sorted(kwargs.items()))
+        if key not in self.surrogates:
+            self.surrogates[key] = Polynomial_Surrogate(self.loc, self.scale, **self.surrogate_kwargs)
+        return self.surrogates[key]
+
+
+    def global_sum(self, value): # Reductions over all particles, overridden when the particles are distributed
+        return value
+
+
+    def global_max(self, value):
+        return value
+
+
+    def report(self, *lines):
+        for line in lines:
+            print(line)
 
 
     def reweight(self, potent):
         self.weights = np.exp(np.log(self.weights) + (self.T[-1]-self.T[-2])*potent) # Update is done in log−scale
-        self.weights /= np.sum(self.weights) # normalize weights
+        self.weights /= self.global_sum(np.sum(self.weights)) # normalize weights
+
+
+    def effective_sample_size(self):
+        return 1/self.global_sum(np.dot(self.weights, self.weights))
 
 
     def effective_sample_size_after_reweight(self, potent, mid_tmp):
         weights_tmp  = np.exp(np.log(self.weights) + (mid_tmp-self.T[-1])*potent)
-        weights_tmp /= np.sum(weights_tmp)
-        return 1/np.dot(weights_tmp, weights_tmp)
+        weights_tmp /= self.global_sum(np.sum(weights_tmp))
+        return 1/self.global_sum(np.dot(weights_tmp, weights_tmp))
 
 
     def adaptive_temperature(self, potent):
@@ -82,89 +187,532 @@ class Sequential_Monte_Carlo():
         self.T.append(T_new)
 
 
-    def resample(self):
-        self.particles = self.particles[np.random.choice(np.arange(self.M), size=self.M, p=self.weights, replace=True)]
+    def resample(self, potent): # The potentials follow their particles
+        indices        = np.random.choice(np.arange(self.M), size=self.M, p=self.weights, replace=True)
+        self.particles = self.particles[indices]
+        self.observed  = self.observed[indices]
+        if self.gradients is not None:
+            self.gradients = self.gradients[indices]
         self.weights   = np.full(self.M, 1/self.M)
+        return potent[indices]
+
 
+    def adaptive_MH(self):
+        self.kernel.adapt(self.alpha_l, self.particles, self.weights, self.global_sum)
+        self.lambda_l = self.kernel.lambda_l
+        return self.kernel.n_moves(self.m, self.MCMC_lower, self.MCMC_upper)
 
-    def adaptive_RW_MH(self):
-        if self.alpha_l > 0.3:
-            self.lambda_l = 2*self.lambda_l
-        elif self.alpha_l < 0.15:
-            self.lambda_l = 0.5*self.lambda_l
-  
-        var_RW = self.lambda_l**2 * np.var(self.particles,axis=0)
-        M_l = floor(self.m/self.lambda_l**2)
-        if M_l < self.MCMC_lower:
-            M_l = self.MCMC_lower
-        elif M_l> self.MCMC_upper:
-            M_l = self.MCMC_upper
-        return var_RW, M_l
 
+    def start_screen(self, kwargs): # Surrogates are refitted once per stage, so the screen is fixed during the moves
+        if self.level_beta is not None:
+            return self.kwargs_coarse is not None
+        if self.surrogate_mode is not None:
+            self.get_surrogate(kwargs).fit()
+        return self.kwargs_coarse is not None or (self.surrogate_mode == "screen" and self.get_surrogate(kwargs).ready())
 
-    def random_walk(self, x, var_RW):
-        proposals = np.zeros(x.shape)
-        for i in range(len(x)):
-            proposals[i,:] = multivariate_normal(mean=np.real(x[i]),cov=np.diag(var_RW)).rvs()
-        return proposals
 
+    def screen_potentials(self, pool, func, proposals, kwargs):
+        if func is level_bridge: # The coarse screen of a level bridge uses the forward map of one discretization
+            return self.vector_potential_proposals(pool, kwargs["forward"], proposals, self.kwargs_coarse)
+        if self.surrogate_mode == "screen" and self.get_surrogate(kwargs).ready():
+            self.n_surrogate += len(proposals)
+            return self.misfit(self.get_surrogate(kwargs).predict(proposals))
+        return self.vector_potential_proposals(pool, func, proposals, self.kwargs_coarse)
 
-    def MCMC_moves(self, pool, potent, func, kwargs):
-        var_RW, M_l = self.adaptive_RW_MH()
-        total_accepted = 0
 
-        for i in range(M_l):
-            proposals       = self.random_walk(self.particles, var_RW)
-            proposal_potent = self.vector_potential_proposals(pool, func, proposals, kwargs)
+    def screen(self, pool, func, proposals, inside, potent_coarse, kwargs): # First stage of delayed acceptance on the coarse discretization or the surrogate
+        proposal_potent_coarse = np.full(len(proposals), -np.inf)
+        if np.any(inside):
+            proposal_potent_coarse[inside] = self.screen_potentials(pool, func, proposals[inside], kwargs)
+
+        coarse_ratio = np.full(len(proposals), -np.inf)
+        coarse_ratio[inside] = (proposal_potent_coarse[inside]-potent_coarse[inside])*self.T[-1]
+        passed = np.random.uniform(size=len(proposals)) < np.exp(np.minimum(coarse_ratio, 0))
+        return passed, proposal_potent_coarse, coarse_ratio
+
+
+    def MCMC_moves(self, pool, potent, func, kwargs, progress=None): # progress continues an interrupted stage from a checkpoint
+        if self.mcmc == "chains" and self.level_beta is None: # The workers only know the misfit of one discretization
+            return self.MCMC_chains(pool, potent, func, kwargs, progress)
+        if progress is None:
+            progress = {"sweep" : 0, "M_l" : self.adaptive_MH(), "total_accepted" : 0, "total_screened" : 0, "total_candidates" : 0}
+            self.n_solves, self.n_surrogate = 0, 0
+        M_l = self.M_l = progress["M_l"]
+        total_accepted = progress["total_accepted"]
+        total_screened, total_candidates = progress["total_screened"], progress["total_candidates"]
+        screening = self.start_screen(kwargs)
+        if screening and "potent_coarse" in progress and self.surrogate_mode != "screen":
+            potent_coarse = progress["potent_coarse"]
+        elif screening:
+            potent_coarse = self.screen_potentials(pool, func, self.particles, kwargs)
+
+        for i in range(progress["sweep"], M_l):
+            start, solves, accepted_before = time.perf_counter(), self.n_solves, total_accepted
+            correction = np.zeros(len(self.particles))
+            if self.kernel.gradient: # The kernel evaluates its proposals, with the gradients for the next move
+                evaluate = lambda P: self.evaluate_gradients(pool, func, P, kwargs)
+                proposals, candidates, candidate_observed, candidate_gradients, log_correction = self.kernel.move(self.particles, self.gradients, self.T[-1], evaluate)
+                correction[candidates] = -log_correction # Proposal densities q(x|y)/q(y|x)
+            else:
+                proposals  = self.kernel.propose(self.particles)
+                candidates = self.kernel.in_support(proposals) # Proposals outside the prior are rejected without a solve
+            if screening: # Only proposals passing the coarse screen get a fine solve
+                passed, proposal_potent_coarse, coarse_ratio = self.screen(pool, func, proposals, candidates, potent_coarse, kwargs)
+                total_candidates += np.sum(candidates)
+                total_screened   += np.sum(candidates & ~passed)
+                candidates &= passed
+                correction[candidates] = coarse_ratio[candidates] # Second stage divides out the coarse ratio, so the target stays exact
+
+            proposal_potent   = np.full(len(proposals), -np.inf)
+            proposal_observed = np.zeros_like(self.observed)
+            if self.kernel.gradient:
+                proposal_gradients = np.zeros_like(self.gradients)
+                proposal_observed[candidates], proposal_gradients[candidates] = candidate_observed, candidate_gradients
+                proposal_potent[candidates] = self.misfit(proposal_observed[candidates])
+            elif np.any(candidates):
+                proposal_observed[candidates] = self.vector_observations_proposals(pool, func, proposals[candidates], kwargs)
+                proposal_potent[candidates]   = self.misfit(proposal_observed[candidates])
             
-            potent_ratio = (proposal_potent-potent)*self.T[-1]
+            potent_ratio = np.full(len(proposals), -np.inf)
+            potent_ratio[candidates] = (proposal_potent[candidates]-potent[candidates])*self.T[-1] - correction[candidates]
             potent_ratio[potent_ratio>0] = 0 # Pobability is maximal 1 (so 0 in log-scale)
-            acceptance_prob = np.exp(potent_ratio)*np.logical_and(-1<=proposals, proposals<=1).all(axis=1)
+            acceptance_prob = np.exp(potent_ratio)
 
             # Randomly accept the transitions based on the acceptance probability
-            accepted = np.random.uniform(size=self.M) < acceptance_prob
+            accepted = np.random.uniform(size=len(proposals)) < acceptance_prob
             self.particles[accepted] = proposals[accepted]
+            self.observed[accepted]  = proposal_observed[accepted]
             potent[accepted] = proposal_potent[accepted]
+            if self.kernel.gradient:
+                self.gradients[accepted] = proposal_gradients[accepted]
+            if screening:
+                potent_coarse[accepted] = proposal_potent_coarse[accepted]
             total_accepted += np.sum(accepted)
 
-        self.alpha_l = total_accepted/(M_l*self.M)
+            progress.update({"sweep" : i + 1, "total_accepted" : total_accepted, "total_screened" : total_screened, "total_candidates" : total_candidates})
+            if screening:
+                progress["potent_coarse"] = potent_coarse
+            self.write_checkpoint("current", potent, progress)
+            self.log_sweep(pool, i, total_accepted - accepted_before, self.n_solves - solves, time.perf_counter() - start)
+
+        self.alpha_l  = self.global_sum(total_accepted)/(M_l*self.M)
+        self.screen_l = self.global_sum(total_screened)/max(self.global_sum(total_candidates), 1)
+        return potent
+
+
+    def MCMC_chains(self, pool, potent, func, kwargs, progress=None): # All moves of a stage in one dispatch, the only barrier is at its end
+        if progress is None:
+            progress = {"sweep" : 0, "M_l" : self.adaptive_MH(), "total_accepted" : 0}
+            self.n_solves, self.n_surrogate = 0, 0
+        self.M_l = progress["M_l"]
+        start    = time.perf_counter()
+        self.particles, potent, self.observed, self.gradients, accepted, solves = pool.chains(self.particles, potent, self.observed, self.gradients, func, kwargs,
+                                                                                             self.kernel, self.T[-1], self.M_l - progress["sweep"])
+        self.n_solves += solves
+        self.alpha_l   = self.global_sum(progress["total_accepted"] + accepted)/(self.M_l*self.M)
+        self.screen_l  = 0
+        self.log_sweep(pool, self.M_l - 1, accepted, solves, time.perf_counter() - start, event="chains", sweeps=self.M_l - progress["sweep"])
         return potent
 
 
     def SMC_update(self, pool, potent, func, kwargs):
-        self.reweight(potent)
-        self.resample() # Resample every iteration
+        with self.metrics.timer("reweight"):
+            self.ess_before = self.effective_sample_size()
+            self.reweight(potent)
+            self.ess_after = self.effective_sample_size()
+            potent = self.resample(potent) # Resample every iteration
         potent = self.MCMC_moves(pool, potent, func, kwargs)
         return potent
 
 
-    def SMC_algorithm(self, func, kwargs):
-        with open("Data/" + time.strftime("%Y%m%d-%H%M%S") + "_Prior.pickle", "wb") as file:
+    def level_target(self, func, kwargs_previous, kwargs): # Forward map and kwargs of the current target between two discretizations
+        if self.level_beta is None:
+            return func, kwargs
+        return level_bridge, {"forward" : func, "levels" : (kwargs_previous, kwargs), "beta" : self.level_beta}
+
+
+    def level_weights(self, ratio, step): # Weights after raising the likelihood ratio of the two discretizations by step
+        log_weights = np.log(self.weights) + step*ratio
+        weights     = np.exp(log_weights - self.global_max(np.max(log_weights)))
+        return weights/self.global_sum(np.sum(weights))
+
+
+    def level_update(self, pool, func, kwargs_previous, kwargs): # One step of the bridge from the previous discretization to the next one at T = 1
+        n = len(self.delta)
+        if self.level_beta is None: # Start of the bridge, the particles are solved once on the next discretization
+            observed_previous = self.observed
+            self.vector_potential(pool, func, kwargs)
+            observed, beta = np.concatenate([observed_previous, self.observed], axis=1), 0
+        else:
+            observed, beta = self.observed, self.level_beta
+        potent_previous, potent_next = self.misfit(observed[:, :n]), self.misfit(observed[:, n:])
+        ratio    = potent_next - potent_previous
+        beta_new = self.adaptive_step(lambda b: 1/self.global_sum(np.sum(self.level_weights(ratio, b - beta)**2)), beta, self.ess_bridge)
+
+        with self.metrics.timer("reweight"):
+            self.ess_before = self.effective_sample_size()
+            self.weights    = self.level_weights(ratio, beta_new - beta)
+            self.ess_level  = self.ess_after = self.effective_sample_size()
+            self.observed   = observed
+            self.level_beta = beta_new if beta_new < 1 else None
+            potent = self.resample((1-beta_new)*potent_previous + beta_new*potent_next)
+        if self.level_beta is None:
+            self.observed = self.observed[:, n:]
+        target = self.level_target(func, kwargs_previous, kwargs)
+        if self.kernel.gradient and (beta > 0 or beta_new < 1): # Gradients from the start of the bridge only hold for the next discretization
+            self.observed, self.gradients = self.evaluate_gradients(pool, *target[:1], self.particles, target[1])
+        potent = self.MCMC_moves(pool, potent, *target)
+        return potent
+
+
+    def bridge(self, start, target, beta): # Data and variance of the likelihood proportional to L(start)^(1-beta)*L(target)^beta, both given as (delta, var)
+        (delta_0, var_0), (delta_1, var_1) = start, target
+        precision = (1-beta)/var_0 + beta/var_1
+        return ((1-beta)*delta_0/var_0 + beta*delta_1/var_1)/precision, 1/precision
+
+
+    def retarget_weights(self, delta, var, potent): # Importance weights for other data from the kept forward outputs, no solves
+        log_weights = np.log(self.weights) - np.sum((delta-self.observed)**2, axis=-1)/(2*var) - potent
+        weights     = np.exp(log_weights - self.global_max(np.max(log_weights)))
+        return weights/self.global_sum(np.sum(weights))
+
+
+    def adaptive_step(self, ess, beta, fraction): # Largest exponent in (beta, 1] whose effective sample size ess(b) stays above fraction*M
+        if ess(1) >= fraction*self.M:
+            return 1
+        l, r, n_iter = beta, 1, 0 # Bisection as in adaptive_temperature
+        while n_iter < self.max_iter and (r-l) > self.p_min*(1-beta):
+            mid = (l+r)/2
+            if ess(mid) >= fraction*self.M:
+                l = mid
+            else:
+                r = mid
+            n_iter = n_iter + 1
+        return l if l > beta else r
+
+
+    def adaptive_bridge(self, start, target, beta, potent): # Largest step towards the target data that keeps the effective sample size above ess_retarget*M
+        return self.adaptive_step(lambda b: 1/self.global_sum(np.sum(self.retarget_weights(*self.bridge(start, target, b), potent)**2)), beta, self.ess_retarget)
+
+
+    def retarget_update(self, pool, potent, func, kwargs, start, target, beta): # One step along the data bridge, particles are only moved when the weights degenerate
+        beta_new = self.adaptive_bridge(start, target, beta, potent)
+        with self.metrics.timer("reweight"):
+            self.ess_before = self.effective_sample_size()
+            self.delta, self.var = self.bridge(start, target, beta_new)
+            pool.set_data(self.delta, self.var)
+            self.weights   = self.retarget_weights(self.delta, self.var, potent)
+            potent         = self.misfit(self.observed)
+            self.ess_after = self.effective_sample_size()
+            if beta_new < 1:
+                potent = self.resample(potent)
+        if beta_new < 1:
+            if self.kernel.gradient: # Kept gradients belong to the previous data, only recomputed when the particles are moved
+                self.observed, self.gradients = self.evaluate_gradients(pool, func, self.particles, kwargs)
+            potent = self.MCMC_moves(pool, potent, func, kwargs)
+        else: # The weighted particles represent the target posterior
+            self.M_l, self.n_solves, self.n_surrogate = 0, 0, 0
+        return potent, beta_new
+
+
+    def save(self, name):
+        with self.metrics.timer("io"), open("Data/" + time.strftime("%Y%m%d-%H%M%S") + "_" + name + ".pickle", "wb") as file:
             pickle.dump(self.particles, file)
             pickle.dump(self.weights, file)
+
+
+    def get_state(self, potent, progress=None): # Complete sampler state as arrays
+        rng = np.random.get_state()
+        state = {"particles" : self.particles, "weights" : self.weights, "potent" : potent, "observed" : self.observed, "T" : np.array(self.T), "lambda_l" : self.lambda_l,
+                 "alpha_l" : self.alpha_l, "screen_l" : self.screen_l, "ess_level" : self.ess_level, "level" : self.level, "stage" : self.stage,
+                 "level_beta" : self.level_beta if self.level_beta is not None else -1,
+                 "n_solves" : self.n_solves, "n_surrogate" : self.n_surrogate,
+                 "rng_keys" : rng[1], "rng_pos" : rng[2], "rng_has_gauss" : rng[3], "rng_cached_gaussian" : rng[4]}
+        if self.gradients is not None:
+            state["gradients"] = self.gradients
+        for name, value in vars(self.kernel).items():
+            if isinstance(value, (np.ndarray, float, int)):
+                state["kernel_" + name] = value
+        if progress is None:
+            state["sweep"] = -1 # Stage is complete
+        else:
+            for name, value in progress.items():
+                state[name] = value
+        return state
+
+
+    def set_state(self, state): # Restores get_state, returns the potentials and the progress of an interrupted MCMC stage
+        self.particles = state["particles"]
+        self.weights   = state["weights"]
+        self.observed  = state["observed"] if "observed" in state else np.full((len(self.particles), len(self.delta)), np.nan) # Checkpoints without forward outputs cannot be retargeted
+        self.gradients = state["gradients"] if "gradients" in state else None
+        self.T         = state["T"].tolist()
+        self.lambda_l, self.alpha_l, self.screen_l, self.ess_level = float(state["lambda_l"]), float(state["alpha_l"]), float(state["screen_l"]), float(state["ess_level"])
+        self.level, self.stage = int(state["level"]), int(state["stage"])
+        self.level_beta = float(state["level_beta"]) if "level_beta" in state and state["level_beta"] >= 0 else None
+        self.n_solves, self.n_surrogate = int(state["n_solves"]), int(state["n_surrogate"])
+        np.random.set_state(("MT19937", state["rng_keys"], int(state["rng_pos"]), int(state["rng_has_gauss"]), float(state["rng_cached_gaussian"])))
+        for key, value in state.items():
+            if key.startswith("kernel_"):
+                setattr(self.kernel, key[len("kernel_"):], value if value.ndim > 0 else value.item())
+
+        progress = None
+        if int(state["sweep"]) >= 0:
+            progress = {name: int(state[name]) for name in ["sweep", "M_l", "total_accepted", "total_screened", "total_candidates"]}
+            if "potent_coarse" in state:
+                progress["potent_coarse"] = state["potent_coarse"]
+        return state["potent"], progress
+
+
+    def write_checkpoint(self, name, potent, progress=None):
+        if self.checkpoint is not None:
+            with self.metrics.timer("io"):
+                self.checkpoint.write(name, **self.get_state(potent, progress))
+
+
+    def end_stage(self, potent): # Indexed checkpoint of a completed stage
+        self.write_checkpoint("stage_{:04d}".format(self.stage), potent)
+        self.stage += 1
+        self.write_checkpoint("current", potent)
+
+
+    def log(self, record):
+        self.metrics.write(record)
+
+
+    def pool_statistics(self, pool): # Dispatch time and tasks of the pool since the last call
+        return pool.statistics()
+
+
+    def log_sweep(self, pool, sweep, accepted, solves, wall, event="sweep", sweeps=1): # event "chains" covers the sweeps of a whole stage
+        statistics = self.pool_statistics(pool)
+        self.metrics.add(statistics)
+        record = {"event" : event, "stage" : self.stage, "level" : self.level, "T" : self.T[-1], "sweep" : sweep, "M_l" : self.M_l, "wall" : wall,
+                  "acceptance" : self.global_sum(accepted)/(sweeps*self.M), "solves" : self.global_sum(solves)}
+        record.update(self.metrics.summary(statistics["dispatch"], statistics["workers"], statistics["tasks"]))
+        self.log(record)
+
+
+    def log_stage(self, pool, **fields): # After end_stage, so the checkpoint of the stage is counted as io
+        self.metrics.add(self.pool_statistics(pool))
+        record = {"event" : "stage", "stage" : self.stage - 1, "level" : self.level, "T" : self.T[-1], "ess_before" : self.ess_before,
+                  "ess_after" : self.ess_after, "lambda_l" : self.lambda_l, "M_l" : self.M_l, "alpha_l" : self.alpha_l, "screen_l" : self.screen_l,
+                  "solves" : self.global_sum(self.n_solves), "surrogate" : self.global_sum(self.n_surrogate)}
+        record.update(self.metrics.stage_summary())
+        record.update(fields)
+        self.log(record)
+        self.report('Wall Time, Dispatch Time and Worker Utilization:', "{0:.1f} s {1:.1f} s {2:.0%}".format(record["wall"], record["dispatch"], record["utilization"]))
+        self.metrics.reset()
+
+
+    def open_checkpoint(self, directory):
+        return Checkpoint(directory)
+
+
+    def prepare_discretizations(self, levels): # Meshes are generated once here, so the workers do not generate and write them concurrently
+        if self.prepare is not None:
+            for kwargs in list(levels) + ([self.kwargs_coarse] if self.kwargs_coarse is not None else []):
+                self.prepare(**kwargs)
+
+
+    def make_pool(self, func, kwargs):
+        return Worker_Pool(self.delta, self.var, self.M, 2*self.J, func=func, kwargs=kwargs, n_chunks=self.n_chunks, profile=self.profile) # For multiprocessing
+
+
+    def SMC_algorithm(self, func, kwargs, kwargs_levels=None, resume_from=None):
+        kwargs_levels = kwargs_levels if kwargs_levels is not None else []
+        levels = list(kwargs_levels) + [kwargs] # Discretizations from coarse to fine, tempering is done on the coarsest one
         
-        pool = mp.Pool(mp.cpu_count()) # For multiprocessing
-        potent = self.vector_potential(pool, func, kwargs)
+        self.prepare_discretizations(levels)
+        pool = self.make_pool(func, levels[0])
+        if resume_from is None:
+            self.checkpoint = self.open_checkpoint(self.checkpoint_dir) if self.checkpoint_dir is not None else None
+            self.save("Prior")
+            potent = self.vector_potential(pool, func, levels[0])
+            self.end_stage(potent)
+            self.log_stage(pool)
+            progress = None
+        else: # Continue from the latest checkpoint without solving the current particles again
+            self.checkpoint = self.open_checkpoint(resume_from)
+            potent, progress = self.set_state(self.checkpoint.read("current"))
         
-        while self.T[-1] != 1:
-            self.adaptive_temperature(potent)
-            potent = self.SMC_update(pool, potent, func, kwargs)
-
-            if self.T[-1] == 1:
-                print("T = {0} is finished".format(self.T[-1]))
-                with open("Data/" + time.strftime("%Y%m%d-%H%M%S") + "_Posterior.pickle", "wb") as file:
-                    pickle.dump(self.particles, file)
-                    pickle.dump(self.weights, file)
+        while self.level == 0 and (self.T[-1] != 1 or progress is not None):
+            if progress is None:
+                with self.metrics.timer("reweight"):
+                    self.adaptive_temperature(potent)
+                potent = self.SMC_update(pool, potent, func, levels[0])
+            else:
+                potent = self.MCMC_moves(pool, potent, func, levels[0], progress)
+                progress = None
+
+            if self.T[-1] == 1 and len(levels) == 1:
+                self.report("T = {0} is finished".format(self.T[-1]))
+                self.save("Posterior")
             else:
-                print("T = {0:.3} is finished".format(self.T[-1]))
-                with open("Data/" + time.strftime("%Y%m%d-%H%M%S") + "_T={:.3}.pickle".format(self.T[-1]), "wb") as file:
-                    pickle.dump(self.particles, file)
-                    pickle.dump(self.weights, file)
+                self.report("T = {0:.3g} is finished".format(self.T[-1]))
+                self.save("T={:.3g}".format(self.T[-1]))
             
-            print('Average Acceptance Rate:')
-            print(self.alpha_l)
+            self.report('Average Acceptance Rate:', self.alpha_l)
+            if self.kwargs_coarse is not None or self.surrogate_mode == "screen":
+                self.report('Coarse Screen Rejection Rate:', self.screen_l)
+            if self.surrogate_mode is not None:
+                self.report('Forward Solves and Surrogate Evaluations:', "{0} {1}".format(self.global_sum(self.n_solves), self.global_sum(self.n_surrogate)))
+            self.end_stage(potent)
+            self.log_stage(pool)
+
+        bridging = progress is not None or self.level_beta is not None # Interrupted inside a level
+        for level in range(self.level if bridging else self.level + 1, len(levels)): # Move the particle system up the hierarchy of discretizations
+            self.level = level
+            while True: # Steps of the bridge between the two discretizations
+                if progress is None:
+                    potent = self.level_update(pool, func, levels[level-1], levels[level])
+                else:
+                    potent = self.MCMC_moves(pool, potent, *self.level_target(func, levels[level-1], levels[level]), progress)
+                    progress = None
+                if self.level_beta is None:
+                    break
+                self.report("Level {0}, beta = {1:.3g} is finished, effective sample size {2:.1f}".format(level, self.level_beta, self.ess_level))
+                self.save("Level={0}_beta={1:.3g}".format(level, self.level_beta))
+                self.report('Average Acceptance Rate:', self.alpha_l)
+                self.end_stage(potent)
+                self.log_stage(pool, beta=self.level_beta)
+            self.report("Level {0} is finished, effective sample size {1:.1f}".format(level, self.ess_level))
+            if level == len(levels) - 1:
+                self.save("Posterior")
+            else:
+                self.save("Level={0}".format(level))
+            self.report('Average Acceptance Rate:', self.alpha_l)
+            self.end_stage(potent)
+            self.log_stage(pool)
         
         pool.close()
-        pool.join()
-        print('Used Temperatures:')
-        print(self.T)
\ No newline at end of file
+        self.metrics.close()
+        self.report('Used Temperatures:', self.T)
+
+
+    def SMC_retarget(self, func, kwargs, delta, var=None): # Posterior for other data or noise variance, starting from the posterior of the current data
+        if self.T[-1] != 1 or self.observed is None or np.any(np.isnan(self.observed)):
+            raise ValueError("Retargeting starts from a posterior at T = 1 with the forward outputs of its particles")
+        var    = self.var if var is None else var
+        start  = (self.delta, self.var)
+        target = (np.asarray(delta), var)
+
+        self.prepare_discretizations([kwargs])
+        pool   = self.make_pool(func, kwargs)
+        potent = self.misfit(self.observed)
+        self.metrics.reset()
+        self.save("Retarget")
+        beta = 0
+        while beta < 1:
+            potent, beta = self.retarget_update(pool, potent, func, kwargs, start, target, beta)
+            if beta == 1:
+                self.report("Retargeting is finished, effective sample size {0:.1f}".format(self.ess_after))
+                self.save("Posterior")
+            else:
+                self.report("beta = {0:.3g} is finished".format(beta))
+                self.save("beta={:.3g}".format(beta))
+                self.report('Average Acceptance Rate:', self.alpha_l)
+            self.end_stage(potent)
+            self.log_stage(pool, beta=beta)
+
+        pool.close()
+        self.metrics.close()
+
+
+class MPI_Sequential_Monte_Carlo(Sequential_Monte_Carlo): # Particles are distributed over the MPI ranks, every rank solves its own particles
+    def __init__(self, meas, var, J, **kwargs):
+        self.comm = kwargs["comm"] if "comm" in kwargs else MPI.COMM_WORLD # Forward models live on MPI.COMM_SELF of every rank
+        seed      = kwargs["seed"] if "seed" in kwargs else None              # Rank r uses seed + r, drawn on rank 0 if None
+        self.rank, self.size = self.comm.Get_rank(), self.comm.Get_size()
+        if seed is None:
+            seed = self.comm.bcast(np.random.randint(2**31 - self.size) if self.rank == 0 else None, root=0)
+        np.random.seed(seed + self.rank)
+        if "checkpoint_dir" not in kwargs: # Time stamps may differ between the ranks
+            kwargs["checkpoint_dir"] = self.comm.bcast("Data/" + time.strftime("%Y%m%d-%H%M%S") + "_Checkpoints" if self.rank == 0 else None, root=0)
+        super().__init__(meas, var, J, **kwargs)
+
+        self.bounds    = np.linspace(0, self.M, self.size + 1).astype(int) # Rank r owns the particles bounds[r]:bounds[r+1]
+        self.n_local   = self.bounds[self.rank + 1] - self.bounds[self.rank]
+        self.particles = self.sample_prior(self.n_local)
+        self.weights   = np.full(self.n_local, 1/self.M)
+
+
+    def global_sum(self, value):
+        return self.comm.allreduce(value, op=MPI.SUM)
+
+
+    def global_max(self, value):
+        return self.comm.allreduce(value, op=MPI.MAX)
+
+
+    def report(self, *lines):
+        if self.rank == 0:
+            super().report(*lines)
+
+
+    def log(self, record):
+        if self.rank == 0:
+            super().log(record)
+
+
+    def pool_statistics(self, pool): # Tasks of all ranks, the ranks dispatch in parallel
+        statistics = self.comm.gather(pool.statistics(), root=0)
+        if self.rank != 0:
+            return {"dispatch" : 0.0, "workers" : self.size, "tasks" : []}
+        tasks = [("{0}:{1}".format(rank, pid), n, seconds) for rank, rank_statistics in enumerate(statistics) for pid, n, seconds in rank_statistics["tasks"]]
+        return {"dispatch" : max(rank_statistics["dispatch"] for rank_statistics in statistics), "workers" : self.size, "tasks" : tasks}
+
+
+    def resample(self, potent): # Systematic resampling with one uniform shared by all ranks, then rebalancing
+        u      = self.comm.bcast(np.random.uniform() if self.rank == 0 else None, root=0)
+        offset = self.comm.exscan(np.sum(self.weights), op=MPI.SUM) or 0 # None on rank 0
+        cumsum = np.minimum(offset + np.cumsum(self.weights), 1)
+        if self.rank == self.size - 1:
+            cumsum[-1] = 1 # Rounding may not add up to exactly one
+        upper  = np.clip(np.ceil(self.M*cumsum - u), 0, self.M).astype(int)
+        counts = np.diff(upper, prepend=np.clip(np.ceil(self.M*offset - u), 0, self.M).astype(int))
+        gradients = np.repeat(self.gradients, counts, axis=0) if self.gradients is not None else None
+        return self.migrate(np.repeat(self.particles, counts, axis=0), np.repeat(self.observed, counts, axis=0), np.repeat(potent, counts), gradients)
+
+
+    def migrate(self, particles, observed, potent, gradients=None): # Moves the particles in global order to their owner ranks
+        start = self.comm.exscan(len(particles), op=MPI.SUM) or 0
+        owner = np.searchsorted(self.bounds, start + np.arange(len(particles)), side="right") - 1
+        extra = gradients if gradients is not None else np.zeros((len(particles), 0))
+        data  = np.column_stack([particles, observed, extra, potent])
+        data  = np.concatenate(self.comm.alltoall([data[owner == r] for r in range(self.size)]))
+        dim, n_extra   = particles.shape[1], extra.shape[1]
+        self.particles = data[:, :dim]
+        self.observed  = data[:, dim:-1-n_extra]
+        self.gradients = data[:, -1-n_extra:-1] if gradients is not None else None
+        self.weights   = np.full(self.n_local, 1/self.M)
+        return data[:, -1]
+
+
+    def save(self, name):
+        particles = self.comm.gather(self.particles, root=0)
+        weights   = self.comm.gather(self.weights, root=0)
+        if self.rank == 0:
+            with self.metrics.timer("io"), open("Data/" + time.strftime("%Y%m%d-%H%M%S") + "_" + name + ".pickle", "wb") as file:
+                pickle.dump(np.concatenate(particles), file)
+                pickle.dump(np.concatenate(weights), file)
+
+
+    def set_state(self, state):
+        if len(state["particles"]) != self.n_local:
+            raise ValueError("Checkpoint was written with a different number of MPI ranks")
+        return super().set_state(state)
+
+
+    def prepare_discretizations(self, levels): # Rank 0 generates, the other ranks wait and only load
+        if self.rank == 0:
+            super().prepare_discretizations(levels)
+        self.comm.Barrier()
+
+
+    def open_checkpoint(self, directory): # One set of checkpoints per rank
+        return Checkpoint(os.path.join(directory, "rank_{0}".format(self.rank)))
+
+
+    def make_pool(self, func, kwargs): # Every rank is one process
+        return Serial_Pool(self.delta, self.var, self.n_local, 2*self.J, func=func, kwargs=kwargs, profile=self.profile if self.rank == 0 else None)
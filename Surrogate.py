@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import numpy as np
+from itertools import combinations_with_replacement
+from collections import Counter
+from numpy.polynomial.legendre import legvander
+
+'''
+Polynomial chaos surrogate of the forward map Y -> K observations. The prior is uniform, so the basis consists
+of tensorised Legendre polynomials. The default hyperbolic cross keeps the terms with prod(1 + k_i) <= p + 1,
+which for 2J inputs and p = 2 are the 1 + 4J univariate terms instead of the C(2J + 2, 2) terms of total
+degree 2. The normal equations are accumulated sample by sample, so refitting costs one linear solve
+independent of the number of samples.
+'''
+
+
+def index_set(dim, degree, basis): # Multi-indices of the basis as Counters {input: degree}
+    indices = [Counter(c) for q in range(degree + 1) for c in combinations_with_replacement(range(dim), q)]
+    if basis == "hyperbolic":
+        indices = [index for index in indices if np.prod([1 + k for k in index.values()]) <= degree + 1]
+    return indices
+
+
+class Polynomial_Surrogate():
+    def __init__(self, loc, scale, **kwargs):
+        self.loc         = np.asarray(loc, dtype=float)
+        self.scale       = np.asarray(scale, dtype=float)
+        self.degree      = kwargs["degree"]      if "degree"      in kwargs else 2    # Degree of the Legendre expansion
+        basis            = kwargs["basis"]       if "basis"       in kwargs else "hyperbolic" # "hyperbolic" cross or "total" degree
+        max_terms        = kwargs["max_terms"]   if "max_terms"   in kwargs else 1000 # Column budget, the degree is lowered until the basis fits
+        self.ridge       = kwargs["ridge"]       if "ridge"       in kwargs else 1e-8 # Relative Tikhonov regularisation of the normal equations
+        self.tol         = kwargs["tol"]         if "tol"         in kwargs else 0.5  # Tolerance on the estimated error of a potential
+        self.min_samples = kwargs["min_samples"] if "min_samples" in kwargs else None # Samples needed before use, default twice the basis size
+
+        dim          = len(self.loc)
+        self.indices = index_set(dim, self.degree, basis)
+        while len(self.indices) > max_terms and self.degree > 1:
+            self.degree -= 1
+            self.indices = index_set(dim, self.degree, basis)
+        self.P       = len(self.indices)
+        width        = max(self.degree, 1) # Univariate factors per term, padded with the constant L_0 of input 0
+        self.dims    = np.zeros((self.P, width), dtype=int)
+        self.degs    = np.zeros((self.P, width), dtype=int)
+        for column, index in enumerate(self.indices):
+            self.dims[column, :len(index)] = list(index.keys())
+            self.degs[column, :len(index)] = list(index.values())
+        if self.min_samples is None:
+            self.min_samples = 2*self.P
+
+        self.n       = 0    # Number of samples in the normal equations
+        self.gram    = np.zeros((self.P, self.P))
+        self.moments = None # Phi^T G
+        self.sqrd    = None # Sum of squared observations per output
+        self.coef    = None
+
+
+    def basis(self, Y):
+        Y   = np.atleast_2d(Y)
+        L   = legvander(2*(Y - self.loc)/self.scale - 1, self.degree) # Shape (n, 2J, degree+1)
+        return np.prod(L[:, self.dims, self.degs], axis=2)
+
+
+    def add(self, Y, observations):
+        Phi = self.basis(Y)
+        if self.moments is None:
+            self.moments = np.zeros((self.P, observations.shape[1]))
+            self.sqrd    = np.zeros(observations.shape[1])
+        self.n       += len(Phi)
+        self.gram    += Phi.T @ Phi
+        self.moments += Phi.T @ observations
+        self.sqrd    += np.sum(observations**2, axis=0)
+
+
+    def ready(self):
+        return self.coef is not None
+
+
+    def fit(self): # Refit on all samples so far, only once enough samples are available
+        if self.min_samples < self.P:
+            raise ValueError(f"min_samples = {self.min_samples} is below the {self.P} terms of the basis, the regression is underdetermined")
+        if self.n < self.min_samples:
+            return False
+        regularised   = self.gram + self.ridge*np.trace(self.gram)/self.P*np.eye(self.P)
+        self.gram_inv = np.linalg.inv(regularised)
+        self.coef     = self.gram_inv @ self.moments
+        residual      = self.sqrd - 2*np.sum(self.coef*self.moments, axis=0) + np.sum(self.coef*(self.gram @ self.coef), axis=0)
+        self.res_var  = np.maximum(residual, 0)/max(self.n - self.P, 1) # Residual variance per output
+        return True
+
+
+    def predict(self, Y):
+        return self.basis(Y) @ self.coef
+
+
+    def potential_error(self, Y, residual, var): # Estimated error of the potential from the predictive variance of the regression
+        Phi      = self.basis(Y)
+        leverage = np.sum((Phi @ self.gram_inv)*Phi, axis=1)
+        obs_err  = np.sqrt(leverage*np.sum(self.res_var))
+        return np.linalg.norm(residual, axis=-1)*obs_err/var
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+import numpy as np
+import cProfile
+import multiprocessing as mp
+import os
+import time
+from contextlib import nullcontext
+from multiprocessing import shared_memory, util
+
+'''
+Persistent worker pool for the Sequential Monte Carlo sampler. The workers are started once, build the
+forward model once and read the particles and data from shared memory, so a task only carries an index
+range and only observations travel back. In chains mode a task runs all Metropolis-Hastings
+steps of a stage for its block of particles, including the accept/reject, and writes the moved particles back
+to shared memory, so the only barrier is at the end of the stage. Kernels with gradients get the gradients of
+the potential with the observations, from one adjoint solve per particle. Every task is timed in the worker,
+and one worker can run under cProfile.
+'''
+
+worker_state = {} # Shared arrays of this worker process, filled by init_worker
+
+
+class Profiler(): # cProfile of the tasks of one process, dumped regularly so long runs can be inspected while they run
+    def __init__(self, path, interval=60):
+        self.path     = path
+        self.interval = interval # Seconds between dumps
+        self.profile  = cProfile.Profile()
+        self.last     = time.perf_counter()
+
+
+    def __enter__(self):
+        self.profile.enable()
+
+
+    def __exit__(self, *args):
+        self.profile.disable()
+        if time.perf_counter() - self.last > self.interval:
+            self.dump()
+
+
+    def dump(self): # Read with pstats or snakeviz
+        self.profile.dump_stats(self.path)
+        self.last = time.perf_counter()
+
+
+def attach(names, shapes):
+    worker_state["shm"] = []
+    for key in shapes:
+        shm = shared_memory.SharedMemory(name=names[key])
+        worker_state["shm"].append(shm)
+        worker_state[key] = np.ndarray(shapes[key], dtype=float, buffer=shm.buf)
+
+
+def init_worker(names, shapes, func, kwargs, profile, profiled):
+    attach(names, shapes)
+    worker_state["profiler"] = None
+    with profiled.get_lock(): # Only the first worker to start is profiled
+        if profile is not None and not profiled.value:
+            profiled.value = 1
+            worker_state["profiler"] = Profiler(profile)
+            util.Finalize(None, worker_state["profiler"].dump, exitpriority=10) # Final dump when the pool is closed
+    if func is not None: # One solve at the reference configuration builds the forward model and compiles the forms
+        func(np.zeros(shapes["particles"][1]), **kwargs)
+
+
+def worker_observations(start, stop, func, kwargs):
+    return func(worker_state["particles"][start:stop], **kwargs)
+
+
+def worker_gradients(start, stop, func, kwargs): # Observations and gradients of the potential
+    return func(worker_state["particles"][start:stop], gradient=(worker_state["delta"], worker_state["var"][0]), **kwargs)
+
+
+class Gradient_Evaluation(): # Observations and gradients of a block of proposals, for the kernels that move with gradients
+    def __init__(self, func, kwargs, delta, var, n_observations, dim):
+        self.func, self.kwargs, self.data = func, kwargs, (delta, var)
+        self.n_observations, self.dim = n_observations, dim
+        self.solves = 0
+
+
+    def __call__(self, proposals):
+        self.solves += len(proposals)
+        if len(proposals) == 0:
+            return np.zeros((0, self.n_observations)), np.zeros((0, self.dim))
+        return self.func(proposals, gradient=self.data, **self.kwargs)
+
+
+def run_chains(particles, potent, observed, gradients, func, kwargs, kernel, T, M_l, delta, var): # M_l Metropolis-Hastings steps of every particle, in place
+    accepted, solves = 0, 0
+    evaluate = Gradient_Evaluation(func, kwargs, delta, var, observed.shape[1], particles.shape[1])
+    for i in range(M_l):
+        proposal_potent   = np.full(len(particles), -np.inf)
+        proposal_observed = np.zeros_like(observed)
+        correction        = np.zeros(len(particles))
+        if kernel.gradient: # The kernel evaluates its own proposals, together with the gradients
+            proposals, candidates, candidate_observed, candidate_gradients, candidate_correction = kernel.move(particles, gradients, T, evaluate)
+            proposal_gradients = np.zeros_like(gradients)
+            proposal_observed[candidates], proposal_gradients[candidates], correction[candidates] = candidate_observed, candidate_gradients, candidate_correction
+        else:
+            proposals  = kernel.propose(particles)
+            candidates = kernel.in_support(proposals) # Proposals outside the prior are rejected without a solve
+            if np.any(candidates):
+                proposal_observed[candidates] = func(proposals[candidates], **kwargs)
+            solves += np.sum(candidates)
+        proposal_potent[candidates] = -np.sum((delta - proposal_observed[candidates])**2, axis=-1)/(2*var)
+
+        potent_ratio = np.full(len(proposals), -np.inf)
+        potent_ratio[candidates] = (proposal_potent[candidates] - potent[candidates])*T + correction[candidates]
+        accept = np.random.uniform(size=len(proposals)) < np.exp(np.minimum(potent_ratio, 0))
+        particles[accept] = proposals[accept]
+        observed[accept]  = proposal_observed[accept]
+        potent[accept]    = proposal_potent[accept]
+        if kernel.gradient:
+            gradients[accept] = proposal_gradients[accept]
+        accepted += np.sum(accept)
+    return accepted, solves + evaluate.solves
+
+
+def worker_chains(start, stop, func, kwargs, kernel, T, M_l, seed): # Chains of a block of particles, moved in shared memory
+    np.random.seed(seed) # Seeds come from the sampler, so results do not depend on the scheduling
+    return run_chains(worker_state["particles"][start:stop], worker_state["potent"][start:stop], worker_state["observed"][start:stop], worker_state["gradients"][start:stop],
+                      func, kwargs, kernel, T, M_l, worker_state["delta"], worker_state["var"][0])
+
+
+def worker_task(task, start, stop, func, kwargs, *args): # Result with the process id and the time spent in the task
+    begin = time.perf_counter()
+    with worker_state["profiler"] or nullcontext():
+        values = task(start, stop, func, kwargs, *args)
+    return values, os.getpid(), time.perf_counter() - begin
+
+
+class Worker_Pool():
+    def __init__(self, delta, var, capacity, dim, **kwargs):
+        self.processes = kwargs["processes"] if "processes" in kwargs else mp.cpu_count()  # Number of worker processes
+        self.n_chunks  = kwargs["n_chunks"]  if "n_chunks"  in kwargs else 4*self.processes # Number of blocks of particles per dispatch
+        func           = kwargs["func"]      if "func"      in kwargs else None             # Forward map used to warm up the workers
+        func_kwargs    = kwargs["kwargs"]    if "kwargs"    in kwargs else {}
+        profile        = kwargs["profile"]   if "profile"   in kwargs else None             # cProfile output of one worker, for example "Data/worker.prof"
+
+        shapes = {"particles" : (capacity, dim), "potent" : (capacity,), "observed" : (capacity, np.size(delta)), "gradients" : (capacity, dim), "delta" : np.shape(delta), "var" : (1,)}
+        self.shm, self.arrays = {}, {}
+        for key, shape in shapes.items():
+            self.shm[key]    = shared_memory.SharedMemory(create=True, size=max(8, 8*int(np.prod(shape))))
+            self.arrays[key] = np.ndarray(shape, dtype=float, buffer=self.shm[key].buf)
+        self.set_data(delta, var)
+        self.reset_statistics()
+
+        names = {key: shm.name for key, shm in self.shm.items()}
+        self.pool = mp.Pool(self.processes, initializer=init_worker, initargs=(names, shapes, func, func_kwargs, profile, mp.Value("b", 0)))
+
+
+    def set_data(self, delta, var):
+        self.arrays["delta"][:] = delta
+        self.arrays["var"][0]   = var
+
+
+    def ranges(self, n):
+        bounds = np.linspace(0, n, min(n, self.n_chunks) + 1).astype(int)
+        return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+    def reset_statistics(self):
+        self.dispatch_time = 0.0
+        self.tasks         = [] # (process id, particles, seconds) per task
+
+
+    def statistics(self): # Time in dispatch and per task since the last call
+        statistics = {"dispatch" : self.dispatch_time, "workers" : self.processes, "tasks" : self.tasks}
+        self.reset_statistics()
+        return statistics
+
+
+    def dispatch(self, task, proposals, func, kwargs):
+        begin = time.perf_counter()
+        self.arrays["particles"][:len(proposals)] = proposals
+        ranges  = self.ranges(len(proposals))
+        results = self.pool.starmap(worker_task, [(task, start, stop, func, kwargs) for start, stop in ranges])
+        self.tasks += [(pid, stop - start, seconds) for (start, stop), (values, pid, seconds) in zip(ranges, results)]
+        self.dispatch_time += time.perf_counter() - begin
+        if isinstance(results[0][0], tuple): # Observations and gradients
+            return tuple(np.concatenate(arrays) for arrays in zip(*[values for values, pid, seconds in results]))
+        return np.concatenate([values for values, pid, seconds in results])
+
+
+    def observations(self, proposals, func, kwargs):
+        return self.dispatch(worker_observations, proposals, func, kwargs)
+
+
+    def gradients(self, proposals, func, kwargs):
+        return self.dispatch(worker_gradients, proposals, func, kwargs)
+
+
+    def chains(self, particles, potent, observed, gradients, func, kwargs, kernel, T, M_l): # Moved copies of the arrays, the number of accepted moves and of solves
+        begin, n = time.perf_counter(), len(particles)
+        self.arrays["particles"][:n], self.arrays["potent"][:n], self.arrays["observed"][:n] = particles, potent, observed
+        if gradients is not None:
+            self.arrays["gradients"][:n] = gradients
+        ranges  = self.ranges(n)
+        seeds   = np.random.randint(2**31, size=len(ranges))
+        results = self.pool.starmap(worker_task, [(worker_chains, start, stop, func, kwargs, kernel, T, M_l, seed) for (start, stop), seed in zip(ranges, seeds)])
+        self.tasks += [(pid, stop - start, seconds) for (start, stop), (values, pid, seconds) in zip(ranges, results)]
+        self.dispatch_time += time.perf_counter() - begin
+        return (self.arrays["particles"][:n].copy(), self.arrays["potent"][:n].copy(), self.arrays["observed"][:n].copy(),
+                self.arrays["gradients"][:n].copy() if gradients is not None else None,
+                sum(values[0] for values, pid, seconds in results), sum(values[1] for values, pid, seconds in results))
+
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.arrays = {} # Views have to be released before the shared memory is closed
+        for shm in self.shm.values():
+            shm.close()
+            shm.unlink()
+
+
+class Serial_Pool(): # Same interface as Worker_Pool, evaluates in the calling process
+    def __init__(self, delta, var, capacity, dim, **kwargs):
+        func        = kwargs["func"]   if "func"   in kwargs else None
+        func_kwargs = kwargs["kwargs"] if "kwargs" in kwargs else {}
+        profile     = kwargs["profile"] if "profile" in kwargs else None
+        self.profiler = Profiler(profile) if profile is not None else None
+        self.set_data(delta, var)
+        self.reset_statistics()
+        if func is not None:
+            func(np.zeros(dim), **func_kwargs)
+
+
+    def set_data(self, delta, var):
+        self.delta = np.array(delta, dtype=float)
+        self.var   = var
+
+
+    def reset_statistics(self):
+        self.dispatch_time = 0.0
+        self.tasks         = []
+
+
+    def statistics(self):
+        statistics = {"dispatch" : self.dispatch_time, "workers" : 1, "tasks" : self.tasks}
+        self.reset_statistics()
+        return statistics
+
+
+    def timed(self, n, func, *args, **kwargs): # Counted as one task of n particles
+        begin = time.perf_counter()
+        with self.profiler or nullcontext():
+            values = func(*args, **kwargs)
+        seconds = time.perf_counter() - begin
+        self.tasks.append((os.getpid(), n, seconds))
+        self.dispatch_time += seconds
+        return values
+
+
+    def observations(self, proposals, func, kwargs):
+        return self.timed(len(proposals), func, proposals, **kwargs)
+
+
+    def gradients(self, proposals, func, kwargs):
+        return self.timed(len(proposals), func, proposals, gradient=(self.delta, self.var), **kwargs)
+
+
+    def chains(self, particles, potent, observed, gradients, func, kwargs, kernel, T, M_l):
+        particles, potent, observed = particles.copy(), potent.copy(), observed.copy()
+        gradients = gradients.copy() if gradients is not None else None
+        accepted, solves = self.timed(len(particles), run_chains, particles, potent, observed, gradients, func, kwargs, kernel, T, M_l, self.delta, self.var)
+        return particles, potent, observed, gradients, accepted, solves
+
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.dump()
@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # The modules live in the root of the repository
+
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch): # The sampler writes its pickles to Data/ in the working directory
+    (tmp_path / "Data").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,28 @@
+import numpy as np
+
+'''
+Cheap nonlinear stand-in for forward_observation with the same calling convention, so the sampler can be tested
+without dolfinx: Y of shape (2J,) or (M, 2J) with J = 2, four observations per particle and, with
+gradient=(delta, var), the gradients of -|delta - observations|^2/(2*var). shift offsets the observations,
+which plays the role of a coarser discretization.
+'''
+
+J     = 2
+delta = np.array([0.5, -0.3, 0.2, 0.1])
+var   = 0.05
+
+
+def forward_stub(Y, gradient=None, shift=0.0, **kwargs):
+    Y = np.atleast_2d(Y)
+    observations = np.column_stack([3*Y[:, :2] + 0.2*Y[:, :2]**2, np.sin(Y[:, 2]), Y[:, 3]*Y[:, 0]]) + shift
+    if gradient is None:
+        return observations
+    residual  = (gradient[0] - observations)/gradient[1]
+    gradients = np.column_stack([residual[:, 0]*(3 + 0.4*Y[:, 0]) + residual[:, 3]*Y[:, 3], residual[:, 1]*(3 + 0.4*Y[:, 1]),
+                                 residual[:, 2]*np.cos(Y[:, 2]), residual[:, 3]*Y[:, 0]])
+    return observations, gradients
+
+
+def moments(smc): # Weighted mean and variance of the particles
+    mean = smc.weights @ smc.particles
+    return mean, smc.weights @ (smc.particles - mean)**2
@@ -0,0 +1,31 @@
+import numpy as np
+import os
+from Checkpoint import Checkpoint
+
+
+def test_round_trip(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    arrays = {"particles" : np.random.uniform(size=(10, 4)), "T" : np.array([0, 0.5, 1]), "stage" : 3, "rng_keys" : np.arange(624, dtype=np.uint32)}
+    checkpoint.write("current", **arrays)
+    state = checkpoint.read("current")
+    assert sorted(state) == sorted(arrays)
+    for name, value in arrays.items():
+        assert np.array_equal(state[name], value)
+        assert state[name].dtype == np.asarray(value).dtype
+
+
+def test_overwrite_leaves_no_temporary_file(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    checkpoint.write("current", x=np.zeros(3))
+    checkpoint.write("current", x=np.ones(3))
+    assert np.array_equal(checkpoint.read("current")["x"], np.ones(3))
+    assert os.listdir(str(tmp_path)) == ["current.npz"]
+
+
+def test_stages_in_order(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    for stage in [2, 0, 10, 1]:
+        checkpoint.write("stage_{:04d}".format(stage), x=np.array(stage))
+    checkpoint.write("current", x=np.array(10))
+    open(checkpoint.path("stage_0011.tmp"), "wb").close() # Left behind by a crash during a write
+    assert checkpoint.stages() == ["stage_0000", "stage_0001", "stage_0002", "stage_0010"]
@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("gmsh")
+pytest.importorskip("dolfinx")
+from Generate_Mesh import Generate_Mesh
+
+
+def test_key_normalises_the_geometry():
+    assert Generate_Mesh(R=7, R_PML=11, r0=1).key == Generate_Mesh(R=7.0, R_PML=11.0, r0=1.0).key
+    assert Generate_Mesh(h=0.125).key == Generate_Mesh(h=1/8).key
+
+
+def test_key_separates_meshes():
+    keys = {Generate_Mesh().key, Generate_Mesh(R=6).key, Generate_Mesh(h=0.1).key, Generate_Mesh(quad=True).key,
+            Generate_Mesh(graded=True).key, Generate_Mesh(graded=True, growth=0.5).key}
+    assert len(keys) == 6
+    assert Generate_Mesh(growth=0.5).key == Generate_Mesh().key # Grading parameters only matter for graded meshes
+
+
+def test_graded_sizes():
+    mesh = Generate_Mesh(graded=True, h=0.02)
+    assert mesh.h_PML == (11 - 7.5)/8 and mesh.h_core == 1/16
+    assert Generate_Mesh(graded=True, h=0.02, n_PML=4, n_core=2).h_PML == 2*mesh.h_PML
+    assert Generate_Mesh(graded=True, h=0.5).h_core == 0.5 # Never finer than h
+
+
+def test_cached(run_dir):
+    mesh = Generate_Mesh(h=0.125)
+    assert mesh.cached() is None
+    (run_dir / "Meshes").mkdir()
+    for suffix in [".XDMF", ".h5"]: # Name of the meshes before the hashed keys
+        (run_dir / "Meshes" / ("Mesh_h=0.12500_quad=False" + suffix)).touch()
+    assert mesh.cached() == "Meshes/Mesh_h=0.12500_quad=False.XDMF"
+    assert Generate_Mesh(h=0.125, R=6).cached() is None
+    for suffix in [".xdmf", ".h5"]:
+        (run_dir / (mesh.path + suffix)).touch()
+    assert mesh.cached() == mesh.path + ".xdmf"
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("dolfinx")
+from scipy.special import zeta
+from Helmholtz import spectral_constants, get_J, Coordinate_Mapping, alpha_hatxx, alpha_hatxy, alpha_hatyy, kappa_sqrd_trans
+
+
+def legacy_J(s, epsilon, char_len): # Loop of the original get_J
+    k = np.arange(1, 1000000, dtype=float)
+    var_sum = np.sum(1/(1 + s*k**(2 + epsilon))**2) if char_len else zeta(2*(2 + epsilon))
+    sum_j, j = 0, 0
+    while sum_j < 0.95*var_sum:
+        j += 1
+        sum_j += 1/((1 + s*j**(2 + epsilon))**2) if char_len else 1/(j**(2*(2 + epsilon)))
+    return j
+
+
+@pytest.mark.parametrize("s, char_len", [(0.2, True), (0.02, True), (0.001, True), (0.001, False)])
+def test_spectral_constants(s, char_len):
+    k = np.arange(1, 1000000, dtype=float)
+    sum, J = spectral_constants(s, 0.001, char_len)
+    assert J == legacy_J(s, 0.001, char_len) == get_J(s=s, char_len=char_len)
+    assert np.isclose(sum, np.sum(1/(1 + s*k**(2.001))) if char_len else zeta(2.001))
+
+
+@pytest.mark.parametrize("char_len", [True, False])
+def test_coordinate_mapping(char_len):
+    np.random.seed(0)
+    R, r0, s, epsilon = 7, 1, 0.2, 0.001
+    sum, J = spectral_constants(s, epsilon, char_len)
+    rho, phi = np.random.uniform(0.05, R + 1, 500), np.random.uniform(-np.pi, np.pi, 500) # Points in every region of the mapping
+    x = np.array([rho*np.cos(phi), rho*np.sin(phi)])
+    Y = np.random.uniform(-1, 1, (2*J, 3))
+    mapping = Coordinate_Mapping(R, r0, char_len, s, epsilon, J, sum, x)
+    batch   = mapping(Y)
+    inside  = (r0/4 < rho)*(rho <= R) # The legacy functions are only evaluated where the mapping is not the identity
+    for m in range(Y.shape[1]):
+        values = mapping(Y[:, m])
+        for value, legacy in zip(values, [alpha_hatxx, alpha_hatxy, alpha_hatyy, kappa_sqrd_trans]):
+            assert np.allclose(value[inside], legacy(R, r0, char_len, s, epsilon, J, sum, Y[:, m], x[:, inside]))
+        for value, value_batch in zip(values, batch):
+            assert np.allclose(value, value_batch[:, m])
+        assert np.allclose(values[0][~inside], 1) and np.allclose(values[1][~inside], 0) and np.allclose(values[3][~inside], 1)
@@ -0,0 +1,35 @@
+import numpy as np
+import json
+from Metrics import Metrics
+from forward_stub import forward_stub, delta, var, J
+from Sequential_Monte_Carlo import Sequential_Monte_Carlo
+
+
+def test_summary():
+    summary = Metrics(None).summary(2.0, 2, [(0, 10, 2.0), (1, 10, 1.0), (0, 5, 1.0)])
+    assert summary["busy"] == {"0" : 3.0, "1" : 1.0}
+    assert summary["solve"] == 4.0 and summary["utilization"] == 1.0 and summary["overhead"] == 0.0
+
+
+def test_stream_of_a_run(run_dir):
+    np.random.seed(1)
+    smc = Sequential_Monte_Carlo(delta, var, J, M=500, checkpoint_dir=str(run_dir / "checkpoints"))
+    smc.SMC_algorithm(forward_stub, {})
+    with open(run_dir / "checkpoints" / "metrics.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    stages = [record for record in records if record["event"] == "stage"]
+    assert [record["stage"] for record in stages] == list(range(len(smc.T)))
+    assert [record["T"] for record in stages] == smc.T
+    for record in stages[1:]: # The sweeps of a stage add up to the stage
+        sweeps = [sweep for sweep in records if sweep["event"] == "sweep" and sweep["stage"] == record["stage"]]
+        assert len(sweeps) == record["M_l"]
+        assert sum(sweep["solves"] for sweep in sweeps) == record["solves"]
+        assert record["wall"] >= record["dispatch"] >= 0
+        assert set(record["histograms"]) == set(record["busy"])
+
+
+def test_disabled_stream(run_dir):
+    np.random.seed(1)
+    smc = Sequential_Monte_Carlo(delta, var, J, M=200, checkpoint_dir=str(run_dir / "checkpoints"), metrics=None)
+    smc.SMC_algorithm(forward_stub, {})
+    assert not (run_dir / "checkpoints" / "metrics.jsonl").exists()
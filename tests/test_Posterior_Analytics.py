@@ -0,0 +1,49 @@
+import numpy as np
+import pickle
+import pytest
+
+pytest.importorskip("matplotlib")
+from Posterior_Analytics import Posterior_Analytics, radius_coefficients, simulations, find_simulation, pickle_snapshots
+
+
+def write(path, *objects):
+    with open(path, "wb") as file:
+        for obj in objects:
+            pickle.dump(obj, file)
+
+
+def test_simulations(tmp_path):
+    for name in ["20250119-132403_Parameters_Simulation", "20250119-132404_Prior", "20250119-140000_T=0.5", "20250119-150000_Posterior",
+                 "20250119-150001_Prior", "20250119-160000_Posterior", "20250209-171146_Parameters_Simulation", "20250209-171147_Prior"]:
+        write(tmp_path / (name + ".pickle"), np.zeros((4, 2)), np.full(4, 0.25))
+    groups = simulations(str(tmp_path))
+    assert len(groups) == 2 and [len(run) for run in groups[0][1]] == [3, 2]
+    assert find_simulation(str(tmp_path)) == groups[-1]
+    assert find_simulation(str(tmp_path), "20250119-132403") == groups[0]
+    assert [name for name, particles, weights in pickle_snapshots(groups[0][1][0])] == ["Prior", "T=0.5", "Posterior"]
+    with pytest.raises(ValueError):
+        find_simulation(str(tmp_path), "20250101-000000")
+
+
+def test_radius():
+    J, Y = 3, np.random.default_rng(0).uniform(-1, 1, (5, 6))
+    analytics = Posterior_Analytics(J, s=0.2)
+    c, phi = radius_coefficients(J, s=0.2), analytics.phi
+    expected = 1 + sum(c[j-1]*(np.outer(Y[:, 2*j-2], np.cos(j*phi)) + np.outer(Y[:, 2*j-1], np.sin(j*phi))) for j in range(1, J+1))
+    assert np.allclose(analytics.radius(Y), expected)
+
+
+def test_summary():
+    rng       = np.random.default_rng(1)
+    particles = rng.uniform(-1, 1, (2000, 4))
+    weights   = rng.uniform(size=2000)
+    analytics = Posterior_Analytics(2, block=1000) # Several blocks of angles
+    summary   = analytics.summarize("T=1", particles, weights)
+    weights   = weights/np.sum(weights)
+    assert np.allclose(summary["mean"], weights @ particles)
+    assert np.allclose(summary["histograms"].sum(axis=1), 1)
+    r = analytics.radius(particles)
+    assert np.allclose(summary["radius_mean"], weights @ r)
+    assert np.allclose(summary["radius_var"], weights @ (r - weights @ r)**2)
+    median = [r[np.argsort(r[:, i]), i][np.argmax(np.cumsum(weights[np.argsort(r[:, i])]) >= 0.5)] for i in range(r.shape[1])]
+    assert np.allclose(summary["radius_quantiles"][1], median)
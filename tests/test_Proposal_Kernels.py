@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from Proposal_Kernels import proposal_kernels
+
+'''
+The kernels are checked through the invariance of a known distribution under Metropolis-Hastings moves: the
+uniform prior for the kernels without gradients, a Gaussian inside the prior box for MALA and HMC, whose
+acceptance probability contains the log_correction of move.
+'''
+
+loc, scale = np.full(3, -1.0), np.full(3, 2.0)
+mean, std  = np.array([0.2, -0.1, 0.0]), 0.15 # Gaussian target, far enough from the faces of the box
+
+
+def potential(particles):
+    return -np.sum((particles - mean)**2, axis=1)/(2*std**2)
+
+
+def gradient(particles):
+    return -(particles - mean)/std**2
+
+
+def metropolis_hastings(kernel, particles, n_moves): # n_moves accept/reject steps of every particle, the target is the prior for kernels without gradients
+    for i in range(n_moves):
+        if kernel.gradient:
+            proposals, inside, observed, proposal_gradients, log_correction = kernel.move(particles, gradient(particles), 1, lambda P: (P, gradient(P)))
+            log_ratio = np.full(len(particles), -np.inf)
+            log_ratio[inside] = potential(proposals[inside]) - potential(particles[inside]) + log_correction
+        else:
+            proposals = kernel.propose(particles)
+            log_ratio = np.where(kernel.in_support(proposals), 0.0, -np.inf)
+        accepted = np.log(np.random.uniform(size=len(particles))) < log_ratio
+        particles = np.where(accepted[:, None], proposals, particles)
+    return particles
+
+
+@pytest.mark.parametrize("name, kernel_kwargs", [("RW", {}), ("covariance", {}), ("covariance", {"rank" : 1}), ("pCN", {})])
+def test_prior_is_invariant(name, kernel_kwargs):
+    np.random.seed(0)
+    kernel    = proposal_kernels[name](loc, scale, lambda_l=0.5, **kernel_kwargs)
+    particles = loc + scale*np.random.uniform(size=(20000, 3))
+    kernel.fit(particles, np.full(len(particles), 1/len(particles)), lambda value: value)
+    moved = metropolis_hastings(kernel, particles.copy(), 10)
+    assert np.all(kernel.in_support(moved))
+    assert np.allclose(np.mean(moved, axis=0), loc + scale/2, atol=0.02)
+    assert np.allclose(np.var(moved, axis=0), scale**2/12, rtol=0.05)
+    assert np.mean(np.any(moved != particles, axis=1)) > 0.5 # The chains did move
+
+
+def test_crank_nicolson_stays_in_support():
+    np.random.seed(1)
+    kernel    = proposal_kernels["pCN"](loc, scale, lambda_l=1)
+    particles = loc + scale*np.random.uniform(size=(1000, 3))
+    assert np.all(kernel.in_support(kernel.propose(particles)))
+
+
+@pytest.mark.parametrize("name", ["MALA", "HMC"])
+def test_gaussian_is_invariant(name):
+    np.random.seed(2)
+    kernel    = proposal_kernels[name](loc, scale, lambda_l=0.7)
+    particles = mean + std*np.random.standard_normal((20000, 3))
+    kernel.fit(particles, np.full(len(particles), 1/len(particles)), lambda value: value)
+    moved = metropolis_hastings(kernel, particles.copy(), 10)
+    assert np.allclose(np.mean(moved, axis=0), mean, atol=0.01)
+    assert np.allclose(np.std(moved, axis=0), std, rtol=0.03)
+
+
+def test_langevin_correction_is_the_ratio_of_the_proposal_densities():
+    np.random.seed(3)
+    kernel    = proposal_kernels["MALA"](loc, scale, lambda_l=0.3)
+    particles = mean + std*np.random.standard_normal((50, 3))
+    kernel.fit(particles, np.full(len(particles), 1/len(particles)), lambda value: value)
+    proposals, inside, observed, proposal_gradients, log_correction = kernel.move(particles, gradient(particles), 1, lambda P: (P, gradient(P)))
+    log_q = lambda y, x: -np.sum(((y - x - 0.5*kernel.std_RW**2*gradient(x))/kernel.std_RW)**2, axis=1)/2 # log q(y|x) up to a constant
+    assert np.allclose(log_correction, log_q(particles[inside], proposals[inside]) - log_q(proposals[inside], particles[inside]))
+
+
+def test_hamiltonian_reflection_is_reversible():
+    np.random.seed(4)
+    kernel = proposal_kernels["HMC"](loc, scale)
+    x, p   = loc + scale*np.random.uniform(size=(1000, 3)), 3*np.random.standard_normal((1000, 3))
+    x1, p1 = kernel.reflect(x + p, p)
+    x2, p2 = kernel.reflect(x1 - p1, -p1) # Back with the momenta flipped
+    assert np.all(kernel.in_support(x1))
+    assert np.allclose(x2, x) and np.allclose(-p2, p)
@@ -0,0 +1,200 @@
+import numpy as np
+import pytest
+from mpi4py import MPI
+from forward_stub import forward_stub, delta, var, J, moments
+from Sequential_Monte_Carlo import Sequential_Monte_Carlo, MPI_Sequential_Monte_Carlo
+from Worker_Pool import Serial_Pool
+
+'''
+The MPI tests also run on several ranks: mpirun -n 3 python -m pytest tests/test_Sequential_Monte_Carlo.py -k mpi
+'''
+
+
+def run(run_dir, seed=1, kwargs_levels=None, **kwargs): # Posterior of the stub forward map
+    np.random.seed(seed)
+    smc = Sequential_Monte_Carlo(delta, var, J, **dict({"M" : 1000, "checkpoint_dir" : str(run_dir / "checkpoints"), "metrics" : None}, **kwargs))
+    smc.SMC_algorithm(forward_stub, {}, kwargs_levels)
+    return smc
+
+
+def assert_posterior(mean, variance, reference): # Within the Monte Carlo error of a few thousand particles
+    assert np.all(np.abs(mean - reference[0]) < 0.3*np.sqrt(reference[1]))
+    assert np.allclose(variance, reference[1], rtol=0.3)
+
+
+@pytest.fixture(scope="module")
+def reference(tmp_path_factory, request): # Random walk posterior the other configurations are compared with
+    run_dir = tmp_path_factory.mktemp("reference")
+    (run_dir / "Data").mkdir()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(run_dir)
+        return moments(run(run_dir, M=4000))
+
+
+@pytest.mark.parametrize("kernel", ["covariance", "pCN"])
+def test_kernels_agree(run_dir, reference, kernel):
+    smc = run(run_dir, kernel=kernel, M=4000)
+    assert smc.T[-1] == 1
+    assert_posterior(*moments(smc), reference)
+
+
+class Crash(Exception):
+    pass
+
+
+class Crashing_Pool(Serial_Pool): # Fails at the n-th dispatch, as a killed job would
+    def __init__(self, *args, crash_at=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.crash_at, self.calls = crash_at, 0
+
+
+    def observations(self, proposals, func, kwargs):
+        self.calls += 1
+        if self.calls == self.crash_at:
+            raise Crash()
+        return super().observations(proposals, func, kwargs)
+
+
+class Serial_Sequential_Monte_Carlo(Sequential_Monte_Carlo): # One process, so the runs are reproducible
+    crash_at = None
+
+    def make_pool(self, func, kwargs):
+        return Crashing_Pool(self.delta, self.var, self.M, 2*self.J, crash_at=self.crash_at)
+
+
+def test_checkpoint_round_trip(tmp_path):
+    np.random.seed(0)
+    smc = Sequential_Monte_Carlo(np.zeros(3), 0.1, 2, M=20, kernel="covariance", checkpoint_dir=None, metrics=None)
+    smc.checkpoint = smc.open_checkpoint(str(tmp_path))
+    smc.weights   = np.random.uniform(size=smc.M)
+    smc.observed  = np.random.standard_normal((smc.M, 3))
+    smc.T, smc.level, smc.stage = [0, 0.25, 1], 1, 7
+    smc.kernel.fit(smc.particles, smc.weights, lambda value: value)
+    potent   = smc.misfit(smc.observed)
+    progress = {"sweep" : 2, "M_l" : 5, "total_accepted" : 11, "total_screened" : 0, "total_candidates" : 0}
+    smc.write_checkpoint("current", potent, progress)
+    expected = np.random.uniform(size=5) # Draws after the checkpoint are repeated on resume
+
+    restored = Sequential_Monte_Carlo(np.zeros(3), 0.1, 2, M=20, kernel="covariance", checkpoint_dir=None, metrics=None)
+    restored_potent, restored_progress = restored.set_state(smc.checkpoint.read("current"))
+    assert np.array_equal(np.random.uniform(size=5), expected)
+    assert restored_progress == progress
+    assert np.array_equal(restored_potent, potent)
+    for name in ["particles", "weights", "observed"]:
+        assert np.array_equal(getattr(restored, name), getattr(smc, name))
+    assert (restored.T, restored.level, restored.stage) == (smc.T, smc.level, smc.stage)
+    assert np.array_equal(restored.kernel.factor, smc.kernel.factor)
+
+
+def resumed(run_dir, crash_at, kwargs_levels=None, **kwargs): # Run that is killed at the crash_at-th dispatch and resumed from its checkpoint
+    np.random.seed(3)
+    options = dict({"M" : 300, "checkpoint_dir" : str(run_dir / "checkpoints"), "metrics" : None}, **kwargs)
+    smc = Serial_Sequential_Monte_Carlo(delta, var, J, **options)
+    smc.crash_at = crash_at
+    try:
+        smc.SMC_algorithm(forward_stub, {}, kwargs_levels)
+    except Crash:
+        np.random.seed(99) # Resuming restores the generator from the checkpoint
+        smc = Serial_Sequential_Monte_Carlo(delta, var, J, **dict(options, checkpoint_dir=None))
+        smc.SMC_algorithm(forward_stub, {}, kwargs_levels, resume_from=str(run_dir / "checkpoints"))
+    return smc
+
+
+def test_resume_is_exact(run_dir):
+    complete = resumed(run_dir, None)
+    for crash_at in [2, 25, 60]:
+        smc = resumed(run_dir / str(crash_at), crash_at)
+        assert np.array_equal(smc.particles, complete.particles) and smc.T == complete.T
+
+
+def test_mpi_systematic_resample():
+    comm = MPI.COMM_WORLD
+    smc  = MPI_Sequential_Monte_Carlo(np.zeros(2), 0.1, 1, M=101, seed=1, comm=comm, checkpoint_dir=None, metrics=None)
+    index   = smc.bounds[smc.rank] + np.arange(smc.n_local) # Global index of the particles of this rank
+    weights = (np.arange(smc.M) + 1.0)**2
+    weights /= np.sum(weights)
+    smc.particles, smc.observed, smc.weights = np.column_stack([index, index]).astype(float), np.column_stack([-index, 2*index]).astype(float), weights[index]
+    potent = smc.resample(index/smc.M)
+
+    assert len(smc.particles) == smc.n_local
+    assert np.allclose(smc.weights, 1/smc.M)
+    particles, observed, potent = [np.concatenate(comm.allgather(value)) for value in [smc.particles, smc.observed, potent]]
+    ids = particles[:, 0].astype(int)
+    assert np.array_equal(observed, np.column_stack([-ids, 2*ids])) and np.allclose(potent, ids/smc.M) # Outputs and potentials follow their particles
+    assert np.all(np.diff(ids) >= 0) # Global order is kept
+    counts = np.bincount(ids, minlength=smc.M)
+    assert np.sum(counts) == smc.M
+    assert np.all(np.abs(counts - smc.M*weights) < 1) # Systematic resampling rounds every expected count up or down
+
+
+def test_mpi_posterior(run_dir, reference):
+    smc = MPI_Sequential_Monte_Carlo(delta, var, J, M=4000, seed=1, checkpoint_dir=None, metrics=None)
+    smc.SMC_algorithm(forward_stub, {})
+    weights, particles = np.concatenate(smc.comm.allgather(smc.weights)), np.concatenate(smc.comm.allgather(smc.particles))
+    mean = weights @ particles
+    assert_posterior(mean, weights @ (particles - mean)**2, reference)
+
+
+def test_delayed_acceptance_is_exact(run_dir, reference):
+    smc = run(run_dir, M=4000, kwargs_coarse={"shift" : 0.2}) # Biased coarse model, the second stage corrects for it
+    assert smc.screen_l > 0
+    assert_posterior(*moments(smc), reference)
+
+
+def test_surrogate_screen_is_exact(run_dir, reference):
+    smc = run(run_dir, M=4000, surrogate="screen") # The hyperbolic cross misses the mixed term of the stub, the second stage corrects for it
+    assert smc.n_surrogate > 0
+    assert_posterior(*moments(smc), reference)
+
+
+def test_surrogate_approximate(run_dir, reference):
+    smc = run(run_dir, M=4000, surrogate="approximate", surrogate_kwargs={"basis" : "total"})
+    assert smc.n_surrogate > 0
+    assert_posterior(*moments(smc), reference)
+
+
+def test_surrogate_basis_larger_than_particles(run_dir):
+    with pytest.raises(ValueError):
+        Sequential_Monte_Carlo(np.zeros(4), var, 58, M=1000, surrogate="screen", surrogate_kwargs={"basis" : "total", "max_terms" : 10**4}, metrics=None)
+
+
+def test_multilevel_bridge(run_dir, reference):
+    smc = run(run_dir, M=4000, kwargs_levels=[{"shift" : 0.4}]) # The coarse level is too far off for a single reweighting
+    assert smc.level == 1 and smc.level_beta is None and smc.stage > len(smc.T) + 1 # Intermediate steps between the levels
+    assert_posterior(*moments(smc), reference)
+
+
+def test_multilevel_bridge_with_coarse_screen(run_dir, reference):
+    smc = run(run_dir, M=4000, kwargs_levels=[{"shift" : 0.4}], kwargs_coarse={"shift" : 0.1})
+    assert smc.stage > len(smc.T) + 1
+    assert_posterior(*moments(smc), reference)
+
+
+def test_resume_inside_multilevel_bridge(run_dir):
+    complete = resumed(run_dir, None, [{"shift" : 0.4}])
+    for crash_at in [76, 80, 86, 89]: # The bridge runs from the 76th to the 87th dispatch
+        smc = resumed(run_dir / str(crash_at), crash_at, [{"shift" : 0.4}])
+        assert np.array_equal(smc.particles, complete.particles) and smc.T == complete.T
+
+
+def test_retarget(run_dir):
+    new_delta, new_var = delta + np.array([0.2, 0.0, -0.2, 0.1]), 0.08 # Far enough that the old posterior fails the comparison
+    np.random.seed(2)
+    direct = Sequential_Monte_Carlo(new_delta, new_var, J, M=4000, checkpoint_dir=str(run_dir / "direct"), metrics=None)
+    direct.SMC_algorithm(forward_stub, {})
+    smc = run(run_dir, M=4000)
+    smc.SMC_retarget(forward_stub, {}, new_delta, new_var)
+    assert np.array_equal(smc.delta, new_delta) and smc.var == new_var
+    assert_posterior(*moments(smc), moments(direct))
+
+
+@pytest.mark.parametrize("kernel", ["RW", "covariance"])
+def test_chains(run_dir, reference, kernel): # Whole chains in the workers sample the same posterior as the sweeps
+    smc = run(run_dir, M=4000, mcmc="chains", kernel=kernel)
+    assert smc.T[-1] == 1
+    assert_posterior(*moments(smc), reference)
+
+
+def test_chains_reject_delayed_acceptance(run_dir):
+    with pytest.raises(ValueError):
+        Sequential_Monte_Carlo(delta, var, J, mcmc="chains", kwargs_coarse={"shift" : 0.2}, metrics=None)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from math import comb
+from Surrogate import Polynomial_Surrogate
+from numpy.polynomial.legendre import legval
+
+loc, scale = np.full(3, -1.0), np.full(3, 2.0)
+
+
+def test_basis_is_the_tensorised_legendre_basis():
+    surrogate = Polynomial_Surrogate(loc, scale, basis="total", degree=3)
+    Y   = np.random.default_rng(0).uniform(-1, 1, (20, 3))
+    Phi = surrogate.basis(Y)
+    assert Phi.shape == (20, comb(3 + 3, 3))
+    for column, index in enumerate(surrogate.indices): # Product of the univariate Legendre polynomials of the multi-index
+        expected = np.ones(len(Y))
+        for dim, deg in index.items():
+            expected *= legval(Y[:, dim], np.eye(deg + 1)[deg])
+        assert np.allclose(Phi[:, column], expected)
+
+
+def test_basis_size():
+    dim = 116 # 2J for J = 58
+    assert Polynomial_Surrogate(np.full(dim, -1.0), np.full(dim, 2.0)).P == 1 + 2*dim # Hyperbolic cross of degree 2
+    capped = Polynomial_Surrogate(np.full(dim, -1.0), np.full(dim, 2.0), basis="total", max_terms=1000)
+    assert capped.degree == 1 and capped.P == 1 + dim # C(118, 2) = 6903 terms exceed the budget
+
+
+def test_fit_recovers_a_polynomial():
+    surrogate = Polynomial_Surrogate(loc, scale, basis="total", degree=2, ridge=1e-12)
+    Y = np.random.default_rng(1).uniform(-1, 1, (200, 3))
+    G = np.column_stack([1 + Y[:, 0]*Y[:, 1], Y[:, 2]**2 - Y[:, 0]])
+    surrogate.add(Y[:100], G[:100])
+    surrogate.add(Y[100:], G[100:])
+    assert surrogate.fit()
+    assert np.allclose(surrogate.predict(Y), G, atol=1e-6)
+
+
+def test_underdetermined_fit_raises():
+    surrogate = Polynomial_Surrogate(loc, scale, basis="total", degree=2, min_samples=5)
+    with pytest.raises(ValueError):
+        surrogate.fit()